@@ -2,22 +2,16 @@
 
 from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
 
-import os
-import tempfile
-from uuid import uuid4
-
 # Import the core and GUI elements of Qt
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+from abcv.tunebook import SvgPages
+from abcv.gui_jobs import scheduler
 from abcv.scrollable_svg import ScrollableSvgWidget, fits
 from abcv.os_ifdef import is_linux
 
-def _make_tmp_fn():
-    tempdir = tempfile.gettempdir()
-    return os.path.join(tempdir, "%s.svg" % uuid4())
-
 class AbcDisplay(QWidget):
     def __init__(self, tune=None, parent=None, fit=fits.FIT_ALL):
         QWidget.__init__(self, parent=parent)
@@ -57,14 +51,16 @@ class AbcDisplay(QWidget):
 
         self.show_or_hide_pages()
 
+        # the rendered pages of the current tune
+        self._pages = SvgPages()
+
+        self._tune = None
         if tune:
             self.tune = tune
-        else:
-            self._tune = None
 
     def resizeEvent(self, *args, **kwargs):
         self.svg.visible_width, self.svg.visible_height = self.size().width(), self.size().height()
-        self.refresh()
+        self._show_page()
 
     @property
     def fit_style(self):
@@ -80,6 +76,9 @@ class AbcDisplay(QWidget):
 
     @tune.setter
     def tune(self, new_val):
+        # a different tune starts on its first page
+        if new_val is not self._tune:
+            self.page = 1
         self._tune = new_val
         self.refresh()
 
@@ -93,12 +92,30 @@ class AbcDisplay(QWidget):
                 wid.hide()
 
     def refresh(self):
+        """Render the tune (or fetch it from the render cache) in the
+        background, and show the current page when it's ready"""
         if self._tune:
-            self._svg_fn = _make_tmp_fn()
-            self.pages = self._tune.write_svg(self._svg_fn, page=self.page)
-            self.show_or_hide_pages()
-            self.svg.load(self._svg_fn)
-            self.show_page_num()
+            # a newer refresh supersedes any render still in progress
+            scheduler().submit(self._tune.svg_pages,
+                               key=("svg pages", id(self)),
+                               on_done=self.set_pages)
+
+    def set_pages(self, pages):
+        """Show an already-rendered SvgPages of the tune"""
+        self._pages = pages
+        self.pages = len(pages)
+        self.page = max(1, min(self.page, self.pages))
+        self.show_or_hide_pages()
+        self._show_page()
+
+    def _show_page(self):
+        # page flips come from memory; nothing is re-rendered
+        if 0 < self.page <= len(self._pages):
+            self.svg.load(self._pages[self.page - 1])
+        else:
+            # nothing rendered; don't leave the last tune showing
+            self.clear()
+        self.show_page_num()
 
     def show_page_num(self):
         self.page_label.setText("%s of %s" % (self.page, self.pages))
@@ -106,12 +123,12 @@ class AbcDisplay(QWidget):
     def next_page(self, *args, **kwargs):
         if self.page < self.pages:
             self.page += 1
-            self.refresh()
+            self._show_page()
 
     def prev_page(self, *args, **kwargs):
         if self.page > 1:
             self.page -= 1
-            self.refresh()
+            self._show_page()
 
     def clear(self):
         self.svg.clear()
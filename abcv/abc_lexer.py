@@ -0,0 +1,299 @@
+# coding=utf-8
+
+"""Splitting ABC into tokens, for everything that reads the music in it
+rather than just its fields.  A token is a tuple (kind, start, end) of
+one of the kinds below and where it is in the text; what it says is
+text[start:end].  Whitespace isn't a token, and neither are the bits of
+music that only matter to layout (y, ` and \\).
+
+ABC is lexed a line at a time, and what a line is depends only on the
+state the line before left off in: outside a tune, in a tune's header or
+in its body.  That's what lets LexedText (and the editor's highlighter)
+lex again just the lines an edit touches."""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import re
+from bisect import bisect_right
+
+# the kinds of token, which are also the names of _music's groups
+FIELD = "field"                   # a field line, e.g. T:Title, up to any comment
+INLINE_FIELD = "inline_field"     # a field in the music, e.g. [K:G]
+TEXT = "text"                     # free text, outside a tune or in its header
+DIRECTIVE = "directive"           # a line of %%, e.g. %%MIDI program 1
+COMMENT = "comment"               # % and the rest of the line
+NOTE = "note"                     # accidental, letter, octave and length, e.g. ^c'3/2
+REST = "rest"                     # z or x, and the length
+MEASURE_REST = "measure_rest"     # Z or X, and the number of bars
+BAR = "bar"                       # a bar line, with any repeat marks, e.g. :|
+ENDING = "ending"                 # a numbered ending, e.g. [2 or the 1 of |1
+CHORD_START = "chord_start"       # [
+CHORD_END = "chord_end"           # ], and the chord's length
+GRACE_START = "grace_start"       # { or {/
+GRACE_END = "grace_end"           # }
+TIE = "tie"                       # -
+BROKEN_RHYTHM = "broken_rhythm"   # < or >, or more of them
+TUPLET = "tuplet"                 # e.g. (3 or (3:2:3
+SLUR = "slur"                     # ( or )
+DECORATION = "decoration"         # e.g. !trill!, +trill+ or ~
+CHORD_SYMBOL = "chord_symbol"     # e.g. "Am7/G"
+ANNOTATION = "annotation"         # quoted text to print, e.g. "^Fine"
+OTHER = "other"                   # a character that's none of those
+
+# the states a line can start in
+FREE = 0     # outside a tune: the file header, or between tunes
+HEADER = 1   # a tune's header, from X: to K:
+BODY = 2     # a tune's music
+
+_field_line = re.compile(r"[ \t]*([A-Za-z+]):")
+_blank_line = re.compile(r"[ \t\r]*$")
+_comment = re.compile(r"(?<!\\)%")
+
+# notes and bar lines are most of the music, so they're tried first
+_music = re.compile(r"""
+    (?P<note>(?:\^\^|\^|__|_|=)?[A-Ga-g][',]*\d*/*\d*)
+  | (?P<bar>\[\||:*\|[|\]]?:*|:{2,})
+  | (?P<space>[ \t\r]+|[y`\\])
+  | (?P<inline_field>\[[A-Za-z]:[^\]]*\])
+  | (?P<ending>\[\d[\d,\-]*|(?<=\|)\d[\d,\-]*)
+  | (?P<rest>[zx]\d*/*\d*)
+  | (?P<measure_rest>[ZX]\d*)
+  | (?P<chord_start>\[)
+  | (?P<chord_end>\]\d*/*\d*)
+  | (?P<grace_start>\{/?)
+  | (?P<grace_end>\})
+  | (?P<tie>-)
+  | (?P<broken_rhythm><+|>+)
+  | (?P<tuplet>\([2-9](?::\d*(?::\d*)?)?)
+  | (?P<slur>[()])
+  | (?P<annotation>"[\^_<>@][^"]*")
+  | (?P<chord_symbol>"[^"]*")
+  | (?P<decoration>![^!]*!|\+[^+\s]*\+|[.~HLMOPSTuvJR])
+  | (?P<comment>%.*)
+  | (?P<other>.)
+""", re.X)
+
+
+def _lex_line(text, start, end, state, tokens):
+    """Append the tokens of the line text[start:end] (without its
+    newline), which starts in state, to tokens, and return the state the
+    next line starts in"""
+    if _blank_line.match(text, start, end):
+        return FREE # a blank line ends a tune
+
+    if text.startswith("%", start, end):
+        tokens.append((DIRECTIVE if text.startswith("%%", start, end) else COMMENT,
+                       start, end))
+        return state
+
+    m = _field_line.match(text, start, end)
+    if m:
+        # a comment can follow the field
+        comment = _comment.search(text, m.end(), end)
+        if comment:
+            tokens.append((FIELD, start, comment.start()))
+            tokens.append((COMMENT, comment.start(), end))
+        else:
+            tokens.append((FIELD, start, end))
+
+        key = m.group(1)
+        if key == "X":
+            return HEADER
+        if key == "K":
+            return BODY
+        return state
+
+    if state != BODY:
+        tokens.append((TEXT, start, end))
+        return state
+
+    for token in _music.finditer(text, start, end):
+        kind = token.lastgroup
+        if kind != "space":
+            tokens.append((kind, token.start(), token.end()))
+    return state
+
+def lex_line(line, state=FREE):
+    """Return the tokens of a line of ABC (without its newline), which
+    starts in state, and the state the next line starts in"""
+    tokens = []
+    return tokens, _lex_line(line, 0, len(line), state, tokens)
+
+def lex(text, state=FREE):
+    """Return a list of the tokens of the ABC text; a tune's ABC starts
+    outside a tune (its X: line starts its header), but a bit of music
+    on its own, e.g. a few notes typed in, should start in BODY"""
+    tokens = []
+    start = 0
+    end = text.find("\n")
+    while end >= 0:
+        state = _lex_line(text, start, end, state, tokens)
+        start = end + 1
+        end = text.find("\n", start)
+    _lex_line(text, start, len(text), state, tokens)
+    return tokens
+
+def iter_lex(text, state=FREE):
+    """Yield the tokens of the ABC text, as lex() returns them, lexing a
+    line at a time, for readers that may not need them all"""
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        last = end < 0
+        if last:
+            end = len(text)
+
+        tokens = []
+        state = _lex_line(text, start, end, state, tokens)
+        for token in tokens:
+            yield token
+
+        if last:
+            return
+        start = end + 1
+
+def field_value(text, token):
+    """Return the key and value of a field or inline field token"""
+    kind, start, end = token
+    if kind == INLINE_FIELD:
+        return text[start + 1], text[start + 3:end - 1].strip()
+    field = text[start:end].lstrip()
+    return field[0], field[2:].strip()
+
+def body_start(text):
+    """Return where the body of the tune's ABC starts: just after the
+    line of the K: field that ends its header, or None if it hasn't one"""
+    state = FREE
+    start = 0
+    while start <= len(text):
+        end = text.find("\n", start)
+        if end < 0:
+            end = len(text)
+
+        if state != BODY and _field_line.match(text, start, end):
+            state = _lex_line(text, start, end, state, [])
+            if state == BODY:
+                return min(end + 1, len(text))
+        elif _blank_line.match(text, start, end):
+            state = FREE
+
+        start = end + 1
+    return None
+
+
+class LexedText(object):
+    """ABC text and its tokens, kept up to date through edits.  An edit
+lexes again only the lines it touches, and the lines after them up to
+the first that starts in the same state as it did before, since the rest
+can't have changed.
+
+The lines after an edit move by the same amount, so rather than change
+where each of them starts, that's kept as a shift from a line on, which
+only has to be worked into the lines between that one and the next
+edit."""
+    def __init__(self, text, state=FREE):
+        self.text = ""
+        self._starts = [0]     # where each line starts, but for the shift
+        self._states = [state] # the state each line starts in
+        self._tokens = [[]]    # each line's tokens, from its start
+        self._shift_line = 1   # the lines from this one on start _shift later
+        self._shift = 0
+        self.edit(0, 0, text)
+
+    def _move_shift(self, line):
+        """Make the shift start at the line, changing the starts of the
+        lines between"""
+        starts, shift = self._starts, self._shift
+        if shift and line > self._shift_line:
+            starts[self._shift_line:line] = [start + shift
+                                             for start in starts[self._shift_line:line]]
+        elif shift and line < self._shift_line:
+            starts[line:self._shift_line] = [start - shift
+                                             for start in starts[line:self._shift_line]]
+        self._shift_line = line
+
+    def _start(self, line):
+        """Return where a line starts"""
+        if line >= self._shift_line:
+            return self._starts[line] + self._shift
+        return self._starts[line]
+
+    def _line_end(self, line):
+        """Return where a line ends, not counting its newline"""
+        if line + 1 < len(self._starts):
+            return self._start(line + 1) - 1
+        return len(self.text)
+
+    def _line_at(self, position):
+        """Return the number of the line position is in"""
+        shift_line = self._shift_line
+        if shift_line < len(self._starts) and position >= self._start(shift_line):
+            return bisect_right(self._starts, position - self._shift, shift_line) - 1
+        return bisect_right(self._starts, position, 0, shift_line) - 1
+
+    def tokens(self):
+        """Return a list of all the tokens"""
+        self._move_shift(len(self._starts))
+
+        result = []
+        for start, tokens in zip(self._starts, self._tokens):
+            result.extend((kind, start + token_start, start + token_end)
+                          for kind, token_start, token_end in tokens)
+        return result
+
+    def line_tokens(self, line):
+        """Return the tokens of a line, by number from 0"""
+        start = self._start(line)
+        return [(kind, start + token_start, start + token_end)
+                for kind, token_start, token_end in self._tokens[line]]
+
+    def edit(self, start, end, new_text):
+        """Replace text[start:end] with new_text, and return the range of
+        lines (first, after the last) lexed again"""
+        first = self._line_at(start)
+        last = self._line_at(end)
+        self._move_shift(last + 1)
+        old_after = last + 1
+
+        change = len(new_text) - (end - start)
+        edited_end = self._line_end(last) + change
+        text = self.text = self.text[:start] + new_text + self.text[end:]
+
+        # the lines the edit touches, lexed again
+        starts, states, tokens = [], [], []
+        state = self._states[first]
+        line_start = self._starts[first]
+        while True:
+            line_end = text.find("\n", line_start, edited_end)
+            if line_end < 0:
+                line_end = edited_end
+            starts.append(line_start)
+            states.append(state)
+            tokens.append([])
+            state = _lex_line(text[line_start:line_end], 0, line_end - line_start,
+                              state, tokens[-1])
+            if line_end == edited_end:
+                break
+            line_start = line_end + 1
+
+        # and the lines after them until one starts as it did
+        while old_after < len(self._starts) and self._states[old_after] != state:
+            line_start = self._start(old_after) + change
+            if old_after + 1 < len(self._starts):
+                line_end = self._start(old_after + 1) - 1 + change
+            else:
+                line_end = len(text)
+            starts.append(line_start)
+            states.append(state)
+            tokens.append([])
+            state = _lex_line(text[line_start:line_end], 0, line_end - line_start,
+                              state, tokens[-1])
+            old_after += 1
+
+        self._starts[first:old_after] = starts
+        self._states[first:old_after] = states
+        self._tokens[first:old_after] = tokens
+        self._shift_line = first + len(starts)
+        self._shift += change
+
+        return first, first + len(starts)
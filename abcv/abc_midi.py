@@ -0,0 +1,562 @@
+# coding=utf-8
+
+"""Making MIDI of a tune in-process, rather than by starting abc2midi,
+for the ABC most tunes are written in: notes, rests, chords, ties,
+tuplets, broken rhythms, repeats and endings, and changes of key, meter,
+unit note length and tempo.  Anything else (guitar chords, voices, parts
+and most %%MIDI directives among them) raises UnsupportedAbc, so the
+caller can use abc2midi instead.  Decorations, grace notes and slurs are
+left out, and the notes under them played plainly."""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import re
+from fractions import Fraction
+
+import mido
+
+import abcv.abc_lexer as abc_lexer
+from abcv.melody import key_signature, _fraction, _semitones, _tuplet_time
+
+# MIDI ticks per quarter note, as abc2midi writes
+ticks_per_beat = 480
+_whole = 4 * ticks_per_beat
+
+# how loud notes on the first beat of a bar, on other beats and off
+# the beat are, as abc2midi plays them unless told otherwise
+_velocities = (105, 95, 80)
+
+# the tempo when a tune doesn't give one: (beat, beats a minute)
+_default_tempo = (Fraction(1, 4), 120)
+
+_middle_c = 60
+
+
+# if a tune uses ABC this doesn't play, raise this
+class UnsupportedAbc(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+_midi_program = re.compile(r"^%%MIDI\s+program\s+(\d+)\s*$")
+
+# the parts of the tokens abc_lexer makes that matter here
+_pitch = re.compile(r"(\^\^|\^|__|_|=)?([A-Ga-g])([',]*)")
+_length = re.compile(r"(\d*)(/*)(\d*)")
+_tuplet = re.compile(r"\((\d)(?::(\d*)(?::(\d*))?)?")
+
+# the kinds of token that don't change how the music's played
+_ignored = frozenset([abc_lexer.TEXT, abc_lexer.COMMENT, abc_lexer.DECORATION,
+                      abc_lexer.SLUR, abc_lexer.ANNOTATION])
+
+_alterations = {"^": 1, "^^": 2, "_": -1, "__": -2, "=": 0}
+
+# what in a K: field changes the notes in ways not played here
+_unplayable_key = re.compile(r"exp|transpose|octave|middle|(?:^|\s)[=^_]+[A-Ga-g]|^\s*H[Pp]")
+
+_meter = re.compile(r"\s*(\d+)\s*/\s*(\d+)\s*$")
+_quoted = re.compile(r'"[^"]*"')
+
+
+def _multiple(num, slashes, den):
+    """Return the length written after a note, as a multiple of the unit"""
+    length = int(num) if num else 1
+    if den:
+        return length / int(den)
+    if slashes:
+        return length / 2 ** len(slashes)
+    return length
+
+def _parse_meter(value):
+    """Return (numerator, denominator) of the M: value, or None for
+    M:none and anything else without a regular beat"""
+    value = value.strip()
+    if value == "C":
+        return 4, 4
+    if value == "C|":
+        return 2, 2
+    m = _meter.match(value)
+    if m and int(m.group(1)) and int(m.group(2)):
+        return int(m.group(1)), int(m.group(2))
+    return None
+
+def _parse_tempo(value, unit):
+    """Return (beat, beats a minute) of the Q: value, where beat is a
+    Fraction of a whole note, or None if it doesn't say; unit is the
+    unit note length, which old-style tempos like Q:120 count in"""
+    value = _quoted.sub("", value).strip()
+    if not value:
+        return None
+
+    if "=" in value:
+        beats, bpm = value.split("=", 1)
+    else:
+        beats, bpm = "", value
+
+    try:
+        beat = Fraction(0)
+        for part in beats.split():
+            beat += unit if part in ("C", "L") else Fraction(part)
+        bpm = int(bpm.strip())
+    except (ValueError, ZeroDivisionError):
+        return None
+
+    if not beat:
+        beat = unit
+    if beat <= 0 or bpm <= 0:
+        return None
+    return beat, bpm
+
+
+# what each token is, as _lex makes it, once it's been seen
+_lexed = {}
+_most_lexed = 20000
+
+def _length_after(text, position):
+    """Return the length written at text[position:], as a multiple of the
+    unit"""
+    return _multiple(*_length.match(text, position).groups())
+
+def _lex(kind, text):
+    """Return what the token of the abc_lexer kind, which says text, is
+    to compile_midi: ("note", alteration or None, letter, octave,
+    multiple of the unit), ("rest", multiple), ("measures", bars),
+    ("chord",), ("chord_end", multiple), ("tie",), ("broken", multiple
+    before, multiple after), ("tuplet", p, q or None, r), ("ending",
+    passes), ("bar", whether it ends a repeat, starts one and ends a
+    section), ("field", key, value) or None for what doesn't matter"""
+    if kind == abc_lexer.NOTE:
+        m = _pitch.match(text)
+        accidental, letter, octave = m.groups()
+        return ("note", _alterations[accidental] if accidental else None,
+                letter.upper(),
+                (1 if letter > "Z" else 0) + octave.count("'") - octave.count(","),
+                _length_after(text, m.end()))
+    if kind == abc_lexer.REST:
+        return ("rest", _length_after(text, 1))
+    if kind == abc_lexer.MEASURE_REST:
+        return ("measures", int(text[1:] or 1))
+    if kind == abc_lexer.CHORD_END:
+        return ("chord_end", _length_after(text, 1))
+    if kind == abc_lexer.BROKEN_RHYTHM:
+        factor = 0.5 ** len(text)
+        if text[0] == ">":
+            return ("broken", 2 - factor, factor)
+        return ("broken", factor, 2 - factor)
+    if kind == abc_lexer.TUPLET:
+        p, q, r = _tuplet.match(text).groups()
+        p = int(p)
+        return ("tuplet", p, int(q) if q else None, int(r or p))
+    if kind == abc_lexer.ENDING:
+        return ("ending", _ending_numbers(text))
+    if kind == abc_lexer.BAR:
+        return ("bar", text.startswith(":"), text.endswith(":"),
+                "||" in text or "]" in text or "[" in text)
+    if kind == abc_lexer.INLINE_FIELD:
+        if text[1] in "VUmP":
+            raise UnsupportedAbc("%s: fields aren't played" % text[1])
+        return ("field", text[1], text[3:-1])
+    if kind == abc_lexer.CHORD_SYMBOL:
+        if len(text) > 2:
+            raise UnsupportedAbc("chord symbols aren't played")
+        return None
+    if kind == abc_lexer.CHORD_START:
+        return ("chord",)
+    if kind == abc_lexer.TIE:
+        return ("tie",)
+    raise UnsupportedAbc("can't play %r" % text)
+
+def _tokens(abc):
+    """Return a list of the things in the tune's ABC that matter to how
+    it's played, in order, as _lex makes them, and ("program", number)
+    for %%MIDI program; the header's fields come first, with any tempo
+    after the unit note length it might be counted in"""
+    header, tempos, body = [], [], []
+    in_body = False
+    in_grace = False
+
+    for token in abc_lexer.lex(abc):
+        kind, start, end = token
+
+        if kind == abc_lexer.DIRECTIVE:
+            line = abc[start:end].strip()
+            m = _midi_program.match(line)
+            if m:
+                (body if in_body else header).append(("program", int(m.group(1))))
+            elif line.startswith("%%MIDI"):
+                raise UnsupportedAbc("%s isn't played" % line)
+            continue
+
+        if kind == abc_lexer.FIELD:
+            key, value = abc_lexer.field_value(abc, token)
+            if key in "VUm" or (key == "P" and not in_body):
+                raise UnsupportedAbc("%s: fields aren't played" % key)
+            if key == "Q" and not in_body:
+                tempos.append(("field", key, value))
+            elif key in "KMLQ":
+                (body if in_body else header).append(("field", key, value))
+            if key == "K":
+                in_body = True
+            continue
+
+        # grace notes aren't played
+        if in_grace:
+            in_grace = kind != abc_lexer.GRACE_END
+            continue
+        if kind == abc_lexer.GRACE_START:
+            in_grace = True
+            continue
+
+        if kind in _ignored:
+            continue
+
+        text = abc[start:end]
+        try:
+            lexed = _lexed[kind, text]
+        except KeyError:
+            if len(_lexed) > _most_lexed:
+                _lexed.clear()
+            lexed = _lexed[kind, text] = _lex(kind, text)
+        if lexed is not None:
+            body.append(lexed)
+
+    if not in_body:
+        raise UnsupportedAbc("no K: field")
+
+    # the K: field ends the header
+    return header[:-1] + tempos + header[-1:] + body
+
+def _passes(tokens, position):
+    """Return how many times the repeat ending at tokens[position] is
+    played: the highest ending number up to the next section, or 2"""
+    passes = 2
+    for token in tokens[position + 1:]:
+        if token[0] == "ending":
+            passes = max([passes] + list(token[1]))
+        elif token[0] == "bar" and (token[1] or token[2] or token[3]):
+            break
+    return passes
+
+def _ending_numbers(text):
+    """Return the set of passes the ending marked text (e.g. "[1,3" or
+    "2-3") is played on"""
+    numbers = set()
+    for part in text.lstrip("[").split(","):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            if first and last:
+                numbers.update(range(int(first), int(last) + 1))
+        elif part:
+            numbers.add(int(part))
+    return frozenset(numbers)
+
+
+def compile_midi(abc, midi_program=None):
+    """Return a mido.MidiFile of the tune's ABC, played with the MIDI
+    program midi_program (the number abc2midi would be given) if it's
+    given; raises UnsupportedAbc if the tune uses ABC this doesn't play"""
+    tokens = _tokens(abc)
+
+    notes = []     # [start, end, key, velocity] of each note, in ticks
+    tempo = []     # (tick, message) for the tempo track
+    programs = []  # (tick, program)
+    if midi_program is not None:
+        programs.append((0, midi_program))
+
+    unit = None        # as a Fraction of a whole note
+    unit_ticks = None
+    meter = None
+    beat = None        # in ticks
+    signature = {}
+    accidentals = {}   # (letter, octave) -> alteration, 'til the bar line
+
+    now = 0.0
+    bar_position = 0.0
+    last = None        # (length, note indexes, [((letter, octave), alteration)])
+    ties = {}          # key -> index of a note tied to the next
+    tied_letters = {}  # (letter, octave) -> alteration of a note tied to the next
+    broken = None      # what the next note's length is multiplied by
+    tuplet_left, tuplet_factor = 0, 1.0
+    chord = None       # [keys, letters, length] in a chord
+
+    section_start = 0
+    repeat = 1
+    skipping = False
+
+    steps = 0
+    i = 0
+    while i < len(tokens):
+        # a guard against repeats that never end
+        steps += 1
+        if steps > 100 * len(tokens):
+            raise UnsupportedAbc("repeats don't end")
+
+        token = tokens[i]
+        kind = token[0]
+        i += 1
+
+        if skipping:
+            # an ending that isn't for this time through goes on until
+            # the next ending, repeat or section
+            if kind == "ending":
+                skipping = False
+            elif kind == "bar":
+                _, repeat_end, repeat_start, section = token
+                if repeat_end:
+                    skipping = False
+                    accidentals = {}
+                    bar_position = 0.0
+                    if repeat_start:
+                        section_start, repeat = i, 1
+                    continue
+                if repeat_start or section:
+                    skipping = False
+            if skipping:
+                continue
+
+        if kind == "note":
+            _, alteration, letter, octave, multiple = token
+            if alteration is not None:
+                accidentals[letter, octave] = alteration
+            elif (letter, octave) in accidentals:
+                alteration = accidentals[letter, octave]
+            elif (letter, octave) in tied_letters:
+                alteration = tied_letters[letter, octave]
+            else:
+                alteration = signature.get(letter, 0)
+
+            key = _middle_c + _semitones[letter] + alteration + 12 * octave
+            if not 0 <= key < 128:
+                raise UnsupportedAbc("note out of range")
+            length = unit_ticks * multiple
+
+            if chord is not None:
+                chord[0].append(key)
+                chord[1].append(((letter, octave), alteration))
+                if chord[2] is None:
+                    chord[2] = length
+                continue
+
+            keys, letters = (key,), (((letter, octave), alteration),)
+
+        elif kind == "bar":
+            accidentals = {}
+            bar_position = 0.0
+
+            _, repeat_end, repeat_start, section = token
+            if repeat_end:
+                if repeat < _passes(tokens, i - 1):
+                    # back to the start of the section, for another time
+                    # through
+                    repeat += 1
+                    i = section_start
+                    last, broken, ties, tied_letters = None, None, {}, {}
+                    tuplet_left = 0
+                    continue
+                section_start, repeat = i, 1
+            elif repeat_start or section:
+                # a new section, or the end of the last ending of one,
+                # which is as far as a pass after the first gets
+                section_start, repeat = i, 1
+            continue
+
+        elif kind == "rest":
+            keys, letters = (), ()
+            length = unit_ticks * token[1]
+
+        elif kind == "broken":
+            if last is not None:
+                length, indexes, letters = last
+                change = length * (token[1] - 1)
+                for index in indexes:
+                    notes[index][1] += change
+                now += change
+                bar_position += change
+                last = (length + change, indexes, letters)
+                broken = token[2]
+            continue
+
+        elif kind == "tie":
+            if last is not None:
+                ties = dict((notes[index][2], index) for index in last[1])
+                tied_letters = dict(last[2])
+            continue
+
+        elif kind == "chord":
+            chord = [[], [], None]
+            continue
+
+        elif kind == "chord_end":
+            if chord is None:
+                raise UnsupportedAbc("] outside a chord")
+            keys, letters, length = chord
+            chord = None
+            if length is None:
+                continue # an empty chord
+            length *= token[1]
+
+        elif kind == "tuplet":
+            _, p, q, tuplet_left = token
+            if q is None:
+                if p in (5, 7, 9) and beat and beat != _whole / meter[1]:
+                    q = 3 # compound meter
+                else:
+                    q = _tuplet_time.get(p, 2)
+            tuplet_factor = q / p
+            continue
+
+        elif kind == "measures":
+            if meter is None:
+                raise UnsupportedAbc("multiple bar rests without a meter")
+            keys, letters = (), ()
+            length = token[1] * _whole * meter[0] / meter[1]
+
+        elif kind == "ending":
+            if repeat not in token[1]:
+                skipping = True
+            continue
+
+        elif kind == "program":
+            # midi_program takes the place of the tune's own at the
+            # start, as the directive abc2midi is given would
+            if midi_program is None or now > 0:
+                programs.append((now, token[1]))
+            continue
+
+        elif kind == "field":
+            _, key, value = token
+            if key == "K":
+                if _unplayable_key.search(value):
+                    raise UnsupportedAbc("K:%s isn't played" % value)
+                signature = key_signature(value)
+                if unit is None:
+                    unit = Fraction(1, 16) if meter and Fraction(*meter) < Fraction(3, 4) \
+                        else Fraction(1, 8)
+                    unit_ticks = float(unit) * _whole
+            elif key == "M":
+                meter = _parse_meter(value)
+                if meter is None:
+                    beat = None
+                else:
+                    numerator, denominator = meter
+                    if numerator % 3 == 0 and numerator > 3 and denominator == 8:
+                        beat = 3 * _whole / denominator
+                    else:
+                        beat = _whole / denominator
+                    if denominator & (denominator - 1) == 0:
+                        tempo.append((now, mido.MetaMessage("time_signature",
+                                                            numerator=numerator,
+                                                            denominator=denominator)))
+            elif key == "L":
+                unit = _fraction(value, unit)
+                if unit is not None:
+                    unit_ticks = float(unit) * _whole
+            elif key == "Q":
+                beats = _parse_tempo(value, unit or Fraction(1, 8))
+                if beats:
+                    tempo.append((now, _tempo_message(*beats)))
+            continue
+
+        else:
+            continue
+
+        # a note, chord or rest, played from now for length ticks
+        if tuplet_left:
+            length *= tuplet_factor
+            tuplet_left -= 1
+        if broken is not None:
+            length *= broken
+            broken = None
+
+        if bar_position < 0.5:
+            velocity = _velocities[0]
+        elif beat and abs(bar_position / beat - round(bar_position / beat)) < 1e-6:
+            velocity = _velocities[1]
+        else:
+            velocity = _velocities[2]
+
+        indexes = []
+        for key in keys:
+            index = ties.get(key)
+            if index is None:
+                indexes.append(len(notes))
+                notes.append([now, now + length, key, velocity])
+            else:
+                notes[index][1] = now + length
+                indexes.append(index)
+
+        last = (length, indexes, letters)
+        if ties:
+            ties, tied_letters = {}, {}
+        now += length
+        bar_position += length
+
+    return _midi_file(notes, tempo, programs)
+
+
+def _tempo_message(beat, bpm):
+    """Return a set_tempo message for bpm beats (Fractions of a whole
+    note) a minute"""
+    return mido.MetaMessage("set_tempo",
+                            tempo=int(round(60000000 / (bpm * float(beat) * 4))))
+
+# note messages made before, copied for use again; making a message
+# checks all its values, which takes longer than the rest of playing the
+# note, while copying one doesn't.  They're copied so no MidiFile shares
+# a message with another, which could change it.
+_messages = {}
+_most_messages = 20000
+
+def _message(type, key, velocity, time):
+    try:
+        message = _messages[type, key, velocity, time]
+    except KeyError:
+        if len(_messages) > _most_messages:
+            _messages.clear()
+        message = _messages[type, key, velocity, time] = \
+            mido.Message(type, note=key, velocity=velocity, time=time)
+    return message.copy()
+
+def _midi_file(notes, tempo, programs):
+    """Return a MidiFile of a tempo track and a track of the notes, each
+    [start, end, key, velocity] in ticks, the program changes, each
+    (tick, program), and the tempo track's (tick, message)s"""
+    midi = mido.MidiFile(type=1, ticks_per_beat=ticks_per_beat)
+
+    # a tempo to start with, unless the tune gives one
+    if not any(message.type == "set_tempo" and tick == 0 for tick, message in tempo):
+        tempo.insert(0, (0, _tempo_message(*_default_tempo)))
+
+    track = mido.MidiTrack()
+    previous = 0
+    for tick, message in tempo:
+        tick = int(round(tick))
+        track.append(message.copy(time=tick - previous))
+        previous = tick
+    track.append(mido.MetaMessage("end_of_track", time=0))
+    midi.tracks.append(track)
+
+    # note offs sort before program changes and those before note ons
+    # at the same tick, so a note repeated straight after itself is
+    # heard again, and in the new program if it changes there
+    events = [(int(round(tick)), 1, "program_change", program, 0)
+              for tick, program in programs]
+    for start, end, key, velocity in notes:
+        start, end = int(round(start)), int(round(end))
+        if end > start:
+            events.append((start, 2, "note_on", key, velocity))
+            events.append((end, 0, "note_off", key, 0))
+    events.sort()
+
+    track = mido.MidiTrack()
+    previous = 0
+    for tick, _, type, value, velocity in events:
+        if type == "program_change":
+            track.append(mido.Message(type, program=value & 0x7f, time=tick - previous))
+        else:
+            track.append(_message(type, value, velocity, tick - previous))
+        previous = tick
+    track.append(mido.MetaMessage("end_of_track", time=0))
+    midi.tracks.append(track)
+
+    return midi
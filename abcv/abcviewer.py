@@ -3,8 +3,7 @@
 # be futuristic!  That is, basically use Python 3.
 from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
 
-import os, platform, sys, tempfile, codecs
-from uuid import uuid4
+import os, platform, sys, codecs
 import webbrowser as wb
 
 from PyQt5.QtCore import *
@@ -12,7 +11,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtPrintSupport import *
 
-from abcv.tunebook import AbcTune, AbcTunebook, information_fields
+from abcv.tunebook import AbcTune, AbcTunebook, information_fields, artifact_cache
 from abcv.scrollable_svg import fits
 
 # TODO: change this back to abcv.abc_display when fixed
@@ -23,9 +22,20 @@ from abcv.filter_dialog import FilterDialog
 from abcv.settings_dialog import SettingsDialog, ToolSettingsDialog
 from abcv.about import about_text
 from abcv.midi_mixin import MidiMixin
+from abcv.gui_jobs import scheduler
+from abcv.prefetch import Prefetcher
+from abcv.jobs import PRIORITY_PREFETCH, PRIORITY_BATCH, PRIORITY_IDLE
+from abcv.title_search import TitleSearch
+from abcv.export import TunebookExport, ExportCancelled
 import abcv.tools as tools
 
-ps_to_pdf_cmd = '%s -o %s -sDEVICE=pdfwrite -dPDFSETTINGS=/prepress -dHaveTrueTypes=true -dEmbedAllFonts=true -dSubsetFonts=false -c ".setpdfwrite <</NeverEmbed [ ]>> setdistillerparams" -f %s'
+# how long the title search waits for a pause in the typing, for
+# tunebooks big enough that searching on every keystroke would lag
+title_search_delay = 150 # ms
+title_search_delay_above = 5000 # titles
+
+# how many tunes the related tunes panel shows
+related_count = 10
 
 class TuneListItem(QListWidgetItem):
     """A QListItem that can carry a tune"""
@@ -33,6 +43,17 @@ class TuneListItem(QListWidgetItem):
         QListWidgetItem.__init__(self, tune.title)
         self.tune = tune
 
+        # whether the filter (as opposed to the title search) hides it
+        self.filtered_out = False
+
+class RelatedTuneItem(QListWidgetItem):
+    """A QListItem for a tune in the related tunes panel, with how like
+    the current tune it is"""
+    def __init__(self, tune, similarity):
+        QListWidgetItem.__init__(self, "%s (%d%%)" % (tune.title,
+                                                     round(max(0, similarity) * 100)))
+        self.tune = tune
+
 def show_tune_info(tune, parent=None):
     """Show a dialog box with the information fields of an ABC tune"""
     
@@ -70,6 +91,9 @@ class Application(QMainWindow, MidiMixin):
 
         # to the extent that there is a file, it starts unchanged
         self._dirty = False
+
+        # the tunebook open, once there is one
+        self.abc_file = None
         
         self.settings = settings
 
@@ -99,6 +123,21 @@ class Application(QMainWindow, MidiMixin):
 
         self.title_vbox.addWidget(self.title_filter_btn, stretch=0)
 
+        # narrows the title list as the user types
+        self.title_search_edit = QLineEdit()
+        self.title_search_edit.setPlaceholderText("Search titles")
+        self.title_search_edit.setClearButtonEnabled(True)
+        self.title_search_edit.textChanged.connect(self._on_title_search_change)
+
+        self.title_vbox.addWidget(self.title_search_edit, stretch=0)
+
+        self._title_search_timer = QTimer(self)
+        self._title_search_timer.setSingleShot(True)
+        self._title_search_timer.timeout.connect(self._search_titles)
+
+        self.title_search = TitleSearch([])
+        self._title_matches = set() # rows of the titles it shows
+
         # the list of tune titles
         self.title_list = QListWidget()
         self.title_list.currentItemChanged.connect(self._on_index_change)
@@ -172,8 +211,26 @@ class Application(QMainWindow, MidiMixin):
 
         # viewer vbox stretches horizontally to fill remaining space
         self.tunebook_hbox.addLayout(self.viewer_vbox, stretch=1.0)
+
+        # the tunes with melodies most like the current one's, in a
+        # panel that can be hidden from the View menu
+        self.related_list = QListWidget()
+        self.related_list.itemActivated.connect(self._on_related_activated)
+
+        self.related_dock = QDockWidget("Related tunes", self)
+        self.related_dock.setWidget(self.related_list)
+        self.related_dock.visibilityChanged.connect(self._show_related)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.related_dock)
+
+        self.view_related = self.related_dock.toggleViewAction()
+        self.view_menu.addAction(self.view_related)
+
+        # the tunebook whose related index is built; 'til then, the
+        # panel stays empty rather than tie up a worker waiting
+        self._related_ready = None
         
-        self.tmp_svg = None
+        # renders the tunes around the current one in the background
+        self.prefetcher = Prefetcher(scheduler())
 
         # if a filename was passed in, load it
         if filename:
@@ -257,6 +314,8 @@ class Application(QMainWindow, MidiMixin):
         self.tunebook_export_pdf = addAction(self.tunebook_export_menu, "As P&DF", "", self._export_pdf)
         self.tunebook_export_ps = addAction(self.tunebook_export_menu, "As Po&stscript", "", self._export_ps)
         
+        self.tunebook_transpose = addAction(self.tunebook_menu, "&Transpose tunes shown…", "", self._transpose_tunebook)
+
         self.tunebook_move_up = addAction(self.tunebook_menu, "Move tune &up", "Ctrl+Up", self._move_tune_up)
         self.tunebook_move_down = addAction(self.tunebook_menu, "Move tune &down", "Ctrl+Down", self._move_tune_down)
         
@@ -266,6 +325,7 @@ class Application(QMainWindow, MidiMixin):
         self.view_fit_width = addAction(self.view_fit_menu, "Width", "", self._fit_width)
         self.view_fit_height = addAction(self.view_fit_menu, "Height", "", self._fit_height)
         self.view_fit_all = addAction(self.view_fit_menu, "All", "", self._fit_all)
+        self.view_search_titles = addAction(self.view_menu, "&Search titles", "Ctrl+F", self._focus_title_search)
 
         # tune menu choices
         self.tune_transpose = addAction(self.tune_menu, "Tra&nspose…", "", self._transpose)
@@ -348,13 +408,31 @@ class Application(QMainWindow, MidiMixin):
         if accept:
             self._load(filename)
 
-    def _load(self, filename):
+    def _load(self, filename, encoding=None):
         """Load a new ABC file"""
 
         # store the directory to start there next time
         self.settings.set("Open directory", os.path.dirname(filename))
 
-        self.abc_file = AbcTunebook(filename)
+        self._close_tunebook()
+        self.abc_file = AbcTunebook(filename, encoding)
+
+        # build the search indexes in the background, ready for
+        # filtering, then bring the sidecar up to date so next time
+        # there's no index to build; an export started meanwhile
+        # doesn't wait for them
+        scheduler().submit(self.abc_file.search_index,
+                           priority=PRIORITY_IDLE)
+        scheduler().submit(self.abc_file.title_index,
+                           priority=PRIORITY_IDLE)
+        scheduler().submit(self.abc_file.incipit_index,
+                           priority=PRIORITY_IDLE)
+        scheduler().submit(self.abc_file.related_index,
+                           priority=PRIORITY_IDLE,
+                           on_done=lambda index, tunebook=self.abc_file:
+                           self._related_index_ready(tunebook))
+        scheduler().submit(self.abc_file.update_sidecar,
+                           priority=PRIORITY_IDLE)
 
         self._refresh_title_list()
 
@@ -371,6 +449,44 @@ class Application(QMainWindow, MidiMixin):
         for tune in self.abc_file:
             self.title_list.addItem(TuneListItem(tune))
 
+        self._reset_title_search()
+
+    def _reset_title_search(self):
+        """Start the title search over with the titles in the list"""
+        self.title_search = TitleSearch([self.title_list.item(i).text()
+                                         for i in range(self.title_list.count())])
+        self._title_matches = set(range(self.title_list.count()))
+
+        if self.title_search_edit.text():
+            self._search_titles()
+
+    def _on_title_search_change(self, text):
+        # searching a big tunebook on every keystroke would make typing
+        # lag, so that waits for a pause
+        if self.title_list.count() > title_search_delay_above:
+            self._title_search_timer.start(title_search_delay)
+        else:
+            self._title_search_timer.start(0)
+
+    def _search_titles(self):
+        """Hide the titles that don't match the title search, touching
+        only the items whose match has changed"""
+        matches = set(self.title_search.search(self.title_search_edit.text()))
+
+        self.title_list.setUpdatesEnabled(False)
+        for row in self._title_matches - matches:
+            self.title_list.item(row).setHidden(True)
+        for row in matches - self._title_matches:
+            item = self.title_list.item(row)
+            item.setHidden(item.filtered_out)
+        self.title_list.setUpdatesEnabled(True)
+
+        self._title_matches = matches
+
+    def _focus_title_search(self, *args, **kwargs):
+        self.title_search_edit.setFocus()
+        self.title_search_edit.selectAll()
+
     def _select_tune_title(self, tune):
         for i in range(self.title_list.count()):
             if self.title_list.item(i).tune == tune:
@@ -383,16 +499,25 @@ class Application(QMainWindow, MidiMixin):
         if not self._confirm_discard_changes():
             return
 
+        self._close_tunebook()
         self.abc_file = AbcTunebook()
         self.title_list.clear()
+        self._reset_title_search()
         self.abc_display.clear()
+        self.related_list.clear()
+        self._related_ready = None
         self.dirty = False
 
+    def _close_tunebook(self):
+        """Let go of the tunebook open, if any, and its sidecar"""
+        if self.abc_file is not None:
+            self.abc_file.close()
+
     def _revert_tunebook(self, *args, **kwargs):
         """Reload the tunebook from its original file"""
 
         if self._confirm_discard_changes():
-            self._load(self.abc_file.filename)
+            self._load(self.abc_file.filename, self.abc_file.encoding)
         
 
     def _save_tunebook(self, *args, **kwargs):
@@ -425,37 +550,99 @@ class Application(QMainWindow, MidiMixin):
         self.abc_file.write(filename)
         self.dirty = False
 
-    def _on_index_change(self, current, previous):
-        # try to delete the last temp SVG file
-        if self.tmp_svg:
-            try:
-                os.unlink(self.tmp_svg)
-            except:
-                pass # oh well
+        scheduler().submit(self.abc_file.update_sidecar,
+                           priority=PRIORITY_IDLE)
 
+    def _on_index_change(self, current, previous):
         # if you've changed to a tune, show it
         if current:
             self._current_tune = current.tune
             self.display_current_tune()
 
+            # and get its neighbours ready
+            distance = self.settings.get("Prefetch distance")
+            if distance is None:
+                distance = 2
+            self.prefetcher.prefetch(
+                self._visible_neighbours(self.title_list.row(current),
+                                         distance),
+                self.settings.get("MIDI instrument"))
+
+    def _visible_neighbours(self, row, distance):
+        """Return the tunes of the distance nearest unfiltered titles on
+        each side of row, nearest first"""
+
+        def visible(rows):
+            tunes = []
+            for i in rows:
+                if len(tunes) == distance:
+                    break
+                item = self.title_list.item(i)
+                if not item.isHidden():
+                    tunes.append(item.tune)
+            return tunes
+
+        after = visible(range(row + 1, self.title_list.count()))
+        before = visible(range(row - 1, -1, -1))
+
+        tunes = []
+        for i in range(distance):
+            tunes.extend(after[i:i + 1] + before[i:i + 1])
+        return tunes
+
     def display_current_tune(self):
         """Show the current tune"""
 
         self.abc_display.tune = self._current_tune
-        tempdir = tempfile.gettempdir()
-        
-        # export the tune as MIDI to get ready to play it
-        self.tmp_midi = os.path.join(tempdir, "%s.mid" % uuid4())
-        self._current_tune.write_midi(
-            self.tmp_midi,
-            midi_program=self.settings.get("MIDI instrument"))
         
         # if you're still playing the previous tune, stop that
         if self.midi.playing:
             self.midi.stop()
 
-        # prepare the mixer to play the new MIDI file
-        if os.path.exists(self.tmp_midi):
+        # get MIDI of the tune (made in-process, or from the cache if
+        # it needs abc2midi and has been played before) in the
+        # background to get ready to play it
+        scheduler().submit(self._current_tune.midi,
+                           (self.settings.get("MIDI instrument"),),
+                           key="current midi",
+                           on_done=self._midi_ready)
+
+        self._show_related()
+
+    def _related_index_ready(self, tunebook):
+        self._related_ready = tunebook
+        self._show_related()
+
+    def _show_related(self, *args, **kwargs):
+        """Fill the related tunes panel with the tunes most like the
+        current one, looked up in the background"""
+        self.related_list.clear()
+
+        tune, tunebook = self._current_tune, self.abc_file
+        if tune is None or tunebook is not self._related_ready or \
+           not self.related_dock.isVisible():
+            return
+
+        def show(related):
+            # unless the user's moved on since
+            if tune is self._current_tune and tunebook is self.abc_file:
+                self.related_list.clear()
+                for similarity, other in related:
+                    self.related_list.addItem(RelatedTuneItem(other, similarity))
+
+        scheduler().submit(tunebook.related_tunes, (tune, related_count),
+                           priority=PRIORITY_PREFETCH,
+                           key="related tunes",
+                           on_done=show)
+
+    def _on_related_activated(self, item):
+        if item.tune in self.abc_file:
+            self._select_tune_title(item.tune)
+
+    def _midi_ready(self, midi):
+        """Prepare the mixer to play the new MIDI"""
+        self.tmp_midi = midi
+        if self.tmp_midi is not None:
             self.load_midi(self.tmp_midi)
         
     def _print(self, *args, **kwargs):
@@ -484,9 +671,48 @@ class Application(QMainWindow, MidiMixin):
                                                 max=12)
 
         if accept:
-            self._current_tune.transpose(steps)
-            self.display_current_tune()
-            self.dirty = True
+            tune = self._current_tune
+
+            def transposed(abc):
+                tune.update_from_abc(abc)
+                self.abc_file.tune_changed(tune)
+                if tune is self._current_tune:
+                    self.display_current_tune()
+                self.dirty = True
+
+            scheduler().submit(tune.transposed_abc, (steps,),
+                               on_done=transposed)
+
+    def _transpose_tunebook(self, *args, **kwargs):
+        """Transpose all the tunes in the list that aren't filtered out,
+        e.g. to re-key a tunebook for another instrument"""
+        steps, accept = QInputDialog.getInt(self,
+                                            "Transpose Tunes Shown",
+                                            "Semitones",
+                                            value=0,
+                                            min=-12,
+                                            max=12)
+
+        if accept and steps:
+            tunes = [self.title_list.item(row).tune
+                     for row in range(self.title_list.count())
+                     if not self.title_list.item(row).isHidden()]
+
+            tunebook = self.abc_file
+
+            # the new ABC is worked out in the background, but the tunes
+            # are only changed here, on the GUI thread
+            def transposed(changes):
+                if tunebook is not self.abc_file:
+                    return # another tunebook's been opened since
+                changed = tunebook.replace_abc(changes)
+                if self._current_tune in changed:
+                    self.display_current_tune()
+                if changed:
+                    self.dirty = True
+
+            scheduler().submit(tunebook.transposed, (steps, tunes),
+                               on_done=transposed)
 
     def _add_tune_to_tunebook(self, *args, **kwargs):
         """Prompt for a tunebook file to add tune to"""
@@ -532,6 +758,11 @@ class Application(QMainWindow, MidiMixin):
             self.display_current_tune()
             self.dirty = True
 
+        # the live preview changes the tune's text even if the edit is
+        # cancelled
+        self.abc_file.tune_changed(self._current_tune)
+        self._show_related()
+
     def _delete_tune(self, *args, **kwargs):
 
         if self._confirm("Delete Tune", "Really delete %s?" % self._current_tune.title):
@@ -559,6 +790,11 @@ class Application(QMainWindow, MidiMixin):
             item = TuneListItem(tune)
             self.title_list.addItem(item)
             self.title_list.setCurrentItem(item)
+
+            # it's shown even if it doesn't match the title search, until
+            # the search changes
+            self.title_search.add(tune.title)
+            self._title_matches.add(self.title_list.row(item))
             self.display_current_tune()
             self.dirty = True
 
@@ -603,13 +839,20 @@ class Application(QMainWindow, MidiMixin):
         if accepted:
 
             filter = dlg.filter
-            filter.apply(self.title_list)
-                    
+            filter.apply(self.title_list, self.abc_file)
+
+            # the title search still hides what it hid
+            for i in range(self.title_list.count()):
+                item = self.title_list.item(i)
+                item.filtered_out = item.isHidden()
+                if i not in self._title_matches:
+                    item.setHidden(True)
 
     def _clear_filter(self, *args, **kwargs):
         for i in range(self.title_list.count()):
             item = self.title_list.item(i)
-            item.setHidden(False)
+            item.filtered_out = False
+            item.setHidden(i not in self._title_matches)
 
     def _app_settings(self, *args, **kwargs):
         dlg = SettingsDialog(self.settings)
@@ -683,27 +926,51 @@ class Application(QMainWindow, MidiMixin):
         return accept, filename
     
     def _export_pdf(self, *args, **kwargs):
-        accept, filename = self._prompt_export("pdf")
-        
-        tmp_fn = str(uuid4()) + ".ps"
-        
-        if accept:
-            cmd = """%s -O "%s" "%s" """ % (self.settings.get("abcm2ps location"),
-                                            tmp_fn,
-                                            self.abc_file.filename)
-        
-            os.system(cmd)
-            cmd = ps_to_pdf_cmd % (self.settings.get("gs location"),
-                                       filename,
-                                       tmp_fn)
-            os.system(cmd)
-            os.system("""rm "%s" """ % tmp_fn)
+        self._export("pdf")
 
     def _export_ps(self, *args, **kwargs):
-        accept, filename = self._prompt_export("ps")
-        cmd = """%s -O "%s" "%s" """ % (self.settings.get("abcm2ps location"),
-                                        filename,
-                                        self.abc_file.filename)
+        self._export("ps")
+
+    def _export(self, format):
+        """Prompt for a file and export the tunebook to it in the
+        background, showing how far along it is"""
+        accept, filename = self._prompt_export(format)
+        
         if accept:
-            os.system(cmd)
-            
+            # the tunes as they are now, edits and all; whatever was
+            # typeset for the last export and hasn't changed is reused
+            export = TunebookExport(list(self.abc_file),
+                                    filename,
+                                    format,
+                                    self.settings.get("abcm2ps location"),
+                                    self.settings.get("gs location"),
+                                    cache=artifact_cache("export"),
+                                    header=self.abc_file.header)
+
+            progress = QProgressDialog("Exporting %s…" % os.path.basename(filename),
+                                       "Cancel", 0, export.total, self)
+            progress.setWindowTitle("Export Tunebook")
+            progress.setMinimumDuration(500)
+            progress.canceled.connect(export.cancel)
+
+            # the export just counts what it's done, on a worker thread;
+            # the dialog looks every so often
+            timer = QTimer(progress)
+            timer.timeout.connect(lambda: progress.setValue(export.done))
+            timer.start(100)
+
+            def finished(result):
+                timer.stop()
+                progress.close()
+
+            def failed(exc_info):
+                finished(None)
+                if not isinstance(exc_info[1], ExportCancelled):
+                    QMessageBox.warning(self, "Export Tunebook",
+                                        "The tunebook couldn't be exported.\n\n%s"
+                                        % exc_info[1])
+
+            scheduler().submit(export.run,
+                               priority=PRIORITY_BATCH,
+                               on_done=finished,
+                               on_error=failed)
@@ -0,0 +1,289 @@
+# coding=utf-8
+
+"""Rendering whole tunebooks without the GUI, e.g. for a publishing
+pipeline.  Run as
+
+    abcenatrix render book.abc --formats svg,png,midi --jobs 8 --out dir/
+
+(or python -m abcv.batch with the same arguments).  Each tune is
+rendered by a pool of processes, through the same render cache as the
+GUI, and how long each took (or why it failed) is reported.  The SVG
+pages of each group of tunes a process is given come from one run of
+abcm2ps.  Nothing
+here imports Qt."""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import multiprocessing
+
+import abcv.tunebook as tunebook
+from abcv.tunebook import AbcTunebook, tune_from_abc, artifact_cache, svg_pages_batch, svg_batch_tunes
+import abcv.tools as tools
+
+formats = ["svg", "png", "midi"]
+
+# the tools each format needs, and those it can do without; MIDI is
+# made in-process, as in the viewer, and only ABC that can't be goes
+# through abc2midi
+_format_tools = {"svg": ["abcm2ps"],
+                 "png": ["abcm2ps", "gs"],
+                 "midi": []}
+_optional_tools = {"midi": ["abc2midi"]}
+
+_not_slug = re.compile(r"[^a-z0-9]+")
+
+def _slug(title):
+    """Return a filename-friendly version of a title"""
+    return _not_slug.sub("-", title.lower()).strip("-")[:40] or "untitled"
+
+def _page_names(stem, extension, count):
+    """Return the filenames for count pages of a tune"""
+    if count == 1:
+        return ["%s.%s" % (stem, extension)]
+    return ["%s-%d.%s" % (stem, page, extension)
+            for page in range(1, count + 1)]
+
+
+# if a tune won't render, raise this
+class RenderError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def render_tune(abc, stem, out_dir, formats, midi_program=None, resolution=150,
+                svg_pages=None):
+    """Render the tune abc to files named after stem in out_dir in each
+    of the formats, returning a list of the files written; raises
+    RenderError if a format couldn't be made.  svg_pages, if given, are
+    the tune's SVG pages, already rendered."""
+    tune = tune_from_abc(abc)
+    written = []
+
+    for format in formats:
+        if format == "svg":
+            pages = svg_pages if svg_pages is not None else tune.svg_pages()
+            names = _page_names(stem, "svg", len(pages))
+            for name, page in zip(names, pages):
+                with open(os.path.join(out_dir, name), "wb") as f:
+                    f.write(page)
+        elif format == "png":
+            pages = tune.png_pages(resolution)
+            names = _page_names(stem, "png", len(pages))
+            for name, page in zip(names, pages):
+                shutil.copyfile(page, os.path.join(out_dir, name))
+        elif format == "midi":
+            midi = tune.midi(midi_program)
+            names = [stem + ".mid"] if midi is not None else []
+            if midi is not None:
+                midi.save(os.path.join(out_dir, names[0]))
+
+        if not names:
+            raise RenderError("no %s made" % format.upper())
+        written.extend(names)
+
+    return written
+
+def _cache_hits():
+    return sum(artifact_cache(kind).hits for kind in ["svg", "png", "midi"])
+
+def _cache_misses():
+    return sum(artifact_cache(kind).misses for kind in ["svg", "png", "midi"])
+
+def _render_job(args):
+    """Render a group of tunes in a worker process, returning a list of
+    (position, seconds, files written, whether it all came from the
+    cache, error message or None) for each"""
+    group, out_dir, formats, midi_program, resolution = args
+
+    # the SVG pages of the whole group at once, with each tune taking
+    # its share of the time
+    svg_pages = [None] * len(group)
+    svg_seconds = 0.0
+    svg_cached = True
+    if "svg" in formats:
+        start = time.time()
+        hits = _cache_hits()
+        try:
+            svg_pages = svg_pages_batch(tune_from_abc(abc) for _, abc, _ in group)
+        except Exception:
+            pass # each tune tries again by itself, and says what's wrong
+        svg_cached = _cache_hits() - hits == len(group)
+        svg_seconds = (time.time() - start) / len(group)
+
+    results = []
+    for (position, abc, stem), pages in zip(group, svg_pages):
+        start = time.time()
+        hits, misses = _cache_hits(), _cache_misses()
+        try:
+            written = render_tune(abc, stem, out_dir, formats, midi_program, resolution,
+                                  pages)
+            error = None
+        except RenderError as e:
+            written, error = [], str(e)
+        except Exception as e:
+            written, error = [], "%s: %s" % (type(e).__name__, e)
+
+        # a tune came from the cache if each of its formats other than
+        # SVG was found there and nothing had to be rendered; MIDI made
+        # in-process never is
+        others = len(formats) - (1 if "svg" in formats else 0)
+        cached = svg_cached and _cache_misses() == misses and \
+            _cache_hits() - hits >= others
+        results.append((position, time.time() - start + svg_seconds,
+                        written, cached, error))
+
+    return results
+
+
+def render(filename, out_dir, formats=formats, jobs=None, midi_program=None,
+           resolution=150, report=None, locations=None):
+    """Render every tune of the tunebook filename into out_dir in each of
+    the formats, on a pool of jobs processes (one per CPU by default),
+    returning a list of (position, tune, seconds, files written, whether
+    it came from the cache, error message or None) in the tunebook's
+    order.  report, if given, is called with each of those as soon as
+    it's done; locations are tool locations to use, as _find_tools finds
+    them."""
+    book = AbcTunebook(filename)
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    width = len(str(len(book)))
+    tunes = [(position, tune.text(),
+              "%0*d-%s" % (width, position + 1, _slug(tune.title)))
+             for position, tune in enumerate(book)]
+
+    # groups small enough to keep every process busy, but no bigger
+    # than one run of abcm2ps takes
+    jobs = jobs or multiprocessing.cpu_count()
+    size = max(1, min(svg_batch_tunes, len(tunes) // (4 * jobs)))
+    work = [(tunes[start:start + size], out_dir, formats, midi_program, resolution)
+            for start in range(0, len(tunes), size)]
+
+    results = []
+    pool = multiprocessing.Pool(jobs, _use_locations, (locations or {},))
+    try:
+        for group in pool.imap_unordered(_render_job, work):
+            for position, seconds, written, cached, error in group:
+                result = (position, book[position], seconds, written, cached, error)
+                results.append(result)
+                if report:
+                    report(*result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return sorted(results, key=lambda result: result[0])
+
+
+class _RunSettings(object):
+    """The user's settings, with tool locations found for one run put
+in front of them without being saved"""
+    def __init__(self, settings, locations):
+        self._settings = settings
+        self._locations = locations
+
+    def get(self, name):
+        if name in self._locations:
+            return self._locations[name]
+        return self._settings.get(name)
+
+    def set(self, name, value):
+        self._settings.set(name, value)
+
+def _find_tools(formats):
+    """Return a dict of setting -> location of the tools the formats
+    need (or can use) whose locations aren't set, found on the PATH as
+    the GUI does, and a list of the names of any they need still
+    missing"""
+    locations, missing = {}, []
+    for format in formats:
+        for command in _format_tools[format] + _optional_tools.get(format, []):
+            setting = "%s location" % command
+            if not tunebook.settings.get(setting) and setting not in locations:
+                location = tools.default_tool_path(command)
+                if location:
+                    locations[setting] = location
+                elif command in _format_tools[format] and command not in missing:
+                    missing.append(command)
+    return locations, missing
+
+def _use_locations(locations):
+    """Use the tool locations _find_tools found in this process, for this
+    run only; the user's settings file isn't changed"""
+    if locations:
+        tunebook.init(_RunSettings(tunebook.settings, locations))
+
+def _print_result(position, tune, seconds, written, cached, error):
+    if error:
+        status = "FAILED: %s" % error
+    else:
+        status = "%d files%s" % (len(written), " (cached)" if cached else "")
+    print("%6.3fs  X:%-5s %-40s %s" % (seconds, tune.xref, tune.title[:40], status))
+    sys.stdout.flush()
+
+def main(argv):
+    """Run the render command with the arguments argv, returning the exit
+    status: 0 if every tune rendered, 1 if any failed"""
+    parser = argparse.ArgumentParser(prog="abcenatrix render",
+                                     description="Render tunebooks without the GUI")
+    parser.add_argument("tunebooks", nargs="+", metavar="tunebook.abc")
+    parser.add_argument("--formats", default="svg",
+                        help="comma-separated formats out of %s (default svg)"
+                        % ", ".join(formats))
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="processes to render in (default one per CPU)")
+    parser.add_argument("--out", default=".",
+                        help="directory to write to; with several tunebooks, "
+                        "each gets a subdirectory (default .)")
+    parser.add_argument("--midi-program", type=int, default=None,
+                        help="General MIDI instrument for MIDI files")
+    parser.add_argument("--resolution", type=int, default=150,
+                        help="dots per inch of PNG files (default 150)")
+    args = parser.parse_args(argv)
+
+    wanted = [format.strip() for format in args.formats.split(",") if format.strip()]
+    unknown = [format for format in wanted if format not in formats]
+    if unknown or not wanted:
+        parser.error("unknown format: %s" % ", ".join(unknown))
+
+    locations, missing = _find_tools(wanted)
+    if missing:
+        sys.stderr.write("Can't find %s; set its location in the settings\n"
+                         % ", ".join(missing))
+        return 1
+    _use_locations(locations)
+
+    failures = count = 0
+    total_start = time.time()
+    for filename in args.tunebooks:
+        out_dir = args.out
+        if len(args.tunebooks) > 1:
+            out_dir = os.path.join(out_dir,
+                                   os.path.splitext(os.path.basename(filename))[0])
+
+        print("%s -> %s" % (filename, out_dir))
+        results = render(filename, out_dir, wanted, args.jobs, args.midi_program,
+                         args.resolution, _print_result, locations)
+
+        count += len(results)
+        failures += sum(1 for result in results if result[5])
+        if results:
+            slowest = max(results, key=lambda result: result[2])
+            print("slowest: X:%s %s, %.3fs; total tune time %.3fs" % (
+                slowest[1].xref, slowest[1].title, slowest[2],
+                sum(result[2] for result in results)))
+
+    print("%d tunes rendered, %d failed, in %.3fs" % (count - failures, failures,
+                                                      time.time() - total_start))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,365 @@
+# coding=utf-8
+
+"""Benchmarks for the ABCenatrix's tunebook handling.  Run one with
+
+    python -m abcv.bench <benchmark> [tunebook.abc]
+
+where <benchmark> is one of the names in benchmarks below.  Without a
+tunebook, a synthetic one of a few thousand reels is used."""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import abcv.tunebook as tunebook
+from abcv.tunebook import AbcTunebook, sidecar_path, svg_pages_batch
+from abcv.search_index import normalize
+
+_reel_bars = ["|:GABc dedB|dedB dedB|c2ec B2dB|c2A2 A2BA|",
+              "|GABc dedB|dedB dedB|c2ec B2dB|AFGE D4:|",
+              "|:d2fd c2ec|defg afge|d2fd c2ec|BAGF GABc|",
+              "|d2fd c2ec|defg abag|fagf e2dc|BAGF G4:|",
+              "|:e2ae gaeg|e2ae gedB|d2Bd g2dg|B2GB dBGB|"]
+
+def sample_tunebook(count=5000, seed=1):
+    """Return the text of a tunebook of count made-up reels"""
+    rnd = random.Random(seed)
+    tunes = []
+    for xref in range(1, count + 1):
+        body = "\n".join(rnd.choice(_reel_bars) for i in range(4))
+        tunes.append("X:%d\nT:Reel number %d\nT:The %s one\nR:reel\nM:4/4\nL:1/8\nK:%s\n%s"
+                     % (xref, xref, rnd.choice(["red", "green", "blue"]),
+                        rnd.choice(["G", "D", "Ador", "Edor"]), body))
+    return "\n\n".join(tunes)
+
+def _tunebook_file(argv):
+    """Return the name of the tunebook file to use and whether it's a
+    temporary one"""
+    if argv:
+        return argv[0], False
+
+    fd, fn = tempfile.mkstemp(suffix=".abc")
+    with os.fdopen(fd, "wb") as f:
+        f.write(sample_tunebook().encode("utf-8"))
+    return fn, True
+
+
+class _DictTune(dict):
+    """The way tunes used to be kept, for comparison: a dict of lists of
+    header values plus a copy of the text"""
+    def __init__(self, abc):
+        dict.__init__(self)
+        self.xref = 0
+        self.title = ""
+        self.content = abc.strip()
+        for line in abc.split("\n"):
+            line = line.strip()
+            if len(line) > 1 and line[1] == ":":
+                self.setdefault(line[0], []).append(line[2:].strip())
+
+def _traced(fn):
+    """Return what fn returns and the bytes it left allocated"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def memory(argv):
+    """Compare memory per loaded (and fully parsed) tune with the old
+    dict-based representation"""
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        def load_old():
+            with open(fn, "rb") as f:
+                abc = f.read().decode("utf-8")
+            return [_DictTune("X:" + tune) for tune in abc.split("\nX:")]
+
+        def load_new():
+            book = AbcTunebook(fn)
+            for tune in book:
+                tune.content # parse every tune, the worst case
+            return book
+
+        old, old_bytes = _traced(load_old)
+        new, new_bytes = _traced(load_new)
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+    count = len(new)
+    print("%d tunes" % count)
+    print("dict-based: %8d bytes per tune" % (old_bytes // count))
+    print("slot-based: %8d bytes per tune" % (new_bytes // count))
+    print("saving:     %8.1f%%" % (100.0 * (old_bytes - new_bytes) / old_bytes))
+
+
+class _Item(object):
+    """A filter item, as in the filter dialog"""
+    def __init__(self, key, pattern):
+        self.key = key
+        self.patterns = normalize(pattern).split(" ")
+
+def _timed(fn):
+    """Return what fn returns and the seconds it took"""
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+def sidecar(argv):
+    """Time opening and searching a tunebook the first time, when its
+    sidecar is made, and the next, when it's used"""
+    fn, temporary = _tunebook_file(argv)
+    search = [_Item("T", "reel"), _Item("*", "dedb")]
+
+    try:
+        for attempt in ["first", "second"]:
+            book, load_time = _timed(lambda: AbcTunebook(fn))
+            index, index_time = _timed(book.search_index)
+            matches, search_time = _timed(lambda: index.search(search))
+            _, update_time = _timed(book.update_sidecar)
+
+            print("%s open of %d tunes (%s):" % (attempt, len(book),
+                                                 type(index).__name__))
+            print("  load:           %6.3fs" % load_time)
+            print("  index:          %6.3fs" % index_time)
+            print("  search:         %6.3fs (%d matches)" % (search_time,
+                                                             len(matches)))
+            print("  update sidecar: %6.3fs" % update_time)
+    finally:
+        if temporary:
+            os.unlink(fn)
+            if os.path.exists(sidecar_path(fn)):
+                os.unlink(sidecar_path(fn))
+
+def titles(argv):
+    """Time building the title index and looking up misspelled titles"""
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        book = AbcTunebook(fn)
+        _, build_time = _timed(book.title_index)
+        print("%d tunes, title index built in %.3fs" % (len(book), build_time))
+
+        rnd = random.Random(1)
+        for tune in rnd.sample(list(book), min(5, len(book))):
+            # drop a letter, as a typo
+            title = tune.title
+            letters = [i for i, c in enumerate(title) if c.isalpha()]
+            cut = rnd.choice(letters) if letters else 0
+            query = title[:cut] + title[cut + 1:]
+
+            found, lookup_time = _timed(lambda: book.find_titles(query, 5))
+            ranked = [found_tune for score, found_tune in found]
+            rank = ranked.index(tune) + 1 if tune in ranked else None
+            print("  %-30s %6.1fms, rank %s" % (query, lookup_time * 1000, rank))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def incipits(argv):
+    """Time building the incipit index and finding tunes by a few notes
+    from the start of their first line of music"""
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        book = AbcTunebook(fn)
+        _, build_time = _timed(book.incipit_index)
+        print("%d tunes, incipit index built in %.3fs" % (len(book), build_time))
+
+        rnd = random.Random(1)
+        for tune in rnd.sample(list(book), min(5, len(book))):
+            music = [line for line in tune.text().split("\n")
+                     if line and line[1:2] != ":"]
+            if not music:
+                continue
+            query = music[0][:16]
+
+            found, lookup_time = _timed(lambda: book.find_incipit(query, 20))
+            print("  %-20s %6.1fms, %d found, %s" % (
+                query, lookup_time * 1000, len(found),
+                "including it" if tune in found else "not including it"))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def related(argv):
+    """Time building the related tunes index and finding the tunes most
+    like a few"""
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        book = AbcTunebook(fn)
+        _, build_time = _timed(book.related_index)
+        print("%d tunes, related index built in %.3fs" % (len(book), build_time))
+
+        rnd = random.Random(1)
+        for tune in rnd.sample(list(book), min(5, len(book))):
+            related, lookup_time = _timed(lambda: book.related_tunes(tune, 10))
+            print("  %-30s %6.1fms, nearest %s" % (
+                tune.title[:30], lookup_time * 1000,
+                ", ".join("%s (%.2f)" % (other.xref, similarity)
+                          for similarity, other in related[:3])))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def dedupe(argv):
+    """Time finding the near-duplicate tunes, in one process and in a
+    pool of one per CPU"""
+    from abcv.dedupe import find_duplicates
+
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        book = AbcTunebook(fn)
+        for workers in sorted(set([1, os.cpu_count() or 1])):
+            clusters, dedupe_time = _timed(lambda: find_duplicates(book, workers=workers))
+            print("%d tunes, %d workers: %d clusters of %d tunes in %.3fs" % (
+                len(book), workers, len(clusters),
+                sum(len(cluster) for cluster in clusters), dedupe_time))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def svg(argv):
+    """Time rendering the SVG of the first few hundred tunes, one run of
+    abcm2ps per tune and in batches, each into an empty cache"""
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        tunes = list(AbcTunebook(fn))[:300]
+        for name, render in [("one at a time", lambda: [tune.svg_pages() for tune in tunes]),
+                             ("in batches", lambda: svg_pages_batch(tunes))]:
+            cache_dir = tempfile.mkdtemp()
+            app_dir, tunebook.app_dir = tunebook.app_dir, cache_dir
+            tunebook._caches.clear()
+            try:
+                pages, render_time = _timed(render)
+            finally:
+                tunebook.app_dir = app_dir
+                tunebook._caches.clear()
+                shutil.rmtree(cache_dir)
+            print("%d tunes %s: %d pages in %.3fs" % (
+                len(tunes), name, sum(len(tune_pages) for tune_pages in pages),
+                render_time))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def midi(argv):
+    """Time making MIDI of each tune in-process, and count the tunes that
+    would need abc2midi"""
+    from abcv.abc_midi import compile_midi, UnsupportedAbc
+
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        times = []
+        unsupported = 0
+        for tune in AbcTunebook(fn):
+            abc = tune.text()
+            try:
+                _, compile_time = _timed(lambda: compile_midi(abc))
+            except UnsupportedAbc:
+                unsupported += 1
+            else:
+                times.append(compile_time)
+
+        times.sort()
+        if times:
+            print("%d tunes made into MIDI: median %.3fms, 90th percentile %.3fms, "
+                  "slowest %.3fms" % (len(times), times[len(times) // 2] * 1000,
+                                      times[len(times) * 9 // 10] * 1000,
+                                      times[-1] * 1000))
+        print("%d tunes would need abc2midi" % unsupported)
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def transpose(argv):
+    """Time transposing every tune in the tunebook up a tone and back"""
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        book = AbcTunebook(fn)
+        before = [tune.text() for tune in book]
+        _, up_time = _timed(lambda: book.transpose(2))
+        _, down_time = _timed(lambda: book.transpose(-2))
+        unchanged = sum(1 for tune, abc in zip(book, before) if tune.text() == abc)
+        print("%d tunes transposed up in %.3fs, back down in %.3fs; "
+              "%d came back as they were" % (len(book), up_time, down_time, unchanged))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+def lexer(argv):
+    """Time lexing the whole tunebook, in MB/s of its ABC, and lexing
+    again as notes are typed and deleted at places in it"""
+    from abcv.abc_lexer import lex, LexedText
+
+    fn, temporary = _tunebook_file(argv)
+
+    try:
+        with open(fn, "rb") as f:
+            data = f.read()
+        text = data.decode("utf-8", "replace")
+        megabytes = len(data) / 1e6
+
+        tokens, lex_time = _timed(lambda: lex(text))
+        print("%d tokens in %.1fMB lexed in %.3fs: %.1fMB/s"
+              % (len(tokens), megabytes, lex_time, megabytes / lex_time))
+
+        lexed, _ = _timed(lambda: LexedText(text))
+        rnd = random.Random(1)
+        typed = "|abcd efga"
+        edits = []
+        for place in range(20):
+            # type a bar of notes somewhere, then take it out again
+            position = rnd.randrange(len(lexed.text))
+            edits.extend((position + i, position + i, typed[i]) for i in range(len(typed)))
+            edits.extend((position + i, position + i + 1, "")
+                         for i in reversed(range(len(typed))))
+
+        lines = 0
+        start = time.time()
+        for edit in edits:
+            first, after = lexed.edit(*edit)
+            lines += after - first
+        edit_time = (time.time() - start) / len(edits)
+        print("%d keystrokes lexed again in %.3fms each on average, %.1f lines each; "
+              "tokens %s lexing it all" % (len(edits), edit_time * 1000, lines / len(edits),
+                                           "match" if lexed.tokens() == tokens else "DON'T MATCH"))
+    finally:
+        if temporary:
+            os.unlink(fn)
+
+
+benchmarks = {"memory": memory,
+              "sidecar": sidecar,
+              "titles": titles,
+              "incipits": incipits,
+              "related": related,
+              "dedupe": dedupe,
+              "svg": svg,
+              "midi": midi,
+              "transpose": transpose,
+              "lexer": lexer}
+
+if __name__ == "__main__":
+    try:
+        benchmark = benchmarks[sys.argv[1]]
+    except (IndexError, KeyError):
+        print(__doc__)
+        print("Benchmarks: %s" % ", ".join(sorted(benchmarks)))
+        sys.exit(1)
+
+    benchmark(sys.argv[2:])
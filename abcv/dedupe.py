@@ -0,0 +1,274 @@
+# coding=utf-8
+
+"""Finding tunes that are the same, or nearly, however they're numbered,
+titled or transposed.  Run as
+
+    python -m abcv.dedupe [--threshold 0.5] [--workers N] tunebook.abc ...
+
+to list the clusters of near-duplicates in one or more tunebooks.
+
+Each tune's melody is cut into overlapping runs of intervals (shingles)
+and summed up by a MinHash signature, whose values agree between two
+tunes about as often as their sets of shingles overlap.  Signatures are
+cut into bands, and only tunes with a band the same (locality-sensitive
+hashing) are compared, so the time taken grows with the number of tunes
+rather than its square."""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import sys
+import random
+import argparse
+import multiprocessing
+from array import array
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # it still works without, only much slower
+
+from abcv.melody import steps
+from abcv.incipit import _intervals
+
+# intervals per shingle; four fit a 32-bit int
+shingle_size = 4
+
+# tunes per chunk of work, for progress reports and the process pool
+chunk_size = 500
+
+_mask = (1 << 64) - 1
+
+
+def shingles(abc):
+    """Return the set of shingles of the melody of a tune's ABC, each
+    shingle_size intervals between notes (in scale steps, with repeated
+    notes made into one) packed into an int"""
+    intervals = _intervals(steps(abc))
+    return set(int.from_bytes(intervals[i:i + shingle_size], "big")
+               for i in range(len(intervals) - shingle_size + 1))
+
+
+class MinHasher(object):
+    """Makes MinHash signatures of num_perm 32-bit values from the sets of
+shingles of tunes, with multiply-shift hashing; the same seed makes the
+same signatures, in any process.  With NumPy, a whole chunk of tunes is
+shingled and hashed at once."""
+    def __init__(self, num_perm=128, seed=1):
+        rnd = random.Random(seed)
+        self.num_perm = num_perm
+        self._a = [rnd.getrandbits(64) | 1 for i in range(num_perm)]
+        self._b = [rnd.getrandbits(64) for i in range(num_perm)]
+
+        if numpy is not None:
+            self._np_a = numpy.array(self._a, dtype=numpy.uint64)[:, None]
+            self._np_b = numpy.array(self._b, dtype=numpy.uint64)[:, None]
+
+    def signatures(self, texts):
+        """Return a list of the signature (as bytes) of the melody of each
+        tune's ABC in texts; a tune too short to have a shingle gets None"""
+        if numpy is None:
+            result = []
+            for text in texts:
+                shingle_set = shingles(text)
+                result.append(self._signature(shingle_set) if shingle_set else None)
+            return result
+
+        # the intervals of all the tunes, end to end, and the tune each
+        # is in; a shingle's intervals all have to be in the same tune
+        melodies = [steps(text) for text in texts]
+        all_steps = numpy.fromiter(chain.from_iterable(melodies), dtype=numpy.int32)
+        owners = numpy.repeat(numpy.arange(len(melodies)),
+                              [len(melody) for melody in melodies])
+        intervals = numpy.diff(all_steps)
+        kept = (intervals != 0) & (owners[1:] == owners[:-1])
+        intervals = numpy.clip(intervals[kept], -127, 127).astype(numpy.uint64) + 128
+        interval_owners = owners[1:][kept]
+
+        result = [None] * len(melodies)
+        if len(intervals) < shingle_size:
+            return result
+
+        # each run of shingle_size intervals packed into an int, as in
+        # shingles(), kept if it's all from one tune
+        n = len(intervals) - shingle_size + 1
+        values = numpy.zeros(n, dtype=numpy.uint64)
+        for i in range(shingle_size):
+            values = (values << numpy.uint64(8)) | intervals[i:i + n]
+        value_owners = interval_owners[:n]
+        whole = value_owners == interval_owners[shingle_size - 1:]
+
+        # one of each shingle per tune, grouped by tune
+        keys = numpy.unique((value_owners[whole].astype(numpy.uint64) << numpy.uint64(32)) |
+                            values[whole])
+        values = keys & numpy.uint64(0xffffffff)
+        filled, starts = numpy.unique(keys >> numpy.uint64(32), return_index=True)
+
+        # every hash of every shingle, then the least of each tune's
+        # (the multiplication wraps around, which is what's wanted)
+        hashes = ((self._np_a * values[None, :] + self._np_b) >> numpy.uint64(32)).astype(numpy.uint32)
+        minima = numpy.minimum.reduceat(hashes, starts, axis=1).T
+
+        for i, signature in zip(filled, minima):
+            result[int(i)] = signature.tobytes()
+        return result
+
+    def _signature(self, shingle_set):
+        return array("I", [min(((a * shingle + b) & _mask) >> 32
+                               for shingle in shingle_set)
+                           for a, b in zip(self._a, self._b)]).tobytes()
+
+
+def agreement(signature, other):
+    """Return the share of the values of two signatures that are the
+    same, which estimates the Jaccard similarity of their tunes"""
+    if numpy is not None:
+        return float(numpy.mean(numpy.frombuffer(signature, dtype=numpy.uint32) ==
+                                numpy.frombuffer(other, dtype=numpy.uint32)))
+
+    values, other_values = array("I", signature), array("I", other)
+    return sum(1 for a, b in zip(values, other_values) if a == b) / len(values)
+
+def banding(num_perm, threshold):
+    """Return (bands, rows) for LSH with num_perm values, with rows a
+    divisor of num_perm, such that tunes about threshold alike are likely
+    to share a band; a bit under threshold is preferred, to miss less"""
+    options = []
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows == 0:
+            bands = num_perm // rows
+            likely = (1.0 / bands) ** (1.0 / rows)
+            options.append((likely > threshold, abs(likely - threshold), bands, rows))
+    return min(options)[2:]
+
+
+_hashers = {}
+
+def _signature_chunk(args):
+    """Return the signatures of a chunk of tunes' ABC; run in the pool"""
+    texts, num_perm, seed = args
+    try:
+        hasher = _hashers[num_perm, seed]
+    except KeyError:
+        hasher = _hashers[num_perm, seed] = MinHasher(num_perm, seed)
+    return hasher.signatures(texts)
+
+
+def signatures(tunes, num_perm=128, seed=1, workers=1, progress=None):
+    """Return a list of the signature of each tune (None for one with no
+    melody to speak of), computed a chunk at a time, in a pool of
+    workers processes if there's more than one; progress(done, total) is
+    called after each chunk"""
+    tunes = list(tunes)
+    chunks = [([tune.text() for tune in tunes[start:start + chunk_size]],
+               num_perm, seed)
+              for start in range(0, len(tunes), chunk_size)]
+
+    result = []
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for chunk_signatures in pool.imap(_signature_chunk, chunks):
+                result.extend(chunk_signatures)
+                if progress:
+                    progress(len(result), len(tunes))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            result.extend(_signature_chunk(chunk))
+            if progress:
+                progress(len(result), len(tunes))
+
+    return result
+
+
+def find_duplicates(tunes, threshold=0.5, num_perm=128, workers=1, progress=None):
+    """Return a list of the clusters of near-duplicate tunes among tunes
+    (e.g. an AbcTunebook), each a list of tunes in their original order,
+    biggest clusters first.  Tunes are near-duplicates if about threshold
+    (from 0 to 1) of their melodies' shingles are the same."""
+    tunes = list(tunes)
+    sigs = signatures(tunes, num_perm, workers=workers, progress=progress)
+    bands, rows = banding(num_perm, threshold)
+
+    # union-find over the tunes' numbers
+    parents = list(range(len(tunes)))
+
+    def root(doc):
+        while parents[doc] != doc:
+            parents[doc] = parents[parents[doc]]
+            doc = parents[doc]
+        return doc
+
+    width = rows * 4 # bytes per band
+    for band in range(bands):
+        buckets = {}
+        for doc, signature in enumerate(sigs):
+            if signature is not None:
+                buckets.setdefault(signature[band * width:(band + 1) * width],
+                                   []).append(doc)
+
+        # comparing each tune in a bucket with the first is enough to
+        # put them all in the right clusters, and doesn't blow up when
+        # thousands of copies of a tune share a bucket
+        for bucket in buckets.values():
+            first = bucket[0]
+            for doc in bucket[1:]:
+                if root(doc) != root(first) and \
+                   agreement(sigs[first], sigs[doc]) >= threshold:
+                    parents[root(doc)] = root(first)
+
+    clusters = {}
+    for doc in range(len(tunes)):
+        clusters.setdefault(root(doc), []).append(tunes[doc])
+
+    return sorted([cluster for cluster in clusters.values() if len(cluster) > 1],
+                  key=lambda cluster: -len(cluster))
+
+
+def _report_progress(done, total):
+    sys.stderr.write("\rsignatures: %d/%d" % (done, total))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+def main(argv):
+    from abcv.tunebook import AbcTunebook
+
+    parser = argparse.ArgumentParser(prog="python -m abcv.dedupe",
+                                     description="List the near-duplicate tunes in tunebooks")
+    parser.add_argument("tunebooks", nargs="+", metavar="tunebook.abc")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="how alike tunes must be, from 0 to 1 (default 0.5)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes to compute signatures in (default 1)")
+    parser.add_argument("--num-perm", type=int, default=128,
+                        help="values per MinHash signature (default 128)")
+    args = parser.parse_args(argv)
+
+    if numpy is None:
+        sys.stderr.write("NumPy isn't installed; this will be slow\n")
+
+    # where each tune came from, for the report
+    tunes, sources = [], {}
+    for filename in args.tunebooks:
+        for tune in AbcTunebook(filename):
+            tunes.append(tune)
+            sources[id(tune)] = filename
+
+    clusters = find_duplicates(tunes, args.threshold, args.num_perm,
+                               args.workers, _report_progress)
+
+    for number, cluster in enumerate(clusters, 1):
+        print("Cluster %d (%d tunes):" % (number, len(cluster)))
+        for tune in cluster:
+            print("  %s X:%s %s" % (sources[id(tune)], tune.xref, tune.title))
+
+    print("%d clusters of %d tunes among %d" % (len(clusters),
+                                                 sum(len(cluster) for cluster in clusters),
+                                                 len(tunes)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,309 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+
+from abcv.render_cache import ArtifactCache
+from abcv.tools import tool_version, scratch_directory
+from abcv.tunebook import file_header
+
+# about how many tunes make a fragment; abcm2ps packs the tunes of a
+# fragment onto pages together, but each fragment starts a new page
+fragment_tunes = 8
+
+# and at most how many, however the hashes fall
+_most_fragment_tunes = 4 * fragment_tunes
+
+# Ghostscript options for writing PDF, as the export always used
+_pdf_options = ["-sDEVICE=pdfwrite",
+                "-dPDFSETTINGS=/prepress",
+                "-dHaveTrueTypes=true",
+                "-dEmbedAllFonts=true",
+                "-dSubsetFonts=false",
+                "-c", ".setpdfwrite <</NeverEmbed [ ]>> setdistillerparams",
+                "-f"]
+
+# and for joining fragments into PostScript
+_ps_options = ["-sDEVICE=ps2write", "-f"]
+
+# how often running tools are checked on, in seconds
+_poll_interval = 0.05
+
+_xref_line = re.compile(r"^\s*X:.*\n?")
+
+
+class ExportCancelled(Exception):
+    def __init__(self):
+        Exception.__init__(self, "Export cancelled")
+
+class ExportError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def tune_digest(tune):
+    """Return a hash of what in a tune affects how it's typeset: all of it
+    but the X: line, which abcm2ps doesn't print unless told to, so that
+    renumbering the tunebook doesn't make every tune new"""
+    return abc_digest(tune.content)
+
+def abc_digest(content):
+    """Return tune_digest of a tune's ABC"""
+    if "withxrefs" not in content:
+        content = _xref_line.sub("", content, count=1)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def fragments(tunes, digests=None):
+    """Return the tunes split into runs of consecutive tunes, about
+    fragment_tunes long.  A run ends after a tune whose digest happens to
+    be divisible by fragment_tunes, so where the runs end depends only on
+    the tunes around, and editing, adding or removing a tune changes just
+    the run it's in."""
+    tunes = list(tunes)
+    if digests is None:
+        digests = [tune_digest(tune) for tune in tunes]
+
+    result = [[]]
+    for tune, digest in zip(tunes, digests):
+        result[-1].append(tune)
+        if int(digest[:8], 16) % fragment_tunes == 0 or \
+           len(result[-1]) == _most_fragment_tunes:
+            result.append([])
+
+    return [fragment for fragment in result if fragment]
+
+
+class TunebookExport(object):
+    """Exports tunes to one PDF or PostScript file.
+
+The tunes are split into fragments (see fragments()), each typeset by
+abcm2ps and made into PDF by Ghostscript, up to workers of those tools
+running at once, then Ghostscript joins the fragments in order.  Each
+fragment's PDF is kept in cache (an ArtifactCache) under a hash of its
+tunes and the tools, so exporting again after a few edits only typesets
+the fragments they touched.  Without Ghostscript, PostScript is made by
+one run of abcm2ps over all the tunes, as it always was.
+
+Since each fragment starts a new page, the pages don't break just where
+they would with one run of abcm2ps over the whole tunebook, as before
+fragments; there's a part-empty page every fragment_tunes tunes or so.
+
+The file is written under a temporary name and renamed into place at
+the end, so a failed or cancelled export leaves nothing behind.
+
+The tunes' ABC is read once, when the export is made, so they can go on
+being edited while it runs; header is the tunebook's file header (see
+AbcTunebook.header), which is put before the tunes of each fragment.
+
+run() does the work, and can be called on a worker thread; done and
+total say how far along it is (in tool runs), and cancel() stops it
+from any thread."""
+    def __init__(self, tunes, filename, format, abcm2ps, gs, cache=None, workers=None,
+                 header=""):
+        self.filename = filename
+        self.format = format
+        self._abc = [tune.text() for tune in tunes]
+        self._header = file_header(header)
+        self._abcm2ps = abcm2ps
+        self._gs = gs
+        self._cache = cache
+        self._workers = workers or multiprocessing.cpu_count()
+
+        # the hashes that say whether each fragment's been done before
+        digests = [abc_digest(abc) for abc in self._abc]
+        self._fragments = fragments(self._abc, digests)
+        tool_parts = [abcm2ps, tool_version("abcm2ps", abcm2ps),
+                      gs or "", tool_version("gs", gs) if gs else "",
+                      " ".join(_pdf_options),
+                      self._header]
+        self._keys = []
+        position = 0
+        for fragment in self._fragments:
+            self._keys.append(ArtifactCache.key(
+                "export fragment",
+                *(tool_parts + digests[position:position + len(fragment)])))
+            position += len(fragment)
+
+        # a PostScript and a PDF run per fragment not in the cache,
+        # then the join
+        if self._direct:
+            self.total = 1
+        else:
+            self.total = 2 * len(self._missing()) + 1
+        self.done = 0
+        self._cancelled = False
+
+    @property
+    def _direct(self):
+        """Whether the export is one run of abcm2ps, with no fragments"""
+        return self.format == "ps" and not self._gs
+
+    def _missing(self):
+        """Return the indexes of the fragments not in the cache"""
+        if self._cache is None:
+            return list(range(len(self._fragments)))
+        return [i for i, key in enumerate(self._keys)
+                if self._cache.get(key) is None]
+
+    def cancel(self):
+        """Stop the export as soon as possible, killing any tools running"""
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def run(self):
+        """Do the export, returning the filename; raises ExportCancelled if
+        it's cancelled, and ExportError if a tool fails"""
+        tmp_fn = "%s.%d.tmp" % (self.filename, os.getpid())
+        with scratch_directory() as work_dir:
+            try:
+                if self._direct:
+                    source = self._write_abc(work_dir, "tunebook", self._abc)
+                    self._run_all([([self._abcm2ps, "-O", tmp_fn, source], tmp_fn)],
+                                  work_dir, strict=False)
+                else:
+                    pdf_list = self._arguments(work_dir, "fragments",
+                                               self._fragment_pdfs(work_dir))
+                    options = _pdf_options if self.format == "pdf" else _ps_options
+                    self._run_all([([self._gs, "-q", "-o", tmp_fn] + options + [pdf_list],
+                                    tmp_fn)],
+                                  work_dir)
+
+                os.rename(tmp_fn, self.filename)
+            finally:
+                if os.path.exists(tmp_fn):
+                    os.unlink(tmp_fn)
+
+        return self.filename
+
+    def _write_abc(self, work_dir, name, abc):
+        """Write the file header and a list of tunes' ABC to an ABC file
+        in work_dir, returning its name"""
+        filename = os.path.join(work_dir, name + ".abc")
+        with open(filename, "wb") as f:
+            f.write((self._header + "\n\n".join(abc)).encode("utf-8"))
+        return filename
+
+    def _arguments(self, work_dir, name, filenames):
+        """Write filenames to a Ghostscript argument file in work_dir,
+        returning the argument that reads them from it; with a fragment
+        PDF for every few tunes, a big tunebook's are too many for one
+        command line (32K characters, on Windows)"""
+        filename = os.path.join(work_dir, name + ".args")
+        with open(filename, "wb") as f:
+            # quoted, in case of spaces, and with forward slashes, which
+            # Ghostscript takes on Windows too and doesn't treat as escapes
+            f.write("".join('"%s"\n' % fn.replace(os.sep, "/")
+                            for fn in filenames).encode("utf-8"))
+        return "@" + filename
+
+    def _keep(self, filename, work_dir, name):
+        """Return a link to (or copy of) filename in work_dir, so the file
+        lasts until the join even if the cache throws it out"""
+        kept = os.path.join(work_dir, name)
+        try:
+            os.link(filename, kept)
+        except OSError:
+            shutil.copyfile(filename, kept)
+        return kept
+
+    def _fragment_pdfs(self, work_dir):
+        """Return a list of the PDF file of each fragment, in order,
+        typesetting the ones that aren't in the cache"""
+        pdfs = [None] * len(self._fragments)
+        missing = []
+        for i, key in enumerate(self._keys):
+            cached = self._cache.get(key) if self._cache is not None else None
+            if cached:
+                pdfs[i] = self._keep(cached[0], work_dir, "kept%05d.pdf" % i)
+            else:
+                missing.append(i)
+
+        names = {}
+        for i in missing:
+            names[i] = os.path.join(work_dir, "fragment%05d" % i)
+            self._write_abc(work_dir, "fragment%05d" % i, self._fragments[i])
+
+        # abcm2ps complains (and exits with an error) about any tune it
+        # can't make sense of, but still sets the rest
+        self._run_all([([self._abcm2ps, "-O", names[i] + ".ps", names[i] + ".abc"],
+                        names[i] + ".ps")
+                       for i in missing],
+                      work_dir, strict=False)
+        self._run_all([([self._gs, "-q", "-o", names[i] + ".pdf"] + _pdf_options +
+                        [names[i] + ".ps"],
+                        names[i] + ".pdf")
+                       for i in missing],
+                      work_dir)
+
+        for i in missing:
+            pdfs[i] = names[i] + ".pdf"
+            if self._cache is not None:
+                # the cache takes its files away, so it gets a copy
+                cached = os.path.join(work_dir, "cache%05d" % i)
+                os.mkdir(cached)
+                shutil.copyfile(pdfs[i], os.path.join(cached, "fragment.pdf"))
+                self._cache.put(self._keys[i], [os.path.join(cached, "fragment.pdf")])
+
+        return pdfs
+
+    def _run_all(self, runs, work_dir, strict=True):
+        """Run each of runs, a list of (command, the file it writes), up to
+        workers at a time, until they're all done or one fails or the
+        export is cancelled.  A run fails if it doesn't write its file,
+        or, if strict, if it exits with an error."""
+        pending = list(runs)
+        running = []
+        try:
+            while pending or running:
+                if self._cancelled:
+                    raise ExportCancelled()
+
+                while pending and len(running) < self._workers:
+                    command, output = pending.pop(0)
+
+                    # what the tool says goes to a file, since a pipe
+                    # nobody's reading could fill up and stall it
+                    log = tempfile.TemporaryFile(dir=work_dir)
+                    try:
+                        process = subprocess.Popen(command,
+                                                   stdout=log,
+                                                   stderr=subprocess.STDOUT)
+                    except OSError as e:
+                        log.close()
+                        raise ExportError("Can't run %s: %s" % (command[0], e))
+                    running.append((command, output, log, process))
+
+                for run in list(running):
+                    command, output, log, process = run
+                    if process.poll() is None:
+                        continue
+
+                    running.remove(run)
+                    log.seek(0)
+                    said = log.read().decode("utf-8", "replace").strip()
+                    log.close()
+
+                    if not os.path.exists(output) or \
+                       (strict and process.returncode != 0):
+                        raise ExportError("%s failed: %s" % (os.path.basename(command[0]),
+                                                             said[-500:]))
+                    self.done += 1
+
+                if running:
+                    time.sleep(_poll_interval)
+        finally:
+            for command, output, log, process in running:
+                process.kill()
+                process.wait()
+                log.close()
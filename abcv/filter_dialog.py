@@ -10,12 +10,13 @@ from PyQt5.QtWidgets import *
 # from PyQt5.QtWebkit import *
 
 from abcv.tunebook import information_fields
+from abcv.search_index import normalize as _only_good_chars
+from abcv.title_index import fold, trigrams, similarity
+from abcv.melody import notes
+from abcv.incipit import contour, indexed_notes
 
-_good_chars = "abcdefghijklmnopqrstuvwxyz "
-
-def _only_good_chars(s):
-    return "".join([c for c in s.lower()
-                    if c in _good_chars]).strip()
+# how alike (from 0 to 1) a title has to be to a "similar title" pattern
+similar_title_threshold = 0.3
 
 def _clean_patterns(pat):
     return _only_good_chars(pat).split(" ")
@@ -39,11 +40,62 @@ class FilterItem(object):
         
         return not (False in results)
 
+class SimilarTitleItem(FilterItem):
+    """Matches tunes with a title spelled something like pattern, with
+    accents and typos allowed for"""
+    key = "~T"
+
+    def __init__(self, pattern):
+        self.patterns = [fold(pattern)]
+
+    def match(self, tune):
+        grams = trigrams(self.patterns[0])
+        return any(similarity(grams, trigrams(fold(title))) >= similar_title_threshold
+                   for title in tune.titles())
+
+    def matching(self, tunebook):
+        """Return a set of the ids of the tunebook's tunes that match"""
+        return tunebook.title_index().similar(self.patterns[0],
+                                              similar_title_threshold)
+
+class MelodyItem(FilterItem):
+    """Matches tunes whose melody has the notes of pattern (in ABC) in its
+opening notes (as many as the IncipitIndex has of it), in any key"""
+    key = "~M"
+
+    def __init__(self, pattern):
+        self.patterns = [pattern.strip()]
+
+    def match(self, tune):
+        melody = contour(notes(self.patterns[0], body=True))
+        return bool(melody) and \
+            melody in contour(notes(tune.text(), indexed_notes))
+
+    def matching(self, tunebook):
+        """Return a set of the ids of the tunebook's tunes that match"""
+        return set(id(tune) for position, tune
+                   in tunebook.incipit_index().search(self.patterns[0], None))
+
 class Filter(list):
     def __init__(self):
         list.__init__(self)
 
-    def apply(self, list_widget):
+    def apply(self, list_widget, tunebook=None):
+        """Hide the items of list_widget whose tunes don't match; with the
+        tunebook, the matching is done by its search indexes"""
+        if tunebook is not None:
+            indexed = [item for item in self if hasattr(item, "matching")]
+            matches = tunebook.search_index().search(
+                [item for item in self if item not in indexed])
+            indexed_matches = [item.matching(tunebook) for item in indexed]
+
+            for i in range(list_widget.count()):
+                item = list_widget.item(i)
+                item.setHidden(item.tune not in matches or
+                               any(id(item.tune) not in tunes
+                                   for tunes in indexed_matches))
+            return
+
         self.clear(list_widget)
 
         for filter in self:
@@ -63,6 +115,9 @@ class Filter(list):
 
         
 
+similar_title_dsc = "Tune title (similar spelling)"
+melody_dsc = "Opening notes (in ABC, any key)"
+
 class FilterDialog(QDialog):
     def __init__(self, parent=None):
         QDialog.__init__(self, parent=parent)
@@ -90,6 +145,8 @@ class FilterDialog(QDialog):
         self.field_list = QComboBox()
 
         self.field_list.addItem("Entire tune")
+        self.field_list.addItem(similar_title_dsc)
+        self.field_list.addItem(melody_dsc)
 
         for dsc in sorted([information_fields[k] for k in information_fields.keys()]):
             self.field_list.addItem(dsc)
@@ -120,7 +177,12 @@ class FilterDialog(QDialog):
             if information_fields[k] == self.field_list.currentText():
                 key = k
 
-        self.filter.append(FilterItem(key, self.pattern_input.text()))
+        if self.field_list.currentText() == similar_title_dsc:
+            self.filter.append(SimilarTitleItem(self.pattern_input.text()))
+        elif self.field_list.currentText() == melody_dsc:
+            self.filter.append(MelodyItem(self.pattern_input.text()))
+        else:
+            self.filter.append(FilterItem(key, self.pattern_input.text()))
 
         self.filter_dsc_label.setText(repr(self.filter))
 
@@ -0,0 +1,35 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+from PyQt5.QtCore import *
+
+from abcv.jobs import JobScheduler
+
+
+class _GuiDispatcher(QObject):
+    """Calls functions on the GUI thread on behalf of worker threads"""
+    call = pyqtSignal(object)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.call.connect(self._call, Qt.QueuedConnection)
+
+    def _call(self, fn):
+        fn()
+
+    def __call__(self, fn):
+        self.call.emit(fn)
+
+
+_scheduler = None
+
+def scheduler():
+    """Return the application's JobScheduler, whose results are reported
+    on the GUI thread; the first call must come from the GUI thread"""
+    global _scheduler
+
+    if _scheduler is None:
+        _scheduler = JobScheduler(dispatch=_GuiDispatcher())
+
+    return _scheduler
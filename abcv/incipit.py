@@ -0,0 +1,144 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+from array import array
+
+from abcv.melody import notes, steps
+
+# how many of each tune's notes are indexed; enough for the first
+# strain or so, which is what people remember a tune by
+indexed_notes = 64
+
+# intervals per n-gram
+gram_size = 3
+
+
+def _intervals(tune_steps):
+    """Return the intervals between the steps as bytes, with repeated
+    notes made into one (so "d2" and "dd" are the same melody)"""
+    intervals = bytearray()
+    for a, b in zip(tune_steps, tune_steps[1:]):
+        if a != b:
+            intervals.append(max(-127, min(127, b - a)) + 128)
+    return bytes(intervals)
+
+def _collapse(tune_notes):
+    """Return (steps, lengths) of the notes, with repeated notes made
+    into one (so "d2" and "dd" are the same melody)"""
+    note_steps, lengths = [], []
+    for pitch, step, length in tune_notes:
+        if note_steps and step == note_steps[-1]:
+            lengths[-1] += length
+        else:
+            note_steps.append(step)
+            lengths.append(length)
+    return note_steps, lengths
+
+def contour(tune_notes):
+    """Return the melody of the notes as bytes, one per interval between
+    them in scale steps (so it's the same in any key, and whatever key
+    signature a query is typed without)"""
+    return _intervals([step for pitch, step, length in tune_notes])
+
+def _rhythm(tune_notes):
+    """Return the length of each of the (collapsed) notes relative to
+    the one before"""
+    note_steps, lengths = _collapse(tune_notes)
+    return [b / a for a, b in zip(lengths, lengths[1:])]
+
+
+class IncipitIndex(object):
+    """An index of the beginnings of the melodies of a tunebook's tunes,
+for finding a tune from a few notes of it typed in ABC.  Each melody is
+reduced to the intervals between its notes, which don't depend on its
+key, and each run of gram_size intervals is indexed.  A search
+intersects the tunes with each of the query's runs, then checks the
+whole query against each one left."""
+    def __init__(self, tunes):
+        self._tunes = []
+        self._contours = []
+        self._postings = {} # run of intervals -> docs with it
+        self._docs = {}     # id(tune) -> doc
+        self._dead = set()  # docs of tunes since edited or removed
+
+        for tune in tunes:
+            self.add(tune)
+
+    def add(self, tune):
+        """Index the melody of a tune"""
+        doc = len(self._tunes)
+        self._docs[id(tune)] = doc
+        self._tunes.append(tune)
+
+        melody = _intervals(steps(tune.text(), indexed_notes))
+        self._contours.append(melody)
+
+        for gram in set(melody[i:i + gram_size]
+                        for i in range(len(melody) - gram_size + 1)):
+            try:
+                self._postings[gram].append(doc)
+            except KeyError:
+                self._postings[gram] = array("I", [doc])
+
+    def remove(self, tune):
+        """Forget the melody of a tune"""
+        self._dead.add(self._docs.pop(id(tune)))
+
+    def update(self, tune):
+        """Reindex a tune that's been edited"""
+        self.remove(tune)
+        self.add(tune)
+
+    def _candidates(self, melody):
+        """Return the docs that may contain melody"""
+        if len(melody) < gram_size:
+            return range(len(self._tunes))
+
+        postings = sorted((self._postings.get(melody[i:i + gram_size], ())
+                           for i in range(len(melody) - gram_size + 1)),
+                          key=len)
+        docs = set(postings[0])
+        for posting in postings[1:]:
+            if len(docs) < 32:
+                break # quicker to check what's left directly
+            docs.intersection_update(posting)
+        return docs
+
+    def search(self, abc, limit=20, rhythm=False):
+        """Return a list of (position, tune) of up to limit tunes (or all
+        of them, if limit is None) whose melody has the notes of abc in
+        it, where position is the number of the note it starts at;
+        tunes where it comes earliest come first.  With rhythm, the
+        lengths of the notes have to go the same way, too."""
+        query_notes = notes(abc, body=True)
+        melody = contour(query_notes)
+        if not melody:
+            return []
+
+        found = []
+        for doc in self._candidates(melody):
+            if doc in self._dead:
+                continue
+            position = self._contours[doc].find(melody)
+            if position != -1:
+                found.append((position, doc))
+        found.sort()
+
+        results = []
+        for position, doc in found:
+            tune = self._tunes[doc]
+            if rhythm and not self._same_rhythm(tune, position, query_notes):
+                continue
+            results.append((position, tune))
+            if limit is not None and len(results) == limit:
+                break
+        return results
+
+    def _same_rhythm(self, tune, position, query_notes):
+        """Return whether the lengths of the query's notes go the same way
+        as the tune's from position on; the last note of the query can
+        be any length"""
+        wanted = _rhythm(query_notes)[:-1]
+        have = _rhythm(notes(tune.text(), indexed_notes))
+        return have[position:position + len(wanted)] == wanted
@@ -0,0 +1,167 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import sys
+import threading
+import traceback
+from collections import deque
+
+# priority classes, most urgent first
+PRIORITY_VISIBLE = 0  # what the user is looking at right now
+PRIORITY_PREFETCH = 1 # what they'll probably look at next
+PRIORITY_BATCH = 2    # exports and other long haul work
+PRIORITY_IDLE = 3     # warming up indexes nobody's asked for yet
+
+_priorities = [PRIORITY_VISIBLE, PRIORITY_PREFETCH, PRIORITY_BATCH,
+               PRIORITY_IDLE]
+
+
+def _print_error(exc_info):
+    traceback.print_exception(*exc_info)
+
+
+class Job(object):
+    """A call waiting to be made (or being made) by a JobScheduler"""
+    def __init__(self, fn, args, priority, key, on_done, on_error):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.key = key
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = False
+
+    def cancel(self):
+        """Don't run the job if it hasn't started, and don't report its
+        result if it has"""
+        self.cancelled = True
+
+
+class JobScheduler(object):
+    """Runs slow calls (mostly external tools) on a pool of worker threads,
+most urgent priority class first.
+
+A job submitted with a key replaces any earlier job with the same key
+that hasn't finished; the newest request wins and the stale one is
+cancelled.  Results are handed to on_done (and exceptions to on_error)
+through the dispatch function, which by default just calls them on the
+worker thread; a GUI passes one that calls them on its own thread.
+
+limits caps how many workers a priority class may occupy at once, so
+that background work always leaves room for the visible tune."""
+    def __init__(self, workers=4, dispatch=None, limits=None):
+        self._dispatch = dispatch or (lambda fn: fn())
+        self._limits = {PRIORITY_VISIBLE: workers,
+                        PRIORITY_PREFETCH: max(1, workers // 2),
+                        PRIORITY_BATCH: 1,
+                        PRIORITY_IDLE: 1}
+        if limits:
+            self._limits.update(limits)
+
+        self._queues = dict((p, deque()) for p in _priorities)
+        self._running = dict((p, 0) for p in _priorities)
+        self._latest = {} # key -> newest job with that key
+        self._cond = threading.Condition()
+        self._stopping = False
+
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, args=(), priority=PRIORITY_VISIBLE, key=None,
+               on_done=None, on_error=None):
+        """Queue fn(*args) to run, returning its Job"""
+        job = Job(fn, tuple(args), priority, key, on_done, on_error)
+
+        with self._cond:
+            if key is not None:
+                stale = self._latest.get(key)
+                if stale:
+                    stale.cancel()
+                self._latest[key] = job
+
+            self._queues[priority].append(job)
+            self._cond.notify()
+
+        return job
+
+    def cancel(self, key=None, priority=None):
+        """Cancel every unfinished job with the key, or in the priority
+        class"""
+        with self._cond:
+            if key is not None:
+                job = self._latest.pop(key, None)
+                if job:
+                    job.cancel()
+
+            if priority is not None:
+                for job in self._queues[priority]:
+                    job.cancel()
+                self._queues[priority].clear()
+
+    def _next_job(self):
+        """Return the most urgent job whose class has a worker free, or
+        None; call with the lock held"""
+        for p in _priorities:
+            queue = self._queues[p]
+
+            # cancelled jobs are dropped as they come up
+            while queue and queue[0].cancelled:
+                queue.popleft()
+
+            if queue and self._running[p] < self._limits[p]:
+                return queue.popleft()
+
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None and not self._stopping:
+                    self._cond.wait()
+                    job = self._next_job()
+
+                if self._stopping:
+                    return
+
+                self._running[job.priority] += 1
+
+            try:
+                result = job.fn(*job.args)
+                self._report(job, job.on_done, result)
+            except Exception:
+                self._report(job, job.on_error or _print_error, sys.exc_info())
+            finally:
+                with self._cond:
+                    self._running[job.priority] -= 1
+                    if job.key is not None and self._latest.get(job.key) is job:
+                        del self._latest[job.key]
+
+                    # a class at its limit may have jobs waiting
+                    self._cond.notify_all()
+
+    def _report(self, job, callback, value):
+        if callback is None:
+            return
+
+        def report():
+            # check again: the job may have been superseded while
+            # the report was on its way
+            if not job.cancelled:
+                callback(value)
+
+        if not job.cancelled:
+            self._dispatch(report)
+
+    def shutdown(self):
+        """Stop the workers once they finish what they're doing"""
+        with self._cond:
+            self._stopping = True
+            for p in _priorities:
+                self._queues[p].clear()
+            self._cond.notify_all()
@@ -0,0 +1,284 @@
+# coding=utf-8
+
+"""Reading the notes out of a tune's ABC: just the pitch and length of
+each, which is enough to compare melodies"""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import re
+from fractions import Fraction
+
+import abcv.abc_lexer as abc_lexer
+
+# semitones above C of each note letter, and the letters in order
+_semitones = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+_letters = "CDEFGAB"
+
+# how many fifths above C each note letter is; a sharp adds seven, a
+# flat takes them away, and that many fifths from C is the number of
+# sharps (or, if negative, flats) in the major key of that tonic.
+# Modes are so many fifths away from their major.
+_letter_fifths = {"F": -1, "C": 0, "G": 1, "D": 2, "A": 3, "E": 4, "B": 5}
+_mode_fifths = {"maj": 0, "ion": 0, "mix": -1, "dor": -2, "m": -3, "min": -3,
+                "aeo": -3, "phr": -4, "loc": -5, "lyd": 1}
+
+_key = re.compile(r"\s*([A-G][#b]?)\s*([A-Za-z]*)")
+
+_alterations = {"^": 1, "^^": 2, "_": -1, "__": -2, "=": 0}
+
+def tonic_fifths(tonic):
+    """Return how many fifths above C the tonic (e.g. "F#") is"""
+    return _letter_fifths[tonic[0]] + 7 * {"#": 1, "b": -1}.get(tonic[1:], 0)
+
+def mode_fifths(mode):
+    """Return how many fifths the signature of the mode (as written in a
+    K: field, e.g. "Dor" or "m") is from its tonic's major"""
+    mode = mode.lower()
+    return _mode_fifths[mode[:3] if mode[:3] in _mode_fifths else
+                        ("m" if mode[:1] == "m" else "maj")]
+
+def key_signature(key):
+    """Return a dict of letter -> semitones sharpened (or flattened, if
+    negative) by the signature of the K: value key"""
+    m = _key.match(key)
+    if not m:
+        return {} # K:none, K:HP and such
+
+    fifths = tonic_fifths(m.group(1)) + mode_fifths(m.group(2))
+
+    if fifths >= 0:
+        return dict((letter, 1) for letter in "FCGDAEB"[:fifths])
+    return dict((letter, -1) for letter in "BEADGCF"[:-fifths])
+
+def _fraction(value, default):
+    """Return the fraction written as value (e.g. "1/8" or "C|"), or
+    default if it isn't one"""
+    value = value.strip()
+    if value == "C":
+        return Fraction(4, 4)
+    if value == "C|":
+        return Fraction(2, 2)
+    try:
+        return Fraction(value)
+    except (ValueError, ZeroDivisionError):
+        return default
+
+
+# the usual number of notes in the time of a tuplet of p notes
+_tuplet_time = {2: 3, 3: 2, 4: 3, 5: 2, 6: 2, 7: 2, 8: 3, 9: 2}
+
+# the parts of abc_lexer's note and rest tokens
+_pitch = re.compile(r"(\^\^|\^|__|_|=)?([A-Ga-g])([',]*)")
+_written_length = re.compile(r"(\d*)(/*)(\d*)")
+
+def _length(num, slashes, den):
+    length = Fraction(int(num) if num else 1)
+    if den:
+        length /= int(den)
+    elif slashes:
+        length /= 2 ** len(slashes)
+    return length
+
+# what the text of each note and rest token is, as _read_note reads it,
+# once it's been seen
+_read = {}
+_most_read = 20000
+
+def _read_note(text):
+    """Return (alteration or None, letter, octave, written length as a
+    multiple of the unit) of a note or rest token's text; a rest's
+    letter is None"""
+    if text[0] in "zx":
+        return None, None, None, _length(*_written_length.match(text, 1).groups())
+
+    m = _pitch.match(text)
+    accidental, letter, octave_marks = m.groups()
+    return (_alterations[accidental] if accidental else None, letter.upper(),
+            (1 if letter.islower() else 0) + octave_marks.count("'") - octave_marks.count(","),
+            _length(*_written_length.match(text, m.end()).groups()))
+
+def _read_new(text):
+    """Return _read_note(text), remembering it in _read"""
+    if len(_read) > _most_read:
+        _read.clear()
+    read = _read[text] = _read_note(text)
+    return read
+
+def notes(abc, limit=None, body=False):
+    """Return a list of (pitch, step, length) of each note of the ABC in
+    order, where pitch is in semitones from middle C, step is in scale
+    steps (letter names) from it and length is a Fraction of a whole
+    note.  The key signature and accidentals are applied; of a chord
+    only the first note is taken, and grace notes are left out.
+
+    Only the first limit notes are read, if there's a limit; with body,
+    abc is just music (e.g. a few notes typed in) with no header."""
+    result = []
+    meter = Fraction(4, 4)
+    unit = None
+    signature = {}
+    accidentals = {} # (letter, octave) -> semitones, 'til the bar line
+    in_chord = chord_taken = in_grace = False
+    broken = None
+    tuplet = None # (notes left, time factor)
+
+    for token in abc_lexer.iter_lex(abc, abc_lexer.BODY if body else abc_lexer.FREE):
+        kind, start, end = token
+
+        if in_grace:
+            in_grace = kind != abc_lexer.GRACE_END
+            continue
+
+        if kind == abc_lexer.NOTE or kind == abc_lexer.REST:
+            if unit is None:
+                unit = Fraction(1, 16) if meter < Fraction(3, 4) else Fraction(1, 8)
+
+            text = abc[start:end]
+            accidental, letter, octave, length = _read.get(text) or _read_new(text)
+            length *= unit
+
+            if tuplet:
+                length *= tuplet[1]
+                tuplet = (tuplet[0] - 1, tuplet[1]) if tuplet[0] > 1 else None
+
+            if broken and result and not in_chord:
+                # the note before gets longer (or shorter) at this
+                # one's expense
+                factor = Fraction(1, 2 ** broken[1])
+                if broken[0] == ">":
+                    pitch, step, before = result[-1]
+                    result[-1] = (pitch, step, before * (2 - factor))
+                    length *= factor
+                else:
+                    pitch, step, before = result[-1]
+                    result[-1] = (pitch, step, before * factor)
+                    length *= 2 - factor
+            broken = None
+
+            if kind == abc_lexer.REST:
+                continue
+
+            if accidental is not None:
+                accidentals[letter, octave] = accidental
+            alteration = accidentals.get((letter, octave),
+                                         signature.get(letter, 0))
+
+            if in_chord:
+                if chord_taken:
+                    continue
+                chord_taken = True
+
+            result.append((_semitones[letter] + alteration + 12 * octave,
+                           _letters.index(letter) + 7 * octave,
+                           length))
+            if limit is not None and len(result) > limit:
+                return result[:limit]
+
+        elif kind == abc_lexer.BAR:
+            accidentals = {}
+        elif kind == abc_lexer.CHORD_START:
+            in_chord, chord_taken = True, False
+        elif kind == abc_lexer.CHORD_END:
+            in_chord = False
+        elif kind == abc_lexer.GRACE_START:
+            in_grace = True
+        elif kind == abc_lexer.BROKEN_RHYTHM:
+            broken = (abc[start], end - start)
+        elif kind == abc_lexer.TUPLET:
+            p = int(abc[start + 1])
+            tuplet = (p, Fraction(_tuplet_time.get(p, 2), p))
+        elif kind == abc_lexer.FIELD or kind == abc_lexer.INLINE_FIELD:
+            key, value = abc_lexer.field_value(abc, token)
+            if key == "M":
+                meter = _fraction(value, meter)
+            elif key == "L":
+                unit = _fraction(value, unit)
+            elif key == "K":
+                signature = key_signature(value)
+
+    return result
+
+# the scale step of each letter from C
+_steps = dict((letter, step) for step, letter in enumerate(_letters))
+
+def steps(abc, limit=None):
+    """Return a list of the scale step (letter name) of each note of the
+    tune's ABC from middle C, as for notes() but quicker, since neither
+    keys nor lengths come into it"""
+    result = []
+    in_chord = chord_taken = in_grace = False
+    for kind, start, end in abc_lexer.iter_lex(abc):
+        if kind == abc_lexer.NOTE:
+            if in_grace:
+                continue
+            if in_chord:
+                if chord_taken:
+                    continue
+                chord_taken = True
+            text = abc[start:end]
+            accidental, letter, octave, length = _read.get(text) or _read_new(text)
+            result.append(_steps[letter] + 7 * octave)
+            if limit is not None and len(result) == limit:
+                break
+        elif kind == abc_lexer.CHORD_START:
+            in_chord, chord_taken = True, False
+        elif kind == abc_lexer.CHORD_END:
+            in_chord = False
+        elif kind == abc_lexer.GRACE_START:
+            in_grace = True
+        elif kind == abc_lexer.GRACE_END:
+            in_grace = False
+
+    return result
+
+
+def key_tonic(key):
+    """Return the semitones above C of the tonic of the K: value key, or
+    None if it hasn't one"""
+    m = _key.match(key)
+    if not m:
+        return None
+    tonic = m.group(1)
+    return (_semitones[tonic[0]] + {"#": 1, "b": -1}.get(tonic[1:], 0)) % 12
+
+def pitches(abc, limit=None):
+    """Return a list of the pitch of each note of the tune's ABC in
+    semitones from middle C, as for notes() but quicker, since lengths
+    don't come into it"""
+    result = []
+    signature = {}
+    accidentals = {}
+    in_chord = chord_taken = in_grace = False
+    for token in abc_lexer.iter_lex(abc):
+        kind, start, end = token
+        if kind == abc_lexer.NOTE:
+            if in_grace:
+                continue
+            if in_chord:
+                if chord_taken:
+                    continue
+                chord_taken = True
+            text = abc[start:end]
+            accidental, letter, octave, length = _read.get(text) or _read_new(text)
+            if accidental is not None:
+                accidentals[letter, octave] = accidental
+            result.append(_semitones[letter] + 12 * octave +
+                          accidentals.get((letter, octave),
+                                          signature.get(letter, 0)))
+            if limit is not None and len(result) == limit:
+                break
+        elif kind == abc_lexer.BAR:
+            accidentals = {}
+        elif kind == abc_lexer.CHORD_START:
+            in_chord, chord_taken = True, False
+        elif kind == abc_lexer.CHORD_END:
+            in_chord = False
+        elif kind == abc_lexer.GRACE_START:
+            in_grace = True
+        elif kind == abc_lexer.GRACE_END:
+            in_grace = False
+        elif (kind == abc_lexer.FIELD or kind == abc_lexer.INLINE_FIELD) and \
+             abc_lexer.field_value(abc, token)[0] == "K":
+            signature = key_signature(abc_lexer.field_value(abc, token)[1])
+
+    return result
@@ -31,8 +31,13 @@ class MidiPlayer(object):
 
     @file.setter
     def file(self, new_file):
-        self._filename = new_file
-        self._file = mido.MidiFile(new_file)
+        # either a filename or a MidiFile made in memory
+        if isinstance(new_file, mido.MidiFile):
+            self._filename = new_file.filename or ""
+            self._file = new_file
+        else:
+            self._filename = new_file
+            self._file = mido.MidiFile(new_file)
 
     def load(self, midi_fn):
         self.file = midi_fn
@@ -0,0 +1,55 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+from abcv.jobs import PRIORITY_PREFETCH
+from abcv.tunebook import svg_pages_batch
+from abcv.abc_midi import compile_midi, UnsupportedAbc
+
+
+class Prefetcher(object):
+    """Renders the tunes the user will probably look at next, so that
+moving to them is instant.  Rendering goes at prefetch priority on a
+JobScheduler (which limits how many workers it gets); the SVG pages of
+all of them are made by one run of abcm2ps, and end up in the tunebook
+module's memory and disk caches, and MIDI that needs abc2midi in its
+disk cache.  Only its own jobs are cancelled when the selection moves
+on; other work at prefetch priority (the related tunes, say) is left
+alone."""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._jobs = [] # the jobs of the latest prefetch
+
+    def prefetch(self, tunes, midi_program=None):
+        """Render the tunes, in order, forgetting about any prefetching
+        for an earlier selection that hasn't happened yet"""
+        self.cancel()
+
+        tunes = list(tunes)
+        self._jobs.append(self.scheduler.submit(svg_pages_batch, (tunes,),
+                                                priority=PRIORITY_PREFETCH,
+                                                on_error=_ignore))
+        for tune in tunes:
+            self._jobs.append(self.scheduler.submit(_midi_file, (tune, midi_program),
+                                                    priority=PRIORITY_PREFETCH,
+                                                    on_error=_ignore))
+
+    def cancel(self):
+        """Cancel the jobs of the latest prefetch that haven't finished"""
+        for job in self._jobs:
+            job.cancel()
+        self._jobs = []
+
+
+def _midi_file(tune, midi_program):
+    """Put MIDI of the tune in the disk cache if it takes abc2midi to make;
+    other tunes are made into MIDI quicker than it can be fetched, so
+    there's nothing to keep"""
+    try:
+        compile_midi(tune.text(), midi_program)
+    except UnsupportedAbc:
+        tune.midi_file(midi_program)
+
+def _ignore(exc_info):
+    pass # it'll be rendered again (and the error shown) if it's viewed
+
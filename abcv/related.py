@@ -0,0 +1,237 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import math
+from operator import sub
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # it still works without, only slower
+
+from abcv.melody import pitches, key_tonic
+import abcv.abc_lexer as abc_lexer
+
+# how many of each tune's notes go into its features
+feature_notes = 256
+
+# intervals wider than this many semitones are counted as this wide
+_widest = 12
+
+# pitch classes relative to the tonic, intervals from -_widest to
+# _widest, and the overall shape of the melody
+feature_size = 12 + (2 * _widest + 1) + 6
+
+
+def features(abc):
+    """Return a list of feature_size numbers describing the melody of a
+    tune's ABC, in a way that doesn't depend on its key or length, or
+    None if it has too few notes to say: how often each pitch class (from
+    the tonic) and each interval comes up, the shares of the intervals
+    going up, down and nowhere and of steps among them, the average
+    interval and the range"""
+    tune_pitches = pitches(abc, feature_notes)
+    if len(tune_pitches) < 2:
+        return None
+
+    tonic = _tonic(abc)
+
+    # counting distinct pitches and intervals, rather than notes, keeps
+    # the loops short
+    result = [0.0] * feature_size
+    share = 1.0 / len(tune_pitches)
+    for pitch, count in Counter(tune_pitches).items():
+        result[(pitch - tonic) % 12] += count * share
+
+    intervals = len(tune_pitches) - 1
+    share = 1.0 / intervals
+    up = down = steps = size = 0
+    for interval, count in Counter(map(sub, tune_pitches[1:], tune_pitches)).items():
+        result[12 + _widest + max(-_widest, min(_widest, interval))] += count * share
+        if interval > 0:
+            up += count
+        elif interval < 0:
+            down += count
+        if 0 < abs(interval) <= 2:
+            steps += count
+        size += abs(interval) * count
+
+    shape = 12 + 2 * _widest + 1
+    result[shape] = up * share
+    result[shape + 1] = down * share
+    result[shape + 2] = (intervals - up - down) * share
+    result[shape + 3] = steps * share
+    result[shape + 4] = size * share / _widest
+    result[shape + 5] = (max(tune_pitches) - min(tune_pitches)) / (2.0 * _widest)
+    return result
+
+def _tonic(abc):
+    """Return the tonic of the key a tune's melody starts in, in semitones
+    from C: that of the last K: field, or inline [K:], before its first
+    note"""
+    tonic = 0
+    for token in abc_lexer.iter_lex(abc):
+        kind = token[0]
+        if kind == abc_lexer.NOTE:
+            break
+        if kind in (abc_lexer.FIELD, abc_lexer.INLINE_FIELD):
+            key, value = abc_lexer.field_value(abc, token)
+            if key == "K":
+                tonic = key_tonic(value) or 0
+    return tonic
+
+
+class RelatedIndex(object):
+    """The melodic features of a tunebook's tunes, for finding the tunes
+most like one.  Each feature is scaled by how much it varies among the
+tunes (as they were when the index was made), so that the ones every
+tune has about the same of don't count for much, and each tune's
+features are made a unit vector, so a matrix product of them all with
+one tune's gives the cosine similarity of every tune to it at once."""
+    def __init__(self, tunes):
+        self._tunes = []      # tune of each row, or None once removed
+        self._docs = {}       # id(tune) -> row
+        self._cache = {}      # (id(tune), count) -> last similar()
+
+        tunes = list(tunes)
+        raw = [features(tune.text()) for tune in tunes]
+
+        # the centre and spread of each feature
+        known = [row for row in raw if row is not None]
+        if not known:
+            self._mean, self._scale = [0.0] * feature_size, [1.0] * feature_size
+        elif numpy is not None:
+            table = numpy.array(known)
+            spread = table.std(axis=0)
+            self._mean = table.mean(axis=0).tolist()
+            self._scale = numpy.where(spread > 1e-9, 1.0 / numpy.maximum(spread, 1e-9),
+                                      0.0).tolist()
+        else:
+            self._mean = [sum(column) / len(known) for column in zip(*known)]
+            self._scale = []
+            for mean, column in zip(self._mean, zip(*known)):
+                spread = math.sqrt(sum((x - mean) ** 2 for x in column) / len(known))
+                self._scale.append(1.0 / spread if spread > 1e-9 else 0.0)
+
+        for tune in tunes:
+            self._docs[id(tune)] = len(self._tunes)
+            self._tunes.append(tune)
+
+        if numpy is not None:
+            # all the rows at once
+            self._matrix = numpy.zeros((max(16, len(tunes)), feature_size),
+                                       dtype=numpy.float32)
+            self._live = numpy.zeros(len(self._matrix), dtype=bool)
+            if known:
+                live = numpy.array([row is not None for row in raw])
+                vectors = numpy.zeros((len(tunes), feature_size))
+                vectors[live] = (table - self._mean) * self._scale
+                lengths = numpy.sqrt((vectors ** 2).sum(axis=1))
+                live &= lengths > 1e-9
+                self._matrix[:len(tunes)][live] = vectors[live] / lengths[live, None]
+                self._live[:len(tunes)] = live
+        else:
+            self._rows = [self._vector(row) for row in raw]
+
+    def _vector(self, row):
+        """Return the features row centred, scaled and of unit length, or
+        None"""
+        if row is None:
+            return None
+        vector = [(x - mean) * scale
+                  for x, mean, scale in zip(row, self._mean, self._scale)]
+        length = math.sqrt(sum(x * x for x in vector))
+        if length < 1e-9:
+            return None
+        return [x / length for x in vector]
+
+    def _new_row(self, tune):
+        """Return a new row for a tune"""
+        doc = len(self._tunes)
+        self._docs[id(tune)] = doc
+        self._tunes.append(tune)
+
+        if numpy is not None:
+            if doc == len(self._matrix):
+                # double the matrix, to keep adding cheap
+                self._matrix = numpy.concatenate([self._matrix,
+                                                  numpy.zeros_like(self._matrix)])
+                self._live = numpy.concatenate([self._live,
+                                                numpy.zeros_like(self._live)])
+        else:
+            self._rows.append(None)
+        return doc
+
+    def _set_row(self, doc, row):
+        vector = self._vector(row)
+        if numpy is not None:
+            if vector is None:
+                self._matrix[doc] = 0
+                self._live[doc] = False
+            else:
+                self._matrix[doc] = vector
+                self._live[doc] = True
+        else:
+            self._rows[doc] = vector
+
+    def add(self, tune):
+        """Index the melody of a tune"""
+        self._set_row(self._new_row(tune), features(tune.text()))
+        self._cache.clear()
+
+    def remove(self, tune):
+        """Forget the melody of a tune"""
+        doc = self._docs.pop(id(tune))
+        self._tunes[doc] = None
+        self._set_row(doc, None)
+        self._cache.clear()
+
+    def update(self, tune):
+        """Reindex a tune that's been edited, in place"""
+        doc = self._docs.get(id(tune))
+        if doc is None:
+            self.add(tune)
+        else:
+            self._set_row(doc, features(tune.text()))
+            self._cache.clear()
+
+    def similar(self, tune, count=10):
+        """Return a list of (similarity, tune) of the count tunes with
+        melodies most like tune's, most alike first; similarity runs from
+        -1 to 1.  tune needn't be in the index."""
+        key = (id(tune), count)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        doc = self._docs.get(id(tune))
+        vector = self._vector(features(tune.text()))
+        if vector is None:
+            return []
+
+        if numpy is not None:
+            size = len(self._tunes)
+            scores = self._matrix[:size].dot(numpy.array(vector, dtype=numpy.float32))
+            scores[~self._live[:size]] = -numpy.inf
+            if doc is not None:
+                scores[doc] = -numpy.inf
+
+            count = min(count, int(self._live[:size].sum()))
+            if count <= 0:
+                return []
+            best = numpy.argpartition(-scores, count - 1)[:count]
+            best = best[numpy.argsort(-scores[best], kind="stable")]
+            result = [(float(scores[i]), self._tunes[i]) for i in best
+                      if scores[i] > -numpy.inf]
+        else:
+            scored = [(sum(a * b for a, b in zip(vector, row)), i)
+                      for i, row in enumerate(self._rows)
+                      if row is not None and i != doc]
+            scored.sort(key=lambda match: (-match[0], match[1]))
+            result = [(score, self._tunes[i]) for score, i in scored[:count]]
+
+        self._cache[key] = result
+        return result
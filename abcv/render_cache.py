@@ -0,0 +1,222 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import os
+import shutil
+import hashlib
+import threading
+from uuid import uuid4
+from collections import OrderedDict
+
+
+class ArtifactCache(object):
+    """A size-bounded on-disk cache of rendered files (SVG pages, MIDI
+files, …).  Each entry is a directory named by a hash of everything
+that went into producing its files; when the cache grows past max_size
+bytes, the least-recently-used entries are deleted until it's down to
+low_water of that, so it's a while before it has to be done again.
+
+Keeps hits and misses counters for the curious."""
+    def __init__(self, directory, max_size=256 * 1024 * 1024, low_water=0.9):
+        self.directory = directory
+        self.max_size = max_size
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+
+        # total size of the cache in bytes; worked out the first time
+        # something is stored, and kept up to date after
+        self._size = None
+
+        # held while an entry is looked up or evicted, so an entry that's
+        # been found is never deleted before it's been marked as used
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        """Return a hash of the parts, suitable for use as a cache key"""
+        h = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = ("%s" % part).encode("utf-8")
+            h.update(part)
+            h.update(b"\0") # so ("ab", "c") and ("a", "bc") differ
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        # spread the entries out a bit so no one directory gets huge
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return a sorted list of the files stored under key, or None if
+        there is no such entry"""
+        entry = self._entry_dir(key)
+
+        with self._lock:
+            try:
+                names = sorted(os.listdir(entry))
+            except OSError:
+                names = []
+
+            # touch the entry so eviction knows it was recently used
+            if names:
+                try:
+                    os.utime(entry, None)
+                except OSError:
+                    if not os.path.isdir(entry):
+                        names = [] # evicted by another process meanwhile
+
+            if not names:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return [os.path.join(entry, name) for name in names]
+
+    def put(self, key, filenames):
+        """Move the files into the cache under key, returning the list of
+        their new locations"""
+        entry = self._entry_dir(key)
+        parent = os.path.dirname(entry)
+
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass # someone else just made it
+
+        # build the entry under a temporary name and rename it into
+        # place, so a half-written entry is never seen
+        tmp_entry = "%s.%s.tmp" % (entry, uuid4())
+        os.mkdir(tmp_entry)
+
+        added = 0
+        for fn in filenames:
+            dest = os.path.join(tmp_entry, os.path.basename(fn))
+            shutil.move(fn, dest)
+            added += os.path.getsize(dest)
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another render of the same thing got there first; use it
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            added = 0
+
+        with self._lock:
+            if self._size is not None:
+                self._size += added
+            stored = [os.path.join(entry, name)
+                      for name in sorted(os.listdir(entry))]
+
+        self.evict(keep=entry)
+
+        return stored
+
+    def _entries(self):
+        """Yield (last use, size, path) for each entry in the cache"""
+        if not os.path.isdir(self.directory):
+            return
+
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.endswith(".tmp"):
+                    continue # still being written
+                entry = os.path.join(prefix_dir, name)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, fn))
+                               for fn in os.listdir(entry))
+                    yield os.path.getmtime(entry), size, entry
+                except OSError:
+                    pass # evicted out from under us
+
+    def _measure(self):
+        """Return the total size of the cached files, adding them up the
+        first time; call with _lock held"""
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        return self._size
+
+    @property
+    def size(self):
+        """The total size of the cached files in bytes"""
+        with self._lock:
+            return self._measure()
+
+    def evict(self, keep=None):
+        """If the cache has grown past max_size, delete least-recently-used
+        entries (but not the entry keep, just stored) until it fits in
+        low_water of max_size"""
+        with self._lock:
+            if self._measure() <= self.max_size:
+                return
+
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_size * self.low_water
+
+            for _, size, entry in entries:
+                if total <= target:
+                    break
+                if entry == keep:
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+            self._size = total
+
+    def clear(self):
+        """Delete everything in the cache"""
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._size = 0
+
+
+class MemoryCache(object):
+    """A least-recently-used cache of objects in memory, bounded by the
+total size given for them when they're stored"""
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict() # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored under key, or None"""
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            # put it back at the recently-used end
+            self._items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size):
+        """Store value under key, counting it as size bytes, and forget
+        the least recently used values until the cache fits"""
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.size -= old[1]
+
+            self._items[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_size and self._items:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
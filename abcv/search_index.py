@@ -0,0 +1,238 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import re
+from array import array
+from bisect import bisect_right
+
+# everything but lowercase letters and spaces is dropped before
+# searching
+_not_good = re.compile("[^a-z ]+")
+
+def normalize(s):
+    """Return s lowercased, with everything but letters and spaces
+    removed"""
+    return _not_good.sub("", s.lower()).strip()
+
+_not_good_or_sep = re.compile("[^a-z \0]+")
+
+def normalize_all(strings):
+    """Return a list of the strings normalized, done in one go"""
+    joined = _not_good_or_sep.sub("", "\0".join(strings).lower())
+    return [s.strip() for s in joined.split("\0")]
+
+def _bitset(docs, size):
+    """Return an int with the bits of the docs numbers set"""
+    bits = bytearray((size + 7) // 8)
+    for doc in docs:
+        bits[doc >> 3] |= 1 << (doc & 7)
+    return int.from_bytes(bytes(bits), "little")
+
+
+def _bitset_where(values, pattern):
+    """Return a bitset of the indexes of the values containing pattern,
+    testing them all"""
+    bits = "".join(["1" if pattern in value else "0"
+                    for value in reversed(values)])
+    return int(bits or "0", 2)
+
+
+class _FieldIndex(object):
+    """The normalized values of one field (or the whole tune) for every
+document, with posting lists of the tokens in them"""
+    def __init__(self, values):
+        # the normalized value of each document, "" if it hasn't the
+        # field
+        self._values = values
+
+        # token -> numbers of the documents containing it
+        postings = {}
+        for doc, value in enumerate(values):
+            for token in set(value.split()):
+                try:
+                    postings[token].append(doc)
+                except KeyError:
+                    postings[token] = array("I", [doc])
+
+        # the vocabulary is one string so patterns (which match
+        # anywhere within a token) can be found with str.find
+        self._tokens = sorted(postings)
+        self._postings = [postings[token] for token in self._tokens]
+        self._vocab = "\n".join(self._tokens)
+        self._vocab_starts = array("I")
+        pos = 0
+        for token in self._tokens:
+            self._vocab_starts.append(pos)
+            pos += len(token) + 1
+
+    def _tokens_containing(self, pattern):
+        """Yield the index of each token that contains pattern"""
+        starts = self._vocab_starts
+        pos = self._vocab.find(pattern)
+        while pos != -1:
+            i = bisect_right(starts, pos) - 1
+            yield i
+            if i + 1 == len(starts):
+                return
+            pos = self._vocab.find(pattern, starts[i + 1])
+
+    def match(self, pattern):
+        """Return a bitset of the documents whose value contains pattern"""
+        postings = []
+        total = 0
+
+        # a union of the postings of the tokens containing pattern,
+        # unless the pattern is so vague that it's quicker to just
+        # look at every document
+        limit = len(self._values) // 16
+
+        for i in self._tokens_containing(pattern):
+            postings.append(self._postings[i])
+            total += len(self._postings[i])
+            if total > limit:
+                return _bitset_where(self._values, pattern)
+
+        return _bitset((doc for posting in postings for doc in posting),
+                       len(self._values))
+
+
+class Matches(object):
+    """The tunes matched by a search, as a bitset over a TuneIndex's
+documents; use "tune in matches" to check a tune"""
+    def __init__(self, index, mask):
+        self.index = index
+        self.mask = mask
+        self._bits = mask.to_bytes((mask.bit_length() + 7) // 8 or 1,
+                                   "little")
+
+    def __contains__(self, tune):
+        try:
+            doc = self.index.doc(tune)
+        except KeyError:
+            return False
+        return doc >> 3 < len(self._bits) and bool(self._bits[doc >> 3] & (1 << (doc & 7)))
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+
+class TuneIndex(object):
+    """An inverted index of the words in a tunebook's tunes, for the
+filter.  Each tune is normalized once, when the index is built; a
+search for a field and patterns (with "*" as the field for the entire
+tune) is then a union of posting lists per pattern, and the patterns
+and filter items are ANDed together as bitsets.
+
+Tunes edited or added after the index is built are kept to one side
+and checked directly, so keeping the index up to date is cheap."""
+    def __init__(self, tunes):
+        self._tunes = list(tunes)
+        self._docs = dict((id(tune), doc)
+                          for doc, tune in enumerate(self._tunes))
+
+        self._build()
+
+        self._size = len(self._tunes)
+        self._removed = 0 # bitset of documents no longer in the book
+        self._changed = {} # doc -> normalized values, since the build
+        self._cache = {}
+
+    def _build(self):
+        """Normalize every tune and make the posting lists"""
+        values = {} # field key -> [value of each doc]
+        for doc, tune in enumerate(self._tunes):
+            for key, value in self._raw_values(tune).items():
+                try:
+                    values[key][doc] = value
+                except KeyError:
+                    values[key] = [""] * len(self._tunes)
+                    values[key][doc] = value
+
+        self._fields = dict((key, _FieldIndex(normalize_all(field_values)))
+                            for key, field_values in values.items())
+
+    @staticmethod
+    def _raw_values(tune):
+        """Return a dict of the values of the tune's fields, each key's
+        joined together, with "*" for the whole tune"""
+        parsed = tune.peek()
+
+        values = {"*": parsed.content}
+        for key, value in parsed.fields():
+            try:
+                values[key] = values[key] + " " + value
+            except KeyError:
+                values[key] = value
+
+        return values
+
+    @classmethod
+    def normalized(cls, tune):
+        """Return a dict of the normalized values of the tune's fields"""
+        values = cls._raw_values(tune)
+        return dict(zip(values, normalize_all(values.values())))
+
+    def doc(self, tune):
+        """Return the document number of the tune"""
+        return self._docs[id(tune)]
+
+    def add(self, tune):
+        """Index a tune added to the tunebook"""
+        self._docs[id(tune)] = len(self._tunes)
+        self._tunes.append(tune)
+        self.update(tune)
+
+    def update(self, tune):
+        """Reindex a tune that's been edited"""
+        doc = self._docs[id(tune)]
+        self._changed[doc] = self.normalized(tune)
+        self._removed |= 1 << doc
+        self._cache.clear()
+
+    def remove(self, tune):
+        """Forget a tune removed from the tunebook"""
+        doc = self._docs.pop(id(tune))
+        self._changed.pop(doc, None)
+        self._removed |= 1 << doc
+        self._cache.clear()
+
+    def _all(self):
+        return ((1 << len(self._tunes)) - 1) & ~self._removed | \
+            _bitset(self._changed, len(self._tunes))
+
+    def match(self, key, pattern):
+        """Return a bitset of the tunes whose key field (or whole text,
+        if key is "*") contains the normalized pattern"""
+        try:
+            return self._cache[key, pattern]
+        except KeyError:
+            pass
+
+        if pattern == "":
+            mask = self._all()
+        else:
+            mask = self._base_match(key, pattern) & ~self._removed
+            mask |= _bitset([doc for doc, values in self._changed.items()
+                             if pattern in values.get(key, "")],
+                            len(self._tunes))
+
+        self._cache[key, pattern] = mask
+        return mask
+
+    def _base_match(self, key, pattern):
+        """Return a bitset of the documents, as they were when the index
+        was built, whose key field contains pattern"""
+        try:
+            return self._fields[key].match(pattern)
+        except KeyError:
+            return 0
+
+    def search(self, items):
+        """Return the Matches of the tunes matching all of the items,
+        each of which has a key and a list of patterns"""
+        mask = self._all()
+        for item in items:
+            for pattern in item.patterns:
+                mask &= self.match(item.key, pattern)
+        return Matches(self, mask)
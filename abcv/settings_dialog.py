@@ -147,6 +147,14 @@ class SettingsDialog(QDialog):
         self.fit_list.setCurrentIndex(fits.index(self.settings.get("Default fit")))
         self.frm.addRow("Fit page to", self.fit_list)
 
+        self.preview_delay_spin = QSpinBox()
+        self.preview_delay_spin.setRange(0, 5000)
+        self.preview_delay_spin.setSingleStep(50)
+        self.preview_delay_spin.setSuffix(" ms")
+        delay = self.settings.get("Editor preview delay (ms)")
+        self.preview_delay_spin.setValue(300 if delay is None else delay)
+        self.frm.addRow("Editor preview delay", self.preview_delay_spin)
+
         self.frm.addRow(line())
 
         self.frm.addRow(QLabel("MIDI options"))
@@ -184,6 +192,7 @@ class SettingsDialog(QDialog):
         self.settings.set("User name", self.username_edit.text())
         self.settings.set("User email", self.email_edit.text())
         self.settings.set("Default fit", self.fit_list.currentText())
+        self.settings.set("Editor preview delay (ms)", self.preview_delay_spin.value())
         for k in general_midi.keys():
             if general_midi[k] == self.instrument_list.currentText():
                 self.settings.set("MIDI instrument", k)
@@ -0,0 +1,273 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import os
+import sys
+import hashlib
+import sqlite3
+import threading
+
+from abcv.search_index import TuneIndex, _bitset
+
+# bump this when the tables change, so old index files are started over
+_schema_version = "1"
+
+# field keys are single characters, so the full-text index can have a
+# column for each; column names go by the key's code, since SQLite's
+# don't distinguish case
+_keys = "*+" + "".join(chr(c) for c in range(ord("A"), ord("Z") + 1)) + \
+    "".join(chr(c) for c in range(ord("a"), ord("z") + 1))
+
+def _column(key):
+    return "f%d" % ord(key)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY,
+                                 digest TEXT UNIQUE,
+                                 indexed INTEGER DEFAULT 0);
+CREATE TABLE IF NOT EXISTS tunes (pos INTEGER PRIMARY KEY,
+                                  start INTEGER,
+                                  end INTEGER,
+                                  xref INTEGER,
+                                  title TEXT,
+                                  doc INTEGER);
+CREATE INDEX IF NOT EXISTS tunes_doc ON tunes (doc);
+CREATE VIRTUAL TABLE IF NOT EXISTS words USING fts5(%s, tokenize='trigram');
+""" % ", ".join(_column(key) for key in _keys)
+
+# how many tunes index() puts in the full-text index at a time, letting
+# go of the database in between
+_chunk_size = 1000
+
+def tune_digest(data, start, end):
+    """Return the digest identifying the text of the tune at data[start:end];
+    the X: line is left out so that renumbering doesn't make a tune new"""
+    first_line_end = data.find(b"\n", start, end)
+    if first_line_end == -1:
+        first_line_end = end
+    return hashlib.sha1(data[first_line_end:end].strip()).hexdigest()
+
+def file_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class Sidecar(object):
+    """An SQLite database kept alongside a tunebook file (in the app
+directory, not next to the file) with the position, xref and title of
+each tune in it and a full-text index of the normalized fields of each,
+so a tunebook that's been opened before can be loaded without scanning
+it and searched without indexing it.
+
+The database says which version of the file it describes by its size,
+modification time and digest; tunes themselves are kept by a digest of
+their text, so when the file changes only the new or changed tunes have
+to be indexed."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._db:
+            version = self._meta("schema")
+            if version not in (None, _schema_version):
+                self._drop()
+            self._db.executescript(_schema)
+            self._set_meta("schema", _schema_version)
+
+    def _drop(self):
+        for table in ["meta", "docs", "tunes", "words"]:
+            self._db.execute("DROP TABLE IF EXISTS %s" % table)
+
+    def _meta(self, key):
+        try:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?",
+                                   (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None # no tables yet
+        return row and row[0]
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                         (key, value))
+
+    def tunes(self, stat, data, encoding=None):
+        """Return the encoding of the file described by stat and data and
+        a list of (start, end, xref, title) for each of its tunes, or None
+        if the database doesn't describe that version of it"""
+        with self._lock, self._db:
+            if self._meta("size") != str(stat.st_size):
+                return None
+
+            known_encoding = self._meta("encoding")
+            if encoding is not None and encoding != known_encoding:
+                return None
+
+            # a changed modification time doesn't mean changed contents
+            if self._meta("mtime") != str(stat.st_mtime_ns):
+                if self._meta("digest") != file_digest(data):
+                    return None
+                self._set_meta("mtime", str(stat.st_mtime_ns))
+
+            return known_encoding, self._db.execute(
+                "SELECT start, end, xref, title FROM tunes ORDER BY pos").fetchall()
+
+    def replace(self, stat, digest, data, encoding, tunes):
+        """Describe a new version of the file, with the digest of its
+        bytes; data is its bytes as the tunes are found in them (which
+        for UTF-16 or with a BOM isn't quite the file) and tunes is a
+        list of (start, end, xref, title) for each tune in data.  Index entries of tunes
+        that are no longer in the file are thrown away."""
+        rows = []
+        with self._lock, self._db:
+            docs = dict(self._db.execute("SELECT digest, id FROM docs"))
+            for pos, (start, end, xref, title) in enumerate(tunes):
+                text_digest = tune_digest(data, start, end)
+                try:
+                    doc = docs[text_digest]
+                except KeyError:
+                    doc = self._db.execute("INSERT INTO docs (digest) VALUES (?)",
+                                           (text_digest,)).lastrowid
+                    docs[text_digest] = doc
+                rows.append((pos, start, end, xref, title, doc))
+
+            self._db.execute("DELETE FROM tunes")
+            self._db.executemany("INSERT INTO tunes VALUES (?, ?, ?, ?, ?, ?)",
+                                 rows)
+
+            unused = [(doc,) for (doc,) in self._db.execute(
+                "SELECT id FROM docs WHERE id NOT IN (SELECT doc FROM tunes)")]
+            self._db.executemany("DELETE FROM words WHERE rowid = ?", unused)
+            self._db.executemany("DELETE FROM docs WHERE id = ?", unused)
+
+            self._set_meta("size", str(stat.st_size))
+            self._set_meta("mtime", str(stat.st_mtime_ns))
+            self._set_meta("digest", digest)
+            self._set_meta("encoding", encoding)
+
+    def unindexed(self):
+        """Return a list of (doc, start, end) for each tune text in the
+        file that isn't in the full-text index yet"""
+        with self._lock:
+            return self._db.execute(
+                """SELECT docs.id, MIN(start), end FROM docs
+                   JOIN tunes ON tunes.doc = docs.id
+                   WHERE NOT docs.indexed GROUP BY docs.id""").fetchall()
+
+    def index(self, docs):
+        """Add the normalized values of tunes to the full-text index; docs
+        is an iterable of (doc, {key: normalized value}).  This is done a
+        chunk at a time, so the database isn't tied up for long."""
+        docs = iter(docs)
+        while True:
+            chunk = [entry for i, entry in zip(range(_chunk_size), docs)]
+            if not chunk:
+                return
+
+            with self._lock, self._db:
+                for doc, values in chunk:
+                    # the doc may have gone while the values were
+                    # being worked out, if the file's been saved
+                    if not self._db.execute(
+                            "UPDATE docs SET indexed = 1 WHERE id = ?",
+                            (doc,)).rowcount:
+                        continue
+
+                    keys = [key for key in values
+                            if values[key] and key in _keys]
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO words (rowid, %s) VALUES (?%s)"
+                        % (", ".join(_column(key) for key in keys),
+                           ", ?" * len(keys)),
+                        [doc] + [values[key] for key in keys])
+
+    def complete(self):
+        """Return whether every tune in the file is in the full-text index"""
+        with self._lock:
+            return self._db.execute(
+                """SELECT NOT EXISTS (SELECT 1 FROM docs
+                   JOIN tunes ON tunes.doc = docs.id
+                   WHERE NOT docs.indexed)""").fetchone()[0] == 1
+
+    def tune_docs(self):
+        """Return a list of the doc of each tune in the file, in order"""
+        with self._lock:
+            return [doc for (doc,) in self._db.execute(
+                "SELECT doc FROM tunes ORDER BY pos")]
+
+    def search(self, key, pattern):
+        """Return the docs whose key field (or whole text, if key is "*")
+        contains the normalized pattern"""
+        if key not in _keys:
+            return []
+
+        column = _column(key)
+        if len(pattern) >= 3:
+            # trigrams make any substring of three or more characters
+            # quick to find
+            sql = "SELECT rowid FROM words WHERE words MATCH ?"
+            pattern = '{%s} : "%s"' % (column, pattern.replace('"', '""'))
+        else:
+            sql = "SELECT rowid FROM words WHERE instr(%s, ?) > 0" % column
+
+        with self._lock:
+            return [doc for (doc,) in self._db.execute(sql, (pattern,))]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_sidecar(path):
+    """Return the Sidecar at path, or None if it can't be had (e.g. with
+    an SQLite without FTS5)"""
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return Sidecar(path)
+    except (OSError, sqlite3.Error):
+        return None
+
+
+class SidecarIndex(TuneIndex):
+    """A TuneIndex whose documents are the tunes of the file as a Sidecar
+describes it, searched in the sidecar's full-text index rather than in
+memory; edits since are kept to one side, as in a TuneIndex.  If the
+sidecar can't be searched, the tunes are indexed in memory after all."""
+    def __init__(self, tunes, sidecar):
+        self.sidecar = sidecar
+        TuneIndex.__init__(self, tunes)
+
+    def _build(self):
+        # the position of the tune with each text, and of any more
+        # tunes with the same text, which there usually aren't
+        docs = self.sidecar.tune_docs()
+        self._positions = dict(zip(reversed(docs), range(len(docs) - 1, -1, -1)))
+        self._duplicates = {}
+        if len(self._positions) < len(docs):
+            for pos, doc in enumerate(docs):
+                if self._positions[doc] != pos:
+                    self._duplicates.setdefault(doc, []).append(pos)
+
+    def _base_match(self, key, pattern):
+        if self.sidecar is not None:
+            try:
+                docs = self.sidecar.search(key, pattern)
+            except sqlite3.Error as e:
+                # the tunes are searched in memory instead, as by a
+                # TuneIndex, from now on
+                sys.stderr.write("Can't search the tunebook's index (%s); "
+                                 "indexing it in memory instead\n" % e)
+                self.sidecar = None
+                TuneIndex._build(self)
+            else:
+                positions = [self._positions[doc] for doc in docs
+                             if doc in self._positions]
+                if self._duplicates:
+                    for doc in docs:
+                        positions.extend(self._duplicates.get(doc, ()))
+                return _bitset(positions, len(self._tunes))
+
+        return TuneIndex._base_match(self, key, pattern)
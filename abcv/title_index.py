@@ -0,0 +1,156 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import re
+import math
+import unicodedata
+from array import array
+from collections import Counter
+
+# letters that don't come apart into a plain letter and accents
+_unfoldable = dict((ord(c), folded) for c, folded in
+                   [("ß", "ss"), ("æ", "ae"), ("œ", "oe"), ("ø", "o"),
+                    ("đ", "d"), ("ð", "d"), ("þ", "th"), ("ł", "l"),
+                    ("ı", "i")])
+
+_not_word = re.compile(r"[\W_]+", re.U)
+
+def fold(s):
+    """Return s lowercased, without accents and with anything but
+    letters and digits turned to single spaces, so that e.g. "Sí Bheag,
+    Sí Mhór" and "si bheag si mhor" are the same"""
+    s = s.lower()
+    if not s.isascii():
+        s = unicodedata.normalize("NFKD", s)
+        s = "".join(c for c in s if not unicodedata.combining(c))
+        s = s.translate(_unfoldable)
+    return _not_word.sub(" ", s).strip()
+
+def trigrams(folded):
+    """Return the set of trigrams of the words of a folded string, each
+    word padded so its start and end count for more"""
+    grams = set()
+    for word in folded.split():
+        word = "  " + word + " "
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+def similarity(grams, other):
+    """Return the Dice coefficient of two sets of trigrams, from 0 for
+    nothing in common to 1 for the same"""
+    if not grams or not other:
+        return 0.0
+    return 2.0 * len(grams & other) / (len(grams) + len(other))
+
+def _minimum_shared(count, threshold):
+    """Return the fewest trigrams a title has to share with a query of
+    count trigrams to be threshold similar; the title has at least as
+    many trigrams as it shares, which bounds its length"""
+    return max(1, int(math.ceil(threshold * count / (2.0 - threshold) - 1e-9)))
+
+
+class TitleIndex(object):
+    """A trigram index of the titles (the T: fields, alternates and all)
+of a tunebook's tunes, folded so that accents and punctuation don't
+matter, for finding tunes by titles spelled more or less the same way.
+
+A lookup counts the query's trigrams in the titles that have the rarer
+of them (a title similar enough has to have one of those), then scores
+those titles exactly."""
+    def __init__(self, tunes):
+        self._tunes = []    # tune of each entry
+        self._titles = []   # folded title of each entry
+        self._postings = {} # trigram -> entries with it
+        self._entries = {}  # id(tune) -> its entries
+        self._dead = set()  # entries of tunes since edited or removed
+
+        for tune in tunes:
+            self.add(tune)
+
+    def add(self, tune):
+        """Index the titles of a tune"""
+        entries = self._entries.setdefault(id(tune), [])
+        for title in set(fold(title) for title in tune.titles()):
+            grams = trigrams(title)
+            if not grams:
+                continue
+
+            entry = len(self._titles)
+            entries.append(entry)
+            self._tunes.append(tune)
+            self._titles.append(title)
+
+            for gram in grams:
+                try:
+                    self._postings[gram].append(entry)
+                except KeyError:
+                    self._postings[gram] = array("I", [entry])
+
+    def remove(self, tune):
+        """Forget the titles of a tune"""
+        self._dead.update(self._entries.pop(id(tune), ()))
+
+    def update(self, tune):
+        """Reindex the titles of a tune that's been edited"""
+        self.remove(tune)
+        self.add(tune)
+
+    def _scores(self, query, threshold, candidates=None):
+        """Return a dict of entry -> similarity to query of the entries
+        at least threshold similar.  With candidates, only that many of
+        the entries with the most of the rarest trigrams in common are
+        scored, which is quicker but can miss a few."""
+        grams = trigrams(fold(query))
+        if not grams:
+            return {}
+
+        postings = sorted((self._postings.get(gram, ()) for gram in grams),
+                          key=len)
+        rarest = len(grams) - _minimum_shared(len(grams), threshold) + 1
+
+        counts = Counter()
+        counted = 0
+        for posting in postings[:rarest]:
+            # the commonest trigrams say little about which titles are
+            # best, so a ranked lookup can stop short of them
+            if candidates is not None and counted and \
+               counted + len(posting) > candidates * 20:
+                break
+            counts.update(posting)
+            counted += len(posting)
+
+        if candidates is not None and len(counts) > candidates:
+            entries = [entry for entry, count in counts.most_common(candidates)]
+        else:
+            entries = counts
+
+        scores = {}
+        for entry in entries:
+            if entry in self._dead:
+                continue
+            score = similarity(grams, trigrams(self._titles[entry]))
+            if score >= threshold:
+                scores[entry] = score
+        return scores
+
+    def lookup(self, query, limit=10, threshold=0.3):
+        """Return a list of (score, tune, title) for up to limit tunes
+        with a title like query, best first; title is the best matching
+        one, folded"""
+        best = {}
+        for entry, score in self._scores(query, threshold,
+                                         max(limit * 50, 1000)).items():
+            tune = self._tunes[entry]
+            if id(tune) not in best or score > best[id(tune)][0]:
+                best[id(tune)] = (score, entry)
+
+        ranked = sorted(best.values(), key=lambda match: (-match[0], match[1]))
+        return [(score, self._tunes[entry], self._titles[entry])
+                for score, entry in ranked[:limit]]
+
+    def similar(self, query, threshold=0.3):
+        """Return a set of the ids of all the tunes with a title at least
+        threshold like query"""
+        return set(id(self._tunes[entry])
+                   for entry in self._scores(query, threshold))
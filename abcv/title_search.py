@@ -0,0 +1,55 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+from abcv.search_index import normalize, normalize_all
+
+
+def _words(query):
+    return [word for word in normalize(query).split(" ") if word]
+
+def _narrows(old_words, new_words):
+    """Return whether everything matching new_words must also match
+    old_words, i.e. each old word is part of some new one (as when more
+    is typed on the end of a query)"""
+    return all(any(old in new for new in new_words)
+               for old in old_words)
+
+
+class TitleSearch(object):
+    """Finds the titles containing every word of a query, for searching
+as the user types.  The titles are normalized once, up front; a query
+that only narrows the last one (the usual thing, typing more) is tested
+against just the titles that matched the last one."""
+    def __init__(self, titles):
+        self._titles = normalize_all(titles)
+        self._words = []
+        self._matches = list(range(len(self._titles)))
+
+    def search(self, query):
+        """Return a list of the indexes of the titles matching query, in
+        order"""
+        words = _words(query)
+
+        if _narrows(self._words, words):
+            candidates = self._matches
+        else:
+            candidates = range(len(self._titles))
+
+        titles = self._titles
+        matches = candidates
+        for word in words:
+            matches = [i for i in matches if word in titles[i]]
+
+        self._words = words
+        self._matches = list(matches)
+        return self._matches
+
+    def add(self, title):
+        """Add a title to the end of the list, returning whether it matches
+        the last query"""
+        self._titles.append(normalize(title))
+        if all(word in self._titles[-1] for word in self._words):
+            self._matches.append(len(self._titles) - 1)
+            return True
+        return False
@@ -1,5 +1,8 @@
 import os
+import shutil
+import tempfile
 import subprocess
+from contextlib import contextmanager
 
 commands = {"abcm2ps": "",
             "abc2midi": "",
@@ -8,15 +11,58 @@ commands = {"abcm2ps": "",
 
 def default_tool_path(command):
     """Try to find the tool in the PATH"""
-    if os.name == "nt":
-        sh_cmd = command
-    elif os.name == "posix":
-        sh_cmd = "which %s" % command
-        
-    child = subprocess.Popen(sh_cmd, shell=True, stdout=subprocess.PIPE)
-    output, _ = child.communicate()
-    
-    if command in output.decode("utf-8"):
-        return (command == sh_cmd) and command or output
-    
-    return None
+    return shutil.which(command)
+
+@contextmanager
+def scratch_directory():
+    """Make a temporary directory for a tool to write in, and delete it
+    and everything in it afterwards; use as
+
+        with scratch_directory() as out_dir:
+            ..."""
+    path = tempfile.mkdtemp(prefix="abcenatrix-")
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def run_tool(args, input=None, check=False):
+    """Run a tool with the argument list args (no shell involved), giving
+    it the bytes input on its stdin, and return what it writes to stdout
+    as bytes; raises OSError if the tool can't be run, and, with check,
+    subprocess.CalledProcessError if it fails"""
+    child = subprocess.Popen(args,
+                             stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+    output, _ = child.communicate(input)
+    if check and child.returncode != 0:
+        raise subprocess.CalledProcessError(child.returncode, args, output)
+    return output
+
+# the option that makes each tool print its version
+_version_options = {"abcm2ps": "-V",
+                    "abc2midi": "-ver",
+                    "abc2abc": "-ver",
+                    "gs": "--version"}
+
+_versions = {}
+
+def tool_version(command, location):
+    """Return what the tool at location says its version is, or an empty
+    string if it won't say; remembered for each location"""
+    try:
+        return _versions[location]
+    except KeyError:
+        pass
+
+    try:
+        child = subprocess.Popen([location, _version_options[command]],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        output, _ = child.communicate()
+        version = output.decode("utf-8", "replace").strip()
+    except (OSError, KeyError):
+        version = ""
+
+    _versions[location] = version
+    return version
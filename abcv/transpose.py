@@ -0,0 +1,184 @@
+# coding=utf-8
+
+"""Transposing ABC in-process, rather than by running abc2abc: K:
+fields, notes (grace notes among them), accidentals and chord symbols
+are rewritten, and everything else is left as it was.  Every note moves
+by the same number of letter names as the tonic, so the spelling follows
+the new key, and accidentals are written where the new key and bar need
+them and where the tune had them."""
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import re
+
+import abcv.abc_lexer as abc_lexer
+from abcv.melody import key_signature, tonic_fifths, mode_fifths, _key, _semitones, _letters
+
+# the pitch at the start of a note token, before its length
+_pitch = re.compile(r"(\^\^|\^|__|_|=)?([A-Ga-g])([',]*)")
+
+# a chord symbol's root, the rest of it, and the bass notes in that
+_chord_symbol = re.compile(r'^"([A-G])([#b]?)([^"]*)"$')
+_bass = re.compile(r"/([A-G])([#b]?)")
+
+# the kinds of token transposing can change; the others are copied
+_changed = frozenset([abc_lexer.NOTE, abc_lexer.CHORD_SYMBOL, abc_lexer.FIELD,
+                      abc_lexer.INLINE_FIELD])
+
+_alterations = {"^": 1, "^^": 2, "_": -1, "__": -2, "=": 0}
+_accidentals = {1: "^", 2: "^^", -1: "_", -2: "__", 0: "="}
+
+
+def _tonic_name(fifths):
+    """Return the tonic (e.g. "Eb") that many fifths above C"""
+    return "FCGDAEB"[(fifths + 1) % 7] + {-1: "b", 0: "", 1: "#"}[(fifths + 1) // 7]
+
+def _letter_shift(old_letter, new_letter, semitones):
+    """Return how many letter names (scale steps) notes move when
+    transposing by semitones takes old_letter to new_letter"""
+    shift = (_letters.index(new_letter) - _letters.index(old_letter)) % 7
+
+    # of the shifts that land on the letter, the one nearest the
+    # interval
+    target = semitones * 7 / 12
+    return min((shift + 7 * octave for octave in range(-12, 13)),
+               key=lambda steps: abs(steps - target))
+
+def transposed_key(key, semitones):
+    """Return the K: value key transposed by semitones, as
+    (the new value, how many letter names notes move); the new key is
+    spelled with no more than six flats or five sharps"""
+    m = _key.match(key)
+    tonic = m.group(1) if m else "C" # K:none moves notes as from C
+
+    offset = mode_fifths(m.group(2)) if m else 0
+    fifths = tonic_fifths(tonic) + offset
+    new_fifths = (fifths + 7 * semitones + 6) % 12 - 6
+    new_tonic = _tonic_name(new_fifths - offset)
+
+    shift = _letter_shift(tonic[0], new_tonic[0], semitones)
+    if not m:
+        return key, shift
+    return key[:m.start(1)] + new_tonic + key[m.end(1):], shift
+
+
+class Transposer(object):
+    """Transposes the ABC of tunes by a number of semitones; one can be
+used for any number of tunes."""
+    def __init__(self, semitones):
+        self.semitones = semitones
+
+    def transpose(self, abc):
+        """Return the ABC of a tune (or a whole tunebook), transposed"""
+        if self.semitones == 0:
+            return abc
+
+        self._set_key("C")
+
+        result = []
+        position = 0
+        for kind, start, end in abc_lexer.lex(abc):
+            if kind in _changed:
+                result.append(abc[position:start])
+                result.append(self._replace(kind, abc[start:end]))
+                position = end
+            elif kind == abc_lexer.BAR:
+                self._accidentals = {}
+                self._new_accidentals = {}
+        result.append(abc[position:])
+
+        return "".join(result)
+
+    def _set_key(self, key):
+        """Start notes in the K: value key, as it's written in the tune"""
+        new_key, self._shift = transposed_key(key, self.semitones)
+        self._signature = key_signature(key)
+        self._new_signature = key_signature(new_key)
+        self._accidentals = {}     # (letter, octave) -> alteration 'til the bar line
+        self._new_accidentals = {} # the same, as transposed
+        return new_key
+
+    def _key_change(self, key):
+        """Return the K: value key transposed, and go on in it"""
+        if not _key.match(key) and not key.strip().lower().startswith("none"):
+            return key # just a clef or some such; the key stays
+        return self._set_key(key)
+
+    def _replace(self, kind, text):
+        """Return the text of a token of one of the _changed kinds,
+        transposed"""
+        if kind == abc_lexer.NOTE:
+            m = _pitch.match(text)
+            return self._note(*m.groups()) + text[m.end():]
+        if kind == abc_lexer.CHORD_SYMBOL:
+            return self._chord_symbol(text)
+        if kind == abc_lexer.INLINE_FIELD:
+            if text[1] == "K":
+                return "[K:%s]" % self._key_change(text[3:-1])
+            return text
+        if text.lstrip().startswith("K:"):
+            value = text.index(":") + 1
+            return text[:value] + self._key_change(text[value:])
+        return text
+
+    def _note(self, accidental, letter, octave_marks):
+        """Return the note transposed"""
+        octave = (1 if letter > "Z" else 0) + \
+            octave_marks.count("'") - octave_marks.count(",")
+        letter = letter.upper()
+
+        if accidental:
+            alteration = self._accidentals[letter, octave] = _alterations[accidental]
+        else:
+            alteration = self._accidentals.get((letter, octave),
+                                               self._signature.get(letter, 0))
+        pitch = _semitones[letter] + alteration + 12 * octave + self.semitones
+
+        # the note moves as many letter names as the tonic, unless that
+        # would take more than a double sharp or flat
+        step = _letters.index(letter) + 7 * octave + self._shift
+        while True:
+            letter, octave = _letters[step % 7], step // 7
+            alteration = pitch - _semitones[letter] - 12 * octave
+            if -2 <= alteration <= 2:
+                break
+            step += 1 if alteration > 0 else -1
+
+        # an accidental's needed if the key and bar say otherwise, and
+        # kept where the tune had one
+        expected = self._new_accidentals.get((letter, octave),
+                                             self._new_signature.get(letter, 0))
+        if accidental or alteration != expected:
+            self._new_accidentals[letter, octave] = alteration
+            accidental = _accidentals[alteration]
+        else:
+            accidental = ""
+
+        if octave > 0:
+            return accidental + letter.lower() + "'" * (octave - 1)
+        return accidental + letter + "," * -octave
+
+    def _chord_symbol(self, text):
+        """Return the chord symbol (or annotation) text transposed"""
+        m = _chord_symbol.match(text)
+        if not m:
+            return text # an annotation, or not a chord
+
+        root, accidental, rest = m.groups()
+        return '"%s%s"' % (self._chord_note(root, accidental),
+                           _bass.sub(lambda bass: "/" + self._chord_note(*bass.groups()),
+                                     rest))
+
+    def _chord_note(self, letter, accidental):
+        """Return the root or bass note of a chord symbol, transposed"""
+        pitch = _semitones[letter] + {"#": 1, "b": -1}.get(accidental, 0) + self.semitones
+
+        step = _letters.index(letter) + self._shift
+        while True:
+            letter = _letters[step % 7]
+            alteration = (pitch - _semitones[letter] + 6) % 12 - 6
+            if -1 <= alteration <= 1:
+                break
+            step += 1 if alteration > 0 else -1
+
+        return letter + {-1: "b", 0: "", 1: "#"}[alteration]
@@ -2,16 +2,15 @@
 
 from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
 
-import os, tempfile
-from uuid import uuid4
-
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
 import abcv.tunebook as tunebook
+import abcv.abc_lexer as abc_lexer
 from abcv.abc_display_win import AbcDisplay, fits
 from abcv.midi_mixin import MidiMixin
+from abcv.gui_jobs import scheduler
 
 tune_template = """X:0
 T:Title
@@ -21,6 +20,65 @@ Z: %s <%s>
 K:A
 A4"""
 
+# how long to wait after the last keystroke before redrawing, if the
+# settings don't say
+default_preview_delay = 300 # ms
+
+# how each kind of token looks in the editor: (colour, bold, italic);
+# notes are left as they are
+_token_styles = {
+    abc_lexer.FIELD: ("darkblue", True, False),
+    abc_lexer.INLINE_FIELD: ("darkblue", True, False),
+    abc_lexer.TEXT: ("darkgreen", False, True),
+    abc_lexer.DIRECTIVE: ("purple", False, False),
+    abc_lexer.COMMENT: ("gray", False, True),
+    abc_lexer.BAR: ("black", True, False),
+    abc_lexer.ENDING: ("black", True, False),
+    abc_lexer.REST: ("gray", False, False),
+    abc_lexer.MEASURE_REST: ("gray", False, False),
+    abc_lexer.GRACE_START: ("gray", False, False),
+    abc_lexer.GRACE_END: ("gray", False, False),
+    abc_lexer.TIE: ("saddlebrown", False, False),
+    abc_lexer.SLUR: ("saddlebrown", False, False),
+    abc_lexer.TUPLET: ("saddlebrown", False, False),
+    abc_lexer.BROKEN_RHYTHM: ("saddlebrown", False, False),
+    abc_lexer.DECORATION: ("darkcyan", False, False),
+    abc_lexer.CHORD_SYMBOL: ("darkred", False, False),
+    abc_lexer.ANNOTATION: ("darkmagenta", False, True),
+    abc_lexer.OTHER: ("red", False, False),
+}
+
+
+class AbcHighlighter(QSyntaxHighlighter):
+    """Colours the ABC in a document by the kind of each token.  The
+lexer's state at the end of each line is kept as the block state, so Qt
+highlights again only the lines an edit changes, and the lines after
+them whose state it changes."""
+    def __init__(self, document):
+        QSyntaxHighlighter.__init__(self, document)
+
+        self._formats = {}
+        for kind, (colour, bold, italic) in _token_styles.items():
+            char_format = QTextCharFormat()
+            char_format.setForeground(QColor(colour))
+            if bold:
+                char_format.setFontWeight(QFont.Bold)
+            char_format.setFontItalic(italic)
+            self._formats[kind] = char_format
+
+    def highlightBlock(self, text):
+        state = self.previousBlockState()
+        if state < 0:
+            state = abc_lexer.FREE # the first line
+
+        tokens, state = abc_lexer.lex_line(text, state)
+        for kind, start, end in tokens:
+            char_format = self._formats.get(kind)
+            if char_format is not None:
+                self.setFormat(start, end - start, char_format)
+
+        self.setCurrentBlockState(state)
+
 
 class AbcTuneEditor(QDialog, MidiMixin):
     def __init__(self, settings, tune=None, parent=None):
@@ -49,9 +107,22 @@ class AbcTuneEditor(QDialog, MidiMixin):
         self.vbox.addLayout(self.hbox, stretch=1)
         
         self.editor = QPlainTextEdit()
+        self.highlighter = AbcHighlighter(self.editor.document())
 
         self.editor.document().setPlainText(tune.content)
 
+        # redraw only once typing pauses, not on every keystroke
+        self._preview_timer = QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        delay = self.settings.get("Editor preview delay (ms)")
+        if delay is None:
+            delay = default_preview_delay
+        self._preview_timer.setInterval(delay)
+        self._preview_timer.timeout.connect(self.redraw_tune)
+
+        # MIDI is only made when it's going to be played
+        self._midi_stale = True
+
         self.editor.textChanged.connect(self._on_text_change)
 
         self.hbox.addWidget(self.editor)
@@ -76,23 +147,43 @@ class AbcTuneEditor(QDialog, MidiMixin):
 
     def _on_text_change(self, *args, **kwargs):
         self._tune.content = self.editor.document().toPlainText()
-        self.redraw_tune()
-        self.export_midi()
+        self._midi_stale = True
+
+        # (re)start the wait for typing to pause; a render of older
+        # text that hasn't finished is of no more use
+        scheduler().cancel(key=("svg pages", id(self.abc_display)))
+        self._preview_timer.start()
 
     def redraw_tune(self):
         self.abc_display.tune = self._tune
 
-    def export_midi(self):
-        tempdir = tempfile.gettempdir()
-        
-        # export the tune as MIDI to get ready to play it
-        self.tmp_midi = os.path.join(tempdir, "%s.mid" % uuid4())
-        self._tune.write_midi(
-            self.tmp_midi,
-            midi_program=self.settings.get("MIDI instrument"))
-
-        if os.path.exists(self.tmp_midi):
-            self.load_midi(self.tmp_midi)
+    def export_midi(self, on_done=None):
+        """Bring the MIDI up to date with the text in the background,
+        then call on_done"""
+
+        def midi_ready(midi):
+            self.tmp_midi = midi
+            self._midi_stale = False
+            if self.tmp_midi is not None:
+                self.load_midi(self.tmp_midi)
+                if on_done:
+                    on_done()
+
+        # most tunes are made into MIDI in-process; undoing an edit to
+        # one that needs abc2midi gets the earlier MIDI back from the
+        # cache
+        scheduler().submit(self._tune.midi,
+                           (self.settings.get("MIDI instrument"),),
+                           key=("editor midi", id(self)),
+                           on_done=midi_ready)
+
+    def _toggle_play(self, *args, **kwargs):
+        """Start or stop playback, first making MIDI of the tune if it's
+        been edited since the last time"""
+        if self._midi_stale and not self.midi.playing:
+            self.export_midi(on_done=self.toggle_play)
+        else:
+            self.toggle_play()
 
 
     def _set_up_menus(self):
@@ -110,7 +201,7 @@ class AbcTuneEditor(QDialog, MidiMixin):
         addAction(self.playback_menu,
                   "Start/Stop",
                   "Ctrl+Space",
-                  lambda *args, **kwargs: self.toggle_play())
+                  self._toggle_play)
 
         
     @property
@@ -3,12 +3,30 @@
 from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
 
 import os
+import re
+import sys
 import codecs
-import tempfile
-from copy import deepcopy
-from subprocess import check_output
+from array import array
+import threading
+import unicodedata
+from collections import Counter
+import shutil
+import sqlite3
+import hashlib
+
+import mido
 
 from abcv.settings import Settings
+from abcv.render_cache import ArtifactCache, MemoryCache
+from abcv.tools import tool_version, run_tool, scratch_directory
+from abcv.search_index import TuneIndex
+from abcv.title_index import TitleIndex
+from abcv.incipit import IncipitIndex
+from abcv.related import RelatedIndex
+from abcv.abc_midi import compile_midi, UnsupportedAbc
+from abcv.transpose import Transposer
+from abcv.abc_lexer import body_start
+from abcv.sidecar import open_sidecar, file_digest, SidecarIndex
 
 information_fields = {
     "X": "Reference number",
@@ -36,154 +54,640 @@ app_dir = os.path.join(homedir,
                        ".abcenatrix")
 
 def init(settings_in):
-    global settings
+    global settings, _cache_sizes
     settings = settings_in
 
+    # the caches are only started over if their size settings changed,
+    # since they hold on to what's been rendered
+    sizes = (settings.get("Render cache size (MB)"),
+             settings.get("Render memory cache (MB)"))
+    if sizes != _cache_sizes:
+        _caches.clear()
+        _cache_sizes = sizes
+
+# on-disk caches of rendered tunes, by kind of output
+_caches = {}
+
+# the size settings the caches were made with
+_cache_sizes = None
+
 init(Settings(os.path.join(app_dir, "settings.json")))
 
+def artifact_cache(kind):
+    """Return the on-disk cache for the kind of output (e.g. "svg")"""
+    try:
+        return _caches[kind]
+    except KeyError:
+        size = settings.get("Render cache size (MB)") or 256
+        _caches[kind] = ArtifactCache(os.path.join(app_dir, "cache", kind),
+                                      size * 1024 * 1024)
+        return _caches[kind]
+
+def sidecar_path(filename):
+    """Return where the sidecar of the tunebook filename is kept"""
+    return os.path.join(app_dir, "index",
+                        hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+                        + ".sqlite")
+
+def sidecar(filename):
+    """Return the Sidecar of the tunebook filename, or None if they're
+    turned off or can't be had"""
+    if settings.get("Index files") is False:
+        return None
+    return open_sidecar(sidecar_path(filename))
+
+def memory_cache():
+    """Return the in-memory cache of recently rendered SvgPages"""
+    try:
+        return _caches["memory"]
+    except KeyError:
+        size = settings.get("Render memory cache (MB)") or 32
+        _caches["memory"] = MemoryCache(size * 1024 * 1024)
+        return _caches["memory"]
+
+# abcm2ps options used for every SVG render; part of the cache key
+_svg_options = ["-v"]
+
+# how many tunes svg_pages_batch gives each run of abcm2ps
+svg_batch_tunes = 32
+
+# marks the first page of each tune of a batch in abcm2ps's SVG output
+_batch_marker = "%%%%beginsvg\n<!-- abcenatrix batch tune %d X:%s -->\n%%%%endsvg\n"
+_batch_marker_svg = re.compile(br"<!-- abcenatrix batch tune (\d+) X:[^>]*-->\n?")
+
 
 def tune_from_abc(abc):
-    lines = abc.split("\n")
     tune = AbcTune(0)
-    tune.content = abc.strip()
-    
-    for line in lines:
-        line = line.strip()
-        
-        if len(line) > 1 and line[1] == ":": # it's a data field
-            key, value = line[0], line[2:].strip()
-            
-            if key == "X":
-                try:
-                    tune.xref = int(value)
-                except ValueError:
-                    tune.xref = None
-            elif key == "T":
-                if tune.title == "":
-                    tune.title = value
+    tune.update_from_abc(abc)
+    return tune
 
-            try:
-                tune[key].append(value)
-            except KeyError:
-                tune[key] = [value,]
 
-    return tune
-                
+# a line that looks like a data field: a letter (or + for a continued
+# field), a colon, and a value, which is group 2 without its padding
+_field_line = re.compile(r"^[ \t]*([A-Za-z+]):[ \t]*(.*?)[ \t\r]*$", re.M)
+
+def _parse_fields(content):
+    """Return the field keys of the ABC content as a string, one letter
+    per field, and an array of the (start, end) offsets of their values
+    in content"""
+    keys = []
+    spans = array("I")
+    for m in _field_line.finditer(content):
+        keys.append(m.group(1))
+        spans.extend(m.span(2))
+
+    # most tunes in a book have the same few fields in the same order,
+    # so they can all share one string
+    return sys.intern("".join(keys)), spans
+
+
+class SvgPages(object):
+    """All the rendered pages of a tune, held in memory as SVG bytes;
+pages[0] is the first page"""
+    def __init__(self, pages=()):
+        self._pages = list(pages)
+
+    @classmethod
+    def from_files(cls, filenames):
+        """Read the pages from a list of SVG files, in order"""
+        pages = []
+        for fn in filenames:
+            with open(fn, "rb") as f:
+                pages.append(f.read())
+        return cls(pages)
+
+    @property
+    def count(self):
+        return len(self._pages)
+
+    @property
+    def size(self):
+        """The total size of the pages in bytes"""
+        return sum(len(page) for page in self._pages)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __getitem__(self, index):
+        return self._pages[index]
 
-class AbcTune(dict):
-    """Represents a single tune from an ABC tunebook; a dict whose
-contents are the top-level properties of the tune.  Also has:
+    def __iter__(self):
+        return iter(self._pages)
+
+
+class AbcTune(object):
+    """Represents a single tune from an ABC tunebook; tune[key] is the
+list of values of the key's fields, as in a dict of the top-level
+properties of the tune.  Also has:
 
  - xref:int: the X: value from the original tunebook
  - title:string: the first T: value
- - content:string: a copy of everything from the first X: line to the next tune"""
-    def __init__(self, xref):
-        dict.__init__(self)
+ - content:string: a copy of everything from the first X: line to the next tune
+
+Field values aren't stored separately; they're sliced out of content
+as needed, so a tune costs little more than its text.  A tune loaded
+from a tunebook file starts out knowing only its xref and title; its
+content and fields are decoded from the file the first time they're
+used."""
+    __slots__ = ["xref", "title", "_content", "_keys", "_spans", "_source"]
+
+    def __init__(self, xref, title="", source=None):
         self.xref = xref
-        self.title = ""
-        self.content = ""
+        self.title = title
+        self._content = ""
+        self._keys = ""
+        self._spans = None
+
+        # (file bytes, start, end, encoding) of a tune whose content
+        # hasn't been decoded yet
+        self._source = source
+
+    @property
+    def content(self):
+        if self._source is not None:
+            self._materialize()
+        return self._content
+
+    @content.setter
+    def content(self, new_val):
+        self._source = None
+        self._content = new_val
+        self._keys, self._spans = _parse_fields(new_val)
+
+    def _materialize(self):
+        """Decode and parse the tune from its tunebook's bytes"""
+        data, start, end, encoding = self._source
+        self.content = data[start:end].decode(encoding, "replace").strip()
+
+    def peek(self):
+        """Return the tune, parsed; a tune still waiting in its tunebook's
+        bytes is parsed into a throwaway copy instead of being kept in
+        memory, for looking through a whole tunebook"""
+        if self._source is None:
+            return self
+
+        data, start, end, encoding = self._source
+        parsed = AbcTune(self.xref, self.title)
+        parsed.content = data[start:end].decode(encoding, "replace").strip()
+        return parsed
+
+    def text(self):
+        """Return the tune's ABC; a tune still waiting in its tunebook's
+        bytes is decoded for it, but not parsed or kept"""
+        if self._source is None:
+            return self._content
+
+        data, start, end, encoding = self._source
+        return data[start:end].decode(encoding, "replace").strip()
+
+    def titles(self):
+        """Return a list of the tune's T: values, alternate titles and
+        all; a tune still waiting in its tunebook's bytes isn't decoded
+        to get them"""
+        if self._source is None:
+            return self.get("T", [])
 
-    def _write_temp_file(self, midi_program=None):
+        data, start, end, encoding = self._source
+        return [m.group(1).strip().decode(encoding, "replace")
+                for m in _title_field.finditer(data, start, end)]
+
+    def fields(self):
+        """Return a list of (key, value) for each field of the tune, in
+        order"""
+        return list(self._fields())
+
+    def _fields(self):
+        """Yield (key, value) for each field of the tune, in order"""
+        content = self.content
+        spans = self._spans
+        for i, key in enumerate(self._keys):
+            yield key, content[spans[2 * i]:spans[2 * i + 1]]
+
+    def __getitem__(self, key):
+        values = [value for k, value in self._fields() if k == key]
+        if not values:
+            raise KeyError(key)
+        return values
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if self._source is not None:
+            self._materialize()
+        return key in self._keys
+
+    def keys(self):
+        """Return the field keys of the tune, in order of first
+        appearance"""
+        if self._source is not None:
+            self._materialize()
+        keys = []
+        for key in self._keys:
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def _snapshot(self):
+        """Return a copy of the tune with its ABC as it is now, to render
+        in the background: the editor changes the tune on the GUI thread
+        meanwhile, and a cache key and the tool input it's for must come
+        from the same text"""
+        snapshot = AbcTune(self.xref, self.title)
+        snapshot.content = self.content
+        return snapshot
+
+    def _tool_input(self, midi_program=None):
+        """Return the tune's ABC as bytes, for a tool to read"""
         abc = self.content
 
         # insert an abc2midi directive for the instrument if needed
         # and possible
         if midi_program != None:
-            try:
-                midi_pos = abc.index("\n", abc.index("\nK:") + 1)
-                abc = abc[:midi_pos] + "\n%%%%MIDI program %s\n" % midi_program + abc[midi_pos + 1:]
-            except ValueError:
-                pass
-                
-        with tempfile.NamedTemporaryFile(mode="wb", delete=False) as f:
-            tmp_fn = f.name
-
-            # Python 3 first, then 2
-            try:
-                f.write(abc.encode("utf-8"), "utf-8")
-            except:
-                f.write(abc.encode("utf-8"))
-            f.flush()
+            body = body_start(abc)
+            if body is not None:
+                header = abc[:body] if abc.endswith("\n", 0, body) else abc[:body] + "\n"
+                abc = header + "%%%%MIDI program %s\n" % midi_program + abc[body:]
+
+        return abc.encode("utf-8")
 
-            return f.name
+    def _write_tool_input(self, out_dir, midi_program=None):
+        """Write the tune's ABC into out_dir for the tools that can't read
+        it from stdin, returning the filename"""
+        filename = os.path.join(out_dir, "tune.abc")
+        with open(filename, "wb") as f:
+            f.write(self._tool_input(midi_program))
+        return filename
         
+    def _render_svg(self, out_dir):
+        """Run abcm2ps on the tune, returning a list of the SVG files it
+        produced in out_dir, one per page"""
+
+        # convert to an SVG, reading the tune from stdin; abcm2ps adds
+        # 001 to the base filename (and for succeeding pages, 002, 003 …)
+        try:
+            run_tool([settings.get("abcm2ps location")] + _svg_options +
+                     ["-O", os.path.join(out_dir, "tune.svg"), "-"],
+                     self._tool_input())
+        except OSError:
+            return [] # no abcm2ps, no pages
+
+        return [os.path.join(out_dir, fn)
+                for fn in sorted(os.listdir(out_dir))
+                if fn.endswith(".svg")]
+
+    def _svg_key(self):
+        """Return the key of the tune's SVG pages in the caches"""
+        abcm2ps = settings.get("abcm2ps location")
+        return ArtifactCache.key("svg",
+                                 self.content,
+                                 abcm2ps,
+                                 tool_version("abcm2ps", abcm2ps),
+                                 " ".join(_svg_options))
+
+    def _cached_svg_pages(self, key):
+        """Return the tune's SvgPages from the memory or disk cache, or
+        None if it hasn't been rendered"""
+
+        # recently shown or prefetched tunes are still in memory
+        svg_pages = memory_cache().get(key)
+        if svg_pages is not None:
+            return svg_pages
+
+        pages = artifact_cache("svg").get(key)
+        if pages is None:
+            return None
+
+        svg_pages = SvgPages.from_files(pages)
+        memory_cache().put(key, svg_pages, svg_pages.size)
+        return svg_pages
+
+    def svg_pages(self):
+        """Return the rendered pages of the tune as an SvgPages"""
+
+        # only run abcm2ps if this exact tune hasn't been rendered
+        # before
+        tune = self._snapshot()
+        key = tune._svg_key()
+        svg_pages = tune._cached_svg_pages(key)
+        if svg_pages is not None:
+            return svg_pages
+
+        with scratch_directory() as out_dir:
+            pages = tune._render_svg(out_dir)
+            if pages:
+                pages = artifact_cache("svg").put(key, pages)
+
+        svg_pages = SvgPages.from_files(pages)
+        memory_cache().put(key, svg_pages, svg_pages.size)
+
+        return svg_pages
+
+    def _batch_input(self, position):
+        """Return the tune's ABC with a marker for svg_pages_batch to find
+        its first page by, or None if there's nowhere to put one"""
+        abc = self.content
+
+        # the marker goes just after the K: line, where it's part of the
+        # tune and so turns up on the tune's first page
+        body = body_start(abc)
+        if body is None:
+            return None
+
+        header = abc[:body] if abc.endswith("\n", 0, body) else abc[:body] + "\n"
+        return header + _batch_marker % (position, self.xref) + abc[body:]
+
     def write_svg(self, filename, page=1):
-        """Write an SVG file of the first page of the tune to the specified
-        filename, returning the page count"""
+        """Write an SVG file of the specified page of the tune to the
+        specified filename, returning the page count"""
 
-        # write the tune to a temp file
-        tmp_fn = self._write_temp_file()
+        pages = self.svg_pages()
 
-        print(tmp_fn)
+        if 0 < page <= len(pages):
+            with open(filename, "wb") as f:
+                f.write(pages[page - 1])
 
-        # convert to an SVG; abcm2ps adds 001 to the base filename
-        # (and for succeeding pages, 002, 003 …)
-        os.system(
-            settings.get("abcm2ps location") + " -v -O %(filename)s %(tmpfile)s" %
-            {"filename": filename,
-             "tmpfile": tmp_fn})
+        return len(pages)
 
-        page_str = "{:0>3d}".format(page)
-        
-        # move the whatnot001.svg file to whatnot.svg
-        os.system(
-            "cp %s %s" % (filename.replace(".svg", "%s.svg" % page_str), filename))
+    def _render_png(self, out_dir, resolution):
+        """Run abcm2ps and Ghostscript on the tune, returning a list of
+        the PNG files they produced in out_dir, one per page"""
 
-        pages = 0
+        ps_fn = os.path.join(out_dir, "tune.ps")
 
-        while os.path.exists(
-                filename.replace(".svg",
-                                 "%s.svg" % "{:0>3d}".format(pages + 1))):
-            pages += 1
+        # PostScript first, from the tune on stdin, then a PNG of each
+        # page of that
+        try:
+            run_tool([settings.get("abcm2ps location"), "-O", ps_fn, "-"],
+                     self._tool_input())
+            if os.path.exists(ps_fn):
+                run_tool([settings.get("gs location"),
+                          "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE",
+                          "-sDEVICE=png16m", "-r%d" % resolution,
+                          "-sOutputFile=%s" % os.path.join(out_dir, "page%03d.png"),
+                          ps_fn])
+        except OSError:
+            return [] # no abcm2ps or gs, no pages
+
+        return [os.path.join(out_dir, fn)
+                for fn in sorted(os.listdir(out_dir))
+                if fn.endswith(".png")]
+
+    def png_pages(self, resolution=150):
+        """Return a list of the PNG files of the pages of the tune,
+        rendered at resolution dots per inch; the files belong to the
+        render cache, so don't change them"""
+
+        tune = self._snapshot()
+        abcm2ps = settings.get("abcm2ps location")
+        gs = settings.get("gs location")
+        key = ArtifactCache.key("png",
+                                tune.content,
+                                resolution,
+                                abcm2ps,
+                                tool_version("abcm2ps", abcm2ps),
+                                gs,
+                                tool_version("gs", gs))
+
+        cache = artifact_cache("png")
+        pages = cache.get(key)
+
+        if pages is None:
+            with scratch_directory() as out_dir:
+                pages = tune._render_png(out_dir, resolution)
+                if pages:
+                    pages = cache.put(key, pages)
 
         return pages
 
+    def midi_file(self, midi_program=None):
+        """Return the name of a MIDI file of the tune, played with the
+        specified MIDI program, or None if it couldn't be made; the file
+        belongs to the render cache, so don't change it"""
+
+        tune = self._snapshot()
+        abc2midi = settings.get("abc2midi location")
+        key = ArtifactCache.key("midi",
+                                tune.content,
+                                midi_program,
+                                abc2midi,
+                                tool_version("abc2midi", abc2midi))
+
+        # only run abc2midi if this exact tune hasn't been converted
+        # with this instrument before
+        cache = artifact_cache("midi")
+        midi = cache.get(key)
+
+        if midi is None:
+            with scratch_directory() as out_dir:
+                out_fn = tune._convert_to_midi(out_dir, midi_program)
+                if out_fn:
+                    midi = cache.put(key, [out_fn])
+
+        if midi:
+            return midi[0]
+        return None
+
+    def _convert_to_midi(self, out_dir, midi_program=None):
+        """Run abc2midi on the tune, returning the name of the MIDI file it
+        wrote in out_dir, or None"""
+
+        # abc2midi only reads files, so the tune goes in out_dir too
+        in_fn = self._write_tool_input(out_dir, midi_program)
+        out_fn = os.path.join(out_dir, "tune.mid")
+
+        # convert to MIDI
+        try:
+            run_tool([settings.get("abc2midi location"), in_fn, "-o", out_fn])
+        except OSError:
+            return None # no abc2midi, no MIDI
+
+        if os.path.exists(out_fn):
+            return out_fn
+        return None
+
+    def midi(self, midi_program=None):
+        """Return a mido.MidiFile of the tune, played with the specified
+        MIDI program, or None if it couldn't be made.  Most tunes are
+        made into MIDI right here, which takes well under a millisecond;
+        only those using ABC abc_midi doesn't play go through abc2midi
+        (and its cache)."""
+        tune = self._snapshot()
+        try:
+            return compile_midi(tune.content, midi_program)
+        except UnsupportedAbc:
+            pass
+
+        midi_fn = tune.midi_file(midi_program)
+        if midi_fn:
+            try:
+                return mido.MidiFile(midi_fn)
+            except (OSError, EOFError, ValueError):
+                pass # not a MIDI file mido can read
+        return None
+
     def write_midi(self, filename, midi_program=None):
         """Write MIDI of the tune to the specified filename"""
 
-        if midi_program == None:
-            tmp_fn = self._write_temp_file()
-        else:
-            tmp_fn = self._write_temp_file(midi_program=midi_program)
-            
-        # convert to MIDI
-        os.system(
-            settings.get("abc2midi location") + " %(tmpfile)s -o %(filename)s" %
-            {"filename": filename,
-             "tmpfile": tmp_fn})
+        midi = self.midi(midi_program)
+        if midi is not None:
+            midi.save(filename)
 
     def copy(self):
         """Return a deep copy of the tune; e.g. for modification, leaving the
 original unchanged."""
-        return deepcopy(self)
+        other = tune_from_abc(self.content)
+        other.xref = self.xref
+        other.title = self.title
+        return other
 
     def transpose(self, semitones):
         """Transpose the tune to a new key"""
-        self._replace_with_abc2abc_output(["-e",  "-t", str(semitones)])
+        self.update_from_abc(self.transposed_abc(semitones))
+
+    def transposed_abc(self, semitones):
+        """Return the ABC of the tune transposed to a new key, leaving the
+        tune unchanged"""
+        return Transposer(semitones).transpose(self.content)
+
+    def set_xref(self, xref):
+        """Change the tune's xref, in its X: field as well"""
+        self.xref = xref
+        content = self.content
+
+        for i, key in enumerate(self._keys):
+            if key == "X":
+                start, end = self._spans[2 * i], self._spans[2 * i + 1]
+                self.content = "%s%s%s" % (content[:start], xref, content[end:])
+                return
+
+        self.content = "X:%s\n%s" % (xref, content)
 
     def update_from_abc(self, abc):
-        other = tune_from_abc(abc)
-        self.clear()
-        self.title = other.title
-        self.xref = other.xref
-        self.content = other.content
-        for k in other.keys():
-            self[k] = other[k]
+        self.content = abc.strip()
 
+        self.xref = 0
+        self.title = ""
 
+        for key, value in self._fields():
+            if key == "X":
+                try:
+                    self.xref = int(value)
+                except ValueError:
+                    self.xref = None
+            elif key == "T":
+                if self.title == "":
+                    self.title = value
 
-    def _replace_with_abc2abc_output(self, abc2abc_args):
-        tmp_fn = self._write_temp_file()
-            
-        self.update_from_abc(
-            check_output([settings.get("abc2abc location"), tmp_fn] + abc2abc_args).decode("utf-8"))
-        
 
-# order of encodings to try when opening files, ordered by prevalence
-# on the web, emphasizing Western languages
+def svg_pages_batch(tunes):
+    """Return a list of the SvgPages of each of tunes, as svg_pages()
+    would, but rendering the ones not in the caches svg_batch_tunes at a
+    time, in one run of abcm2ps each, which is much quicker for short
+    tunes than starting abcm2ps for every one"""
+    tunes = [tune._snapshot() for tune in tunes]
+    keys = [tune._svg_key() for tune in tunes]
+    result = [tune._cached_svg_pages(key) for tune, key in zip(tunes, keys)]
+
+    missing = [i for i, pages in enumerate(result) if pages is None]
+    for start in range(0, len(missing), svg_batch_tunes):
+        group = missing[start:start + svg_batch_tunes]
+        rendered = _render_svg_batch([tunes[i] for i in group],
+                                     [keys[i] for i in group])
+        for i, svg_pages in zip(group, rendered):
+            # anything the batch couldn't account for is done alone
+            result[i] = svg_pages if svg_pages is not None else tunes[i].svg_pages()
+
+    return result
+
+def _render_svg_batch(tunes, keys):
+    """Render the tunes in one run of abcm2ps, caching each one's pages
+    under its key, and return a list of the SvgPages of each, or None
+    for any whose pages couldn't be told apart from the rest"""
+    result = [None] * len(tunes)
+
+    # each tune starts a new page, as it would alone, with a marker on
+    # it; tunes that can't be marked are left out
+    batch = []
+    inputs = []
+    for i, tune in enumerate(tunes):
+        abc = tune._batch_input(len(batch))
+        if abc is not None:
+            batch.append(i)
+            inputs.append(abc)
+    if not batch:
+        return result
+
+    with scratch_directory() as out_dir:
+        try:
+            run_tool([settings.get("abcm2ps location")] + _svg_options +
+                     ["-O", os.path.join(out_dir, "batch.svg"), "-"],
+                     "\n\n%%newpage\n\n".join(inputs).encode("utf-8"))
+        except OSError:
+            return result # no abcm2ps, no pages
+
+        # a page goes with the tune marked on it, or on the last marked
+        # page before it
+        pages = [[] for _ in batch]
+        current = -1
+        for fn in sorted(os.listdir(out_dir)):
+            if not fn.endswith(".svg"):
+                continue
+            with open(os.path.join(out_dir, fn), "rb") as f:
+                page = f.read()
+
+            m = _batch_marker_svg.search(page)
+            if m:
+                # if the markers aren't all there in order, tunes'
+                # pages could be mixed up, so none can be trusted
+                if int(m.group(1)) != current + 1:
+                    return result
+                current += 1
+                page = page[:m.start()] + page[m.end():]
+            elif current < 0:
+                return result
+
+            pages[current].append(page)
+
+        if current != len(batch) - 1:
+            return result
+
+        cache = artifact_cache("svg")
+        for position, i in enumerate(batch):
+            filenames = []
+            for number, page in enumerate(pages[position]):
+                filenames.append(os.path.join(out_dir, "tune%03d-%03d.svg" % (position, number)))
+                with open(filenames[-1], "wb") as f:
+                    f.write(page)
+            cache.put(keys[i], filenames)
+
+            svg_pages = SvgPages(pages[position])
+            memory_cache().put(keys[i], svg_pages, svg_pages.size)
+            result[i] = svg_pages
+
+    return result
+
+
+# encodings to consider when opening files, ordered by prevalence on
+# the web, emphasizing Western languages; earlier ones win ties
 _encodings = ["utf-8",
               "ISO-8859-1",
-              "Windows-1251",
+              "Windows-1252",
               "Windows-1251",
               "ISO-8859-2",
               "ISO-8859-15"]
@@ -196,52 +700,529 @@ class LoadError(Exception):
 # no, seriously, someone has to raise the baby
 
 
+_boms = [(codecs.BOM_UTF8, "utf-8"),
+         (codecs.BOM_UTF16_LE, "utf-16"),
+         (codecs.BOM_UTF16_BE, "utf-16")]
+
+# runs of non-ASCII bytes, which is all that tells encodings apart
+_non_ascii = re.compile(b"[\x80-\xff]+")
+
+# non-letters that turn up in tune titles and notes often enough to
+# count as evidence for an encoding that has them
+_plausible_symbols = "«»°©®£€§¿¡·½"
+
+def _detect_encoding(data):
+    """Return the encoding from _encodings that the bytes are most
+    plausibly in, looking at the whole file only once"""
+
+    for bom, encoding in _boms:
+        if data.startswith(bom):
+            return encoding
+
+    runs = []
+    words = 0
+    for m in _non_ascii.finditer(data):
+        run = m.group()
+        runs.append(run)
+
+        # Cyrillic words are whole runs of high bytes, while the
+        # accented letters of Latin words are among ASCII ones
+        if len(run) > 1 and not _ascii_letter(data, m.start() - 1) and \
+           not _ascii_letter(data, m.end()):
+            words += len(run)
+
+    # plain ASCII is UTF-8 too
+    if not runs:
+        return "utf-8"
+
+    # UTF-8 multibyte sequences never include ASCII, so checking the
+    # runs (kept apart by spaces) is as good as checking the file
+    try:
+        b" ".join(runs).decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    counts = Counter(b"".join(runs))
+    high = sum(counts.values())
+
+    # any run of high bytes means something in Cyrillic, so a Cyrillic
+    # encoding is only tried for text that's mostly words of them;
+    # anything else is one of the Latin ones, as it always was
+    latin = [encoding for encoding in _encodings[1:] if not _is_cyrillic(encoding)]
+    if words > high / 2:
+        groups = [[encoding for encoding in _encodings[1:] if _is_cyrillic(encoding)],
+                  latin]
+    else:
+        groups = [latin]
+
+    best = None
+    for group in groups:
+        best_score = None
+        for encoding in group:
+            score = _encoding_score(encoding, counts)
+            if score is not None and (best_score is None or score > best_score):
+                best, best_score = encoding, score
+        if best is not None:
+            break
+
+    if best is None:
+        # you ran out of encodings, you poor sod
+        raise LoadError("Unable to determine file encoding. Tried: " + ", ".join(_encodings))
+
+    return best
+
+def _encoding_score(encoding, counts):
+    """Score how plausible the counted high bytes are as text in the
+    encoding; None if some of them mean nothing in it"""
+    score = 0
+    for byte, count in counts.items():
+        try:
+            c = bytes([byte]).decode(encoding)
+        except UnicodeDecodeError:
+            return None
+
+        category = unicodedata.category(c)
+        if c.isalpha() or category.startswith("P") or c in _plausible_symbols:
+            score += count
+        elif category == "Cc":
+            score -= 10 * count # C1 control codes aren't text
+
+    return score
+
+def _ascii_letter(data, position):
+    """Return whether there's an ASCII letter at position in the bytes"""
+    return 0 <= position < len(data) and data[position:position + 1].isalpha()
+
+def _is_cyrillic(encoding):
+    return "\u0400" <= bytes([0xe0]).decode(encoding) <= "\u04ff"
+
+
+# a tune starts with an X: field at the start of a line; anything before
+# the first one is extraneous matter
+_tune_start = re.compile(br"^X:", re.M)
+_title_field = re.compile(br"^[ \t]*T:(.*)$", re.M)
+_xref_field = re.compile(br"X:(.*)")
+
+def file_header(header):
+    """Return a tunebook's header ready to go before its tunes, ending in
+    the blank line that ends it, or "" if there's nothing in it"""
+    header = header.rstrip()
+    return header + "\n\n" if header else ""
+
+def _tune_spans(data):
+    """Yield (start, end) of each tune in the bytes of a tunebook"""
+    starts = [m.start() for m in _tune_start.finditer(data)]
+    for start, end in zip(starts, starts[1:] + [len(data)]):
+        yield start, end
+
+def _xref(data, start, end):
+    try:
+        return int(_xref_field.match(data, start, end).group(1).strip())
+    except ValueError:
+        return None
+
+def _title(data, start, end, encoding):
+    for m in _title_field.finditer(data, start, end):
+        title = m.group(1).strip()
+        if title:
+            return title.decode(encoding, "replace")
+    return ""
+
+def _scan(data, encoding):
+    """Return a list of (start, end, xref, title) of each tune in the
+    bytes of a tunebook"""
+    return [(start, end, _xref(data, start, end), _title(data, start, end, encoding))
+            for start, end in _tune_spans(data)]
+
+
 class AbcTunebook(list):
     """Represents a tunebook file in ABC format; a list of tunes with a
-filename and a method to return a sorted list of titles"""
-    def __init__(self, filename=None):
+filename and a method to return a sorted list of titles.  encoding is
+the file's encoding, worked out when it's loaded unless it's passed in
+(e.g. when reloading a file whose encoding is already known)."""
+    def __init__(self, filename=None, encoding=None):
         list.__init__(self)
+        self.encoding = encoding
+
+        # what comes before the first tune in the file, e.g. %%scale or
+        # %%pagewidth, which applies to all the tunes when they're
+        # typeset together
+        self.header = ""
+
+        # xrefs from this index on may be out of sequence; they're put
+        # right when the tunebook is written
+        self._unnumbered_from = None
+
+        # the search index, once something has asked for it
+        self._index = None
+        self._index_lock = threading.Lock()
+
+        # a list of the edits made since each index being built was
+        # started, to be passed on to it once it's done
+        self._building = []
+
+        # an Event for each index being built, set once it's done, so
+        # it isn't built twice at once (e.g. by a filter while it's
+        # being built in the background)
+        self._builds = {}
+
+        # held while the sidecar's told about a changed file, which
+        # writes the whole file's tunes, so _index_lock needn't be; take
+        # it before _index_lock, never while holding it
+        self._sidecar_lock = threading.Lock()
+
+        # the TitleIndex, IncipitIndex and RelatedIndex, likewise
+        self._title_index = None
+        self._incipit_index = None
+        self._related_index = None
+
+        # the Sidecar of the file, if there is one; the tunes as they
+        # are in the file, with its bytes and encoding, so it can be
+        # brought up to date; whether it has to be; and the edits made
+        # since, for a SidecarIndex to be told about.  Without a
+        # sidecar, or once it's indexed the file, none of it's kept.
+        self._sidecar = None
+        self._file_tunes = None
+        self._file = None
+        self._sidecar_stale = None
+        self._edits = []
+
         if filename:
             self.filename = filename
             self._load()
         else:
             self.filename = None
 
-    def _load(self, encoding="utf-8"):
+    def _load(self):
         """load the tunebook filename"""
-        
-        tune = None
 
-        # try to load the file with each encoding from _encodings in turn
+        # read the whole file once, as bytes; tunes are decoded from
+        # it only when they're used
+        with open(self.filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+
+        # if the file's been opened before, its sidecar already knows
+        # where the tunes are
+        self._sidecar = sidecar(self.filename)
+        known = None
+        if self._sidecar is not None:
+            try:
+                known = self._sidecar.tunes(stat, data, self.encoding)
+            except sqlite3.Error:
+                self._sidecar = None
+
+        if known is not None:
+            self.encoding, tunes = known
+        elif self.encoding is None:
+            self.encoding = _detect_encoding(data)
+
+        encoding = self.encoding
+        digest = file_digest(data) if known is None and self._sidecar else None
+
+        # the tune finding works on ASCII-compatible bytes, so UTF-16
+        # has to be converted first
+        if codecs.lookup(encoding).name.startswith("utf-16"):
+            data = data.decode(encoding).encode("utf-8")
+            encoding = "utf-8"
+        elif data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):] # or it hides the first X:
+
+        if known is None:
+            tunes = _scan(data, encoding)
+            if self._sidecar is not None:
+                self._sidecar_stale = (stat, digest, self.encoding, tunes)
+
+        self.header = data[:tunes[0][0] if tunes else len(data)].decode(encoding, "replace")
+
+        for start, end, xref, title in tunes:
+            list.append(self, AbcTune(xref, title,
+                                      source=(data, start, end, encoding)))
+
+        if self._sidecar is not None:
+            self._file_tunes = list(self)
+            self._file = (data, encoding)
+
+        # files often have duplicate or missing xrefs
+        self._unnumbered_from = 0
+
+    def search_index(self):
+        """Return the TuneIndex of the tunebook, building it the first
+        time (which is slow for big tunebooks, so do that in the
+        background); if the tunebook's sidecar has indexed the whole
+        file, that's used instead, which is quick"""
+        with self._index_lock:
+            if self._index is not None:
+                return self._index
+
+        self._use_sidecar_index()
+        index = self._build_index("_index", TuneIndex)
+
+        with self._index_lock:
+            if self._index is index:
+                # the sidecar's no more use for searching now
+                self._edits = []
+                self._file_tunes = None
+        return index
+
+    def _build_index(self, name, make):
+        """Return the index in the attribute name, building it with
+        make(tunes) if there isn't one.  It's built without _index_lock
+        held, so edits on the GUI thread don't wait for it, then the
+        edits made meanwhile are passed on to it before it's put in
+        place.  If another thread is building it already, this waits for
+        that one."""
+        while True:
+            with self._index_lock:
+                index = getattr(self, name)
+                if index is not None:
+                    return index
+
+                building = self._builds.get(name)
+                if building is None:
+                    building = self._builds[name] = threading.Event()
+                    tunes = list(self)
+                    edits = []
+                    self._building.append(edits)
+                    break
+
+            building.wait()
+
         try:
-            with codecs.open(self.filename, "r", encoding) as f:
-                abc = f.read()
-        except UnicodeDecodeError:
+            built = make(tunes)
+        except:
+            with self._index_lock:
+                self._building.remove(edits)
+                del self._builds[name]
+            building.set()
+            raise
+
+        with self._index_lock:
+            self._building.remove(edits)
+            del self._builds[name]
+            building.set()
+
+            # unless another thread got there first
+            index = getattr(self, name)
+            if index is None:
+                # a tune is added to or removed from the list just before
+                # the indexes are told, so the list copied may already
+                # have had it added or removed
+                indexed = set(map(id, tunes))
+                for method, tune in edits:
+                    if method == "add" and id(tune) in indexed or \
+                       method == "remove" and id(tune) not in indexed:
+                        continue
+                    if method == "remove":
+                        indexed.discard(id(tune))
+                    else:
+                        indexed.add(id(tune))
+                    getattr(built, method)(tune)
+                index = built
+                setattr(self, name, index)
+            return index
+
+    def _use_sidecar_index(self):
+        """Make the search index a SidecarIndex, if the tunebook's sidecar
+        has indexed the whole file; this is done without _index_lock held,
+        and the edits made since the file was read are passed on to it.
+        A SidecarIndex of the file as it was before it was saved is
+        replaced."""
+        sidecar = self._replace_sidecar()
+        if sidecar is None:
+            return
+
+        with self._index_lock:
+            tunes = self._file_tunes if self._sidecar is sidecar else None
+        if tunes is None:
+            return
+
+        try:
+            if not sidecar.complete():
+                return
+            index = SidecarIndex(tunes, sidecar)
+        except sqlite3.Error:
+            with self._index_lock:
+                if self._sidecar is sidecar:
+                    self._drop_sidecar()
+            return
+
+        with self._index_lock:
+            old = self._index
+            if self._file_tunes is tunes and \
+               (old is None or isinstance(old, SidecarIndex) and old.sidecar is sidecar):
+                for method, tune in self._edits:
+                    getattr(index, method)(tune)
+                self._index = index
+                self._edits = []
+                self._file_tunes = None
+
+    def _drop_sidecar(self):
+        """Stop using the sidecar, and any search index that searches it;
+        call with _index_lock held"""
+        if isinstance(self._index, SidecarIndex) and self._index.sidecar is self._sidecar:
+            self._index = None
+        self._sidecar = None
+        self._file_tunes = self._file = self._sidecar_stale = None
+        self._edits = []
+
+    def _replace_sidecar(self):
+        """Tell the sidecar about the tunes in a changed file, if it hasn't
+        been told, and return it, or None if there's no sidecar (or it
+        fails).  This writes all the file's tunes to it, so call it
+        without _index_lock held."""
+        with self._sidecar_lock:
+            with self._index_lock:
+                sidecar, stale, file = self._sidecar, self._sidecar_stale, self._file
+            if sidecar is None or stale is None:
+                return sidecar
+
+            stat, digest, encoding, tunes = stale
             try:
-                next_encoding = _encodings[_encodings.index(encoding) + 1]
-            except IndexError: # you ran out of encodings, you poor sod
-                raise LoadError("Unable to determine file encoding. Tried: " + ", ".join(_encodings))
-            
-            self._load(next_encoding)
-            return None
+                if tunes is None:
+                    # a file just saved, scanned here rather than on
+                    # the GUI thread
+                    digest, tunes = file_digest(file[0]), _scan(file[0], encoding)
+                sidecar.replace(stat, digest, file[0], encoding, tunes)
+            except sqlite3.Error:
+                with self._index_lock:
+                    if self._sidecar is sidecar:
+                        self._drop_sidecar()
+                return None
 
-        def maybe_add_xref_tag(tune):
-            if tune.startswith("X:"):
-                return tune
-            else:
-                return "X:" + tune
-            
-        tunes = [tune for tune in map(tune_from_abc,
-                                      [maybe_add_xref_tag(tune)
-                                       for tune in abc.split("\nX:")
-                                       if tune.strip()])]
+            with self._index_lock:
+                if self._sidecar_stale is stale:
+                    self._sidecar_stale = None
+            return sidecar
+
+    def update_sidecar(self):
+        """Bring the tunebook's sidecar up to date with its file, putting
+        any tunes it hasn't seen in its full-text index; for a big
+        tunebook opened for the first time (or saved) this takes a while,
+        so do it in the background"""
+        sidecar = self._replace_sidecar()
+        with self._index_lock:
+            if sidecar is None or self._sidecar is not sidecar or self._file is None:
+                return
+            data, encoding = self._file
 
-        # trim off extraneous matter before first tune
-        if not abc.strip().startswith("X:"):
-            tunes = tunes[1:]
+        # the tunes' text is taken from the file, since the tunes
+        # themselves may have been edited since
+        try:
+            sidecar.index(
+                (doc, TuneIndex.normalized(AbcTune(0, source=(data, start, end, encoding))))
+                for doc, start, end in sidecar.unindexed())
+        except sqlite3.Error:
+            with self._index_lock:
+                if self._sidecar is sidecar:
+                    self._drop_sidecar()
+            return
 
-        for tune in tunes:
-            list.append(self, tune)
+        # a file just saved is searched in the sidecar again now
+        self._use_sidecar_index()
+
+        with self._index_lock:
+            # the sidecar has all it needs from the file's bytes (lazy
+            # tunes hold on to them themselves)
+            if self._file is not None and self._file[0] is data and \
+               self._sidecar_stale is None:
+                self._file = None
+
+    def close(self):
+        """Let go of the tunebook's sidecar, e.g. when another tunebook
+        is opened in its place; anything being done with it in the
+        background stops"""
+        with self._index_lock:
+            sidecar = self._sidecar
+            self._drop_sidecar()
+        if sidecar is not None:
+            sidecar.close()
+
+    def title_index(self):
+        """Return the TitleIndex of the tunebook, building it the first
+        time"""
+        return self._build_index("_title_index", TitleIndex)
+
+    def find_titles(self, query, limit=10):
+        """Return a list of (score, tune) for up to limit tunes with a
+        title spelled something like query, best first; score runs from
+        0 (nothing alike) to 1 (the same)"""
+        return [(score, tune)
+                for score, tune, title in self.title_index().lookup(query, limit)]
+
+    def incipit_index(self):
+        """Return the IncipitIndex of the tunebook, building it the first
+        time (which is slow for big tunebooks, so do that in the
+        background)"""
+        return self._build_index("_incipit_index", IncipitIndex)
+
+    def find_incipit(self, abc, limit=20, rhythm=False):
+        """Return a list of up to limit tunes with the notes of abc (e.g.
+        "GABc dedB") near the start of their melody, in any key, those
+        where the notes come earliest first; with rhythm, the notes'
+        lengths have to match too"""
+        return [tune for position, tune
+                in self.incipit_index().search(abc, limit, rhythm)]
+
+    def related_index(self):
+        """Return the RelatedIndex of the tunebook, building it the first
+        time (in the background, for big tunebooks)"""
+        return self._build_index("_related_index", RelatedIndex)
+
+    def related_tunes(self, tune, count=10):
+        """Return a list of (similarity, tune) of the count tunes of the
+        tunebook with melodies most like tune's, most alike first"""
+        return self.related_index().similar(tune, count)
+
+    def _reindex(self, method, tune):
+        """Call method(tune) on the search indexes there are"""
+        with self._index_lock:
+            if self._index is not None:
+                getattr(self._index, method)(tune)
+            if self._file_tunes is not None:
+                self._edits.append((method, tune))
+
+            for index in [self._title_index, self._incipit_index,
+                          self._related_index]:
+                if index is not None:
+                    getattr(index, method)(tune)
+
+            for edits in self._building:
+                edits.append((method, tune))
+
+    def tune_changed(self, tune):
+        """Let the tunebook know one of its tunes has been edited"""
+        self._reindex("update", tune)
+
+    def transposed(self, semitones, tunes=None):
+        """Return a list of (tune, its ABC, that transposed by semitones)
+        for the tunes (a selection of the tunebook's, or all of them);
+        the tunes aren't changed, so this can be done in the background
+        and the result passed to replace_abc afterwards"""
+        transposer = Transposer(semitones)
+        result = []
+        for tune in (self if tunes is None else tunes):
+            abc = tune.content
+            result.append((tune, abc, transposer.transpose(abc)))
+        return result
+
+    def replace_abc(self, changes):
+        """Give tunes new ABC, from a list of (tune, its ABC, the new ABC)
+        as transposed() returns; a tune edited since is left alone.
+        Returns the tunes changed."""
+        changed = []
+        for tune, old_abc, new_abc in changes:
+            if tune.content == old_abc:
+                tune.update_from_abc(new_abc)
+                self.tune_changed(tune)
+                changed.append(tune)
+        return changed
+
+    def transpose(self, semitones, tunes=None):
+        """Transpose the tunes (a selection of the tunebook's, or all of
+        them) by semitones"""
+        return self.replace_abc(self.transposed(semitones, tunes))
 
     def titles(self):
         """Return a list of tune titles"""
@@ -256,40 +1237,98 @@ filename and a method to return a sorted list of titles"""
         if direction > 0 and len(self) > index + 1:
             cur, next = self[index], self[index + 1]
             self[index + 1], self[index] = cur, next
+            self._mark_unnumbered(index)
         elif direction < 0 and index > 0:
             cur, prev = self[index], self[index - 1]
             self[index - 1], self[index] = cur, prev
+            self._mark_unnumbered(index - 1)
         else:
             return False
 
         return True
-            
+
+    def _mark_unnumbered(self, index):
+        """Note that xrefs from index on may be out of sequence"""
+        if self._unnumbered_from is None or index < self._unnumbered_from:
+            self._unnumbered_from = index
+
+    def _number(self, index):
+        """Give the tune at index the xref of its position"""
+        if self[index].xref != index + 1:
+            self[index].set_xref(index + 1)
             
     def renumber(self):
-        """Renumber tunes with sequential xrefs"""
-        xref = 1
-        for tune in self:
-            tune.xref = xref
-            xref_line = [line for line in tune.content.split("\n")
-                         if line.strip().startswith("X:")][0]
-            tune.content = tune.content.replace(xref_line,
-                                                "X:%s" % xref)
-            xref += 1
+        """Renumber tunes with sequential xrefs; only the tunes from the
+        first one moved, inserted or removed since the last renumbering
+        are looked at, and only those with the wrong xref are changed"""
+        if self._unnumbered_from is None:
+            return
+
+        for index in range(self._unnumbered_from, len(self)):
+            self._number(index)
+
+        self._unnumbered_from = None
 
     def write(self, fn):
-        """Save the tunebook to a file"""
+        """Save the tunebook to a file, and its sidecar along with it"""
         self.renumber() # in case of duplicate xrefs
-        with codecs.open(fn, "w", "utf-8") as f:
-            f.write("\n\n".join([tune.content
-                                 for tune in self]))
+        data = (file_header(self.header) +
+                "\n\n".join([tune.text()
+                              for tune in self])).encode("utf-8")
+        with open(fn, "wb") as f:
+            f.write(data)
+            f.flush()
+            stat = os.fstat(f.fileno())
         self.filename = fn
-            
+        self.encoding = "utf-8"
+
+        with self._index_lock:
+            # a sidecar that's being searched goes on being searched
+            # while update_sidecar (in the background) indexes just the
+            # edited tunes, then it's searched as the new file
+            old = None
+            rebase = isinstance(self._index, SidecarIndex) and \
+                self._sidecar.path == sidecar_path(fn)
+
+            if not rebase:
+                old = self._sidecar
+                self._drop_sidecar()
+                self._sidecar = sidecar(fn)
+
+            self._edits = []
+            if self._sidecar is not None:
+                # the tunes are only wanted for a SidecarIndex, if
+                # there's no other index
+                self._file_tunes = list(self) if self._index is None or rebase else None
+                self._file = (data, "utf-8")
+                self._sidecar_stale = (stat, None, "utf-8", None)
+
+        if old is not None:
+            old.close()
+
     def append(self, tune):
         """Add a tune to the tunebook"""
         list.append(self, tune)
-        self.renumber() # redo xref numbering to keep unique
+        self._number(len(self) - 1)
+        self._reindex("add", tune)
+
+    def extend(self, tunes):
+        """Add several tunes to the tunebook"""
+        start = len(self)
+        list.extend(self, tunes)
+        for index in range(start, len(self)):
+            self._number(index)
+            self._reindex("add", self[index])
+
+    def insert(self, index, tune):
+        """Add a tune to the tunebook before index"""
+        list.insert(self, index, tune)
+        self._mark_unnumbered(min(index, len(self) - 1))
+        self._reindex("add", tune)
 
     def remove(self, tune):
         """Delete a tune from the tunebook"""
-        list.remove(self, tune)
-        self.renumber()
+        index = self.index(tune)
+        del self[index]
+        self._mark_unnumbered(index)
+        self._reindex("remove", tune)
@@ -30,6 +30,8 @@ setup(
     data_files=[("/usr/share/applications", ["abcenatrix.desktop"]),
                 ("/usr/share/pixmaps", ["abcenatrix.png"])],
     install_requires=requirements,
+    # near-duplicate detection works without, but slowly
+    extras_require={"dedupe": ["numpy"]},
     packages=['abcv',],
     long_description=read('README.md'),
     classifiers=[
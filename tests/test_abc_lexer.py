@@ -0,0 +1,83 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import random
+import unittest
+
+from abcv.abc_lexer import LexedText, lex, body_start, NOTE, FIELD
+
+_tune = """X:1
+T:The Test Reel
+M:4/4
+L:1/8
+K:G
+|:"G"GABc dBAG|[K:D]FAdf a2fd|1 e2 {g}fe d4:|2 [df]2 z2 d4||
+"""
+
+# bits of ABC edits are made of, so the text goes in and out of tunes,
+# headers and bodies
+_pieces = ["A", "c'", "^f", "|", ":|", "[", "]", "1", "\n", "\n\n", "X:2\n",
+           "K:D\n", "T:x\n", "%", "%%MIDI program 1\n", '"Am"', "z2", " "]
+
+
+class LexedTextTest(unittest.TestCase):
+    def assertLexed(self, lexed):
+        self.assertEqual(lexed.tokens(), lex(lexed.text))
+
+    def test_whole_text(self):
+        self.assertLexed(LexedText(_tune))
+
+    def test_edit_in_body(self):
+        lexed = LexedText(_tune)
+        start = _tune.index("dBAG")
+        lexed.edit(start, start + 4, "^c=c_B")
+        self.assertEqual(lexed.text, _tune.replace("dBAG", "^c=c_B"))
+        self.assertLexed(lexed)
+
+    def test_edit_ending_header(self):
+        # taking away the K: line makes the music part of the header
+        lexed = LexedText(_tune)
+        start = _tune.index("K:G")
+        lexed.edit(start, start + 4, "")
+        self.assertLexed(lexed)
+        self.assertNotIn(NOTE, [kind for kind, start, end in lexed.tokens()])
+
+        lexed.edit(start, start, "K:G\n")
+        self.assertEqual(lexed.text, _tune)
+        self.assertLexed(lexed)
+
+    def test_blank_line_ends_tune(self):
+        lexed = LexedText(_tune)
+        start = _tune.index("[K:D]")
+        lexed.edit(start, start, "\n\n")
+        self.assertLexed(lexed)
+
+    def test_random_edits(self):
+        rand = random.Random(1)
+        for trial in range(300):
+            lexed = LexedText(_tune)
+            for i in range(10):
+                start = rand.randint(0, len(lexed.text))
+                end = rand.randint(start, min(len(lexed.text), start + 12))
+                new_text = "".join(rand.choice(_pieces)
+                                   for j in range(rand.randint(0, 3)))
+                lexed.edit(start, end, new_text)
+                self.assertLexed(lexed)
+
+
+class BodyStartTest(unittest.TestCase):
+    def test_after_key(self):
+        self.assertEqual(body_start(_tune), _tune.index("|:"))
+
+    def test_no_key(self):
+        self.assertIsNone(body_start("X:1\nT:No Key\nabc|\n"))
+
+    def test_key_fields_in_lex(self):
+        fields = [_tune[start:end] for kind, start, end in lex(_tune)
+                  if kind == FIELD]
+        self.assertEqual(fields[-1], "K:G")
+
+
+if __name__ == "__main__":
+    unittest.main()
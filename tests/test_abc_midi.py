@@ -0,0 +1,68 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import unittest
+
+from abcv.abc_midi import compile_midi
+
+_keys = {"C": 60, "D": 62, "E": 64, "F": 65, "G": 67, "A": 69, "B": 71, "c": 72}
+
+
+def _played(body):
+    """Return the letters of the notes compile_midi plays for the tune
+    body, in order"""
+    midi = compile_midi("X:1\nT:Test\nM:4/4\nL:1/4\nK:C\n" + body + "\n")
+    names = dict((key, letter) for letter, key in _keys.items())
+    return " ".join(names[message.note] for message in midi.tracks[1]
+                    if message.type == "note_on")
+
+
+class RepeatTest(unittest.TestCase):
+    def test_no_repeats(self):
+        self.assertEqual(_played("C D|E F|]"), "C D E F")
+
+    def test_simple_repeat(self):
+        self.assertEqual(_played("|:C D:|E F|]"), "C D C D E F")
+
+    def test_repeat_from_start(self):
+        self.assertEqual(_played("C D:|E F|]"), "C D C D E F")
+
+    def test_double_repeat(self):
+        self.assertEqual(_played("|:C D::E F:|"), "C D C D E F E F")
+
+    def test_endings(self):
+        self.assertEqual(_played("|:C D|1 E:|2 F|]"), "C D E C D F")
+
+    def test_bracket_endings(self):
+        self.assertEqual(_played("|:C D|[1 E:|[2 F|]"), "C D E C D F")
+
+    def test_three_endings(self):
+        self.assertEqual(_played("|:C|1 D:|2 E:|3 F|]"), "C D C E C F")
+
+    def test_repeat_after_endings(self):
+        self.assertEqual(_played("|:C D|1 E:|2 F|]\n|:G A:|"),
+                         "C D E C D F G A G A")
+
+    def test_endings_after_endings(self):
+        self.assertEqual(_played("|:C D|1 E:|2 F||\n|:G A|1 B:|2 c|]"),
+                         "C D E C D F G A B G A c")
+
+    def test_repeat_from_section_after_endings(self):
+        self.assertEqual(_played("C D|[1 E:|[2 F||\nG A:|"),
+                         "C D E C D F G A G A")
+
+
+class MessageTest(unittest.TestCase):
+    def test_files_dont_share_messages(self):
+        abc = "X:1\nT:Test\nM:4/4\nL:1/4\nK:C\nC D E F|]\n"
+        first, second = compile_midi(abc), compile_midi(abc)
+        for message in first.tracks[1]:
+            if message.type == "note_on":
+                message.velocity = 1
+        self.assertTrue(all(message.velocity > 1 for message in second.tracks[1]
+                            if message.type == "note_on"))
+
+
+if __name__ == "__main__":
+    unittest.main()
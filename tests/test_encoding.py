@@ -0,0 +1,56 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import unittest
+
+from abcv.tunebook import _detect_encoding
+
+
+def _tunebook(titles):
+    """Return the ABC of a tunebook of short tunes with the titles"""
+    return "\n\n".join("X:%d\nT:%s\nM:6/8\nL:1/8\nK:G\nGAB c2d|edc BAG|\n" % (i + 1, title)
+                       for i, title in enumerate(titles))
+
+
+class DetectEncodingTest(unittest.TestCase):
+    def test_latin1_accents(self):
+        abc = _tunebook(["Sí Bheag, Sí Mhór",
+                         "Ríl Mhór Bhaile an Chalaidh",
+                         "Le Reel à Bouchard",
+                         "«Été» à Québec",
+                         "La Bastringue (Québec)",
+                         "Schöne Müllerin",
+                         "Gruß aus Kärnten",
+                         "Ñandutí",
+                         "Façon d'été"])
+        encoding = _detect_encoding(abc.encode("ISO-8859-1"))
+        self.assertIn(encoding, ["ISO-8859-1", "Windows-1252", "ISO-8859-15"])
+        self.assertEqual(abc.encode("ISO-8859-1").decode(encoding), abc)
+
+    def test_latin2_accents(self):
+        # runs of accented letters, as in żół, look like Cyrillic
+        # words in Windows-1251 unless there are ASCII letters about them
+        abc = _tunebook(["Zażółć",
+                         "Gżegżółka",
+                         "Pożółkłe liście",
+                         "Krakowiak z Łańcuta",
+                         "Čardáš ze Žďáru"])
+        encoding = _detect_encoding(abc.encode("ISO-8859-2"))
+        self.assertNotEqual(encoding, "Windows-1251")
+        self.assertEqual(abc.encode("ISO-8859-2").decode(encoding), abc)
+
+    def test_cyrillic(self):
+        abc = _tunebook(["Калинка",
+                         "Коробейники",
+                         "Ой, то не вечер",
+                         "Во поле берёза стояла"])
+        self.assertEqual(_detect_encoding(abc.encode("Windows-1251")), "Windows-1251")
+
+    def test_utf8(self):
+        abc = _tunebook(["Sí Bheag, Sí Mhór", "Калинка"])
+        self.assertEqual(_detect_encoding(abc.encode("utf-8")), "utf-8")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import threading
+import unittest
+
+from abcv.jobs import JobScheduler, PRIORITY_VISIBLE, PRIORITY_PREFETCH, PRIORITY_BATCH, PRIORITY_IDLE
+
+# how long a test waits for jobs before giving up, in seconds
+_timeout = 5
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.ran = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def record(self, name):
+        with self.lock:
+            self.ran.append(name)
+
+    def blocked(self, workers=1):
+        """Make the scheduler with its workers tied up until the returned
+        Event is set, so jobs queue up behind them"""
+        self.scheduler = JobScheduler(workers=workers,
+                                      limits={PRIORITY_VISIBLE: workers})
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def wait():
+            started.release()
+            release.wait(_timeout)
+
+        for i in range(workers):
+            self.scheduler.submit(wait)
+        for i in range(workers):
+            self.assertTrue(started.acquire(timeout=_timeout))
+        return release
+
+    def run_jobs(self, release, names):
+        """Let the queued jobs run, waiting for them with a job of the
+        least urgent class, which (with one worker) runs last, then check
+        the names of the jobs that ran"""
+        done = threading.Event()
+        self.scheduler.submit(lambda: done.set(), priority=PRIORITY_IDLE)
+        release.set()
+        self.assertTrue(done.wait(_timeout))
+        self.assertEqual(sorted(self.ran), sorted(names))
+
+    def test_priority_order(self):
+        release = self.blocked()
+        for priority, name in [(PRIORITY_IDLE, "idle"),
+                               (PRIORITY_BATCH, "batch"),
+                               (PRIORITY_PREFETCH, "prefetch"),
+                               (PRIORITY_VISIBLE, "visible")]:
+            self.scheduler.submit(self.record, (name,), priority=priority)
+        self.run_jobs(release, ["visible", "prefetch", "batch", "idle"])
+        self.assertEqual(self.ran, ["visible", "prefetch", "batch", "idle"])
+
+    def test_same_priority_in_order(self):
+        release = self.blocked()
+        for name in ["first", "second", "third"]:
+            self.scheduler.submit(self.record, (name,), priority=PRIORITY_BATCH)
+        self.run_jobs(release, ["first", "second", "third"])
+        self.assertEqual(self.ran, ["first", "second", "third"])
+
+    def test_export_before_warm_up(self):
+        # an export queued after the indexes' warm-up jobs still goes
+        # first
+        release = self.blocked()
+        for i in range(5):
+            self.scheduler.submit(self.record, ("warm-up",), priority=PRIORITY_IDLE)
+        self.scheduler.submit(self.record, ("export",), priority=PRIORITY_BATCH)
+        self.run_jobs(release, ["export"] + ["warm-up"] * 5)
+        self.assertEqual(self.ran[0], "export")
+
+    def test_newest_with_key_wins(self):
+        release = self.blocked()
+        for name in ["old", "new"]:
+            self.scheduler.submit(self.record, (name,), key="tune")
+        self.run_jobs(release, ["new"])
+
+    def test_cancel_priority(self):
+        release = self.blocked()
+        self.scheduler.submit(self.record, ("prefetch",), priority=PRIORITY_PREFETCH)
+        self.scheduler.submit(self.record, ("visible",))
+        self.scheduler.cancel(priority=PRIORITY_PREFETCH)
+        self.run_jobs(release, ["visible"])
+
+    def test_limits(self):
+        # with two workers, only one does batch jobs, so a visible job
+        # doesn't wait for the other batch job
+        self.scheduler = JobScheduler(workers=2)
+        batch_release = threading.Event()
+        batch_started = threading.Event()
+        visible_done = threading.Event()
+        batches_done = threading.Semaphore(0)
+
+        def batch(name):
+            batch_started.set()
+            batch_release.wait(_timeout)
+            self.record(name)
+            batches_done.release()
+
+        self.scheduler.submit(batch, ("batch 1",), priority=PRIORITY_BATCH)
+        self.scheduler.submit(batch, ("batch 2",), priority=PRIORITY_BATCH)
+        self.assertTrue(batch_started.wait(_timeout))
+        self.scheduler.submit(lambda: visible_done.set())
+
+        self.assertTrue(visible_done.wait(_timeout))
+        self.assertEqual(self.ran, [])
+        batch_release.set()
+        for i in range(2):
+            self.assertTrue(batches_done.acquire(timeout=_timeout))
+        self.assertEqual(self.ran, ["batch 1", "batch 2"])
+
+    def test_on_done_and_on_error(self):
+        self.scheduler = JobScheduler(workers=1)
+        results, errors = [], []
+        done = threading.Event()
+        self.scheduler.submit(lambda: 42, on_done=results.append)
+
+        def fail():
+            raise ValueError("no")
+        self.scheduler.submit(fail, on_error=lambda exc_info: (errors.append(exc_info[0]),
+                                                               done.set()))
+        self.assertTrue(done.wait(_timeout))
+        self.assertEqual(results, [42])
+        self.assertEqual(errors, [ValueError])
+
+
+if __name__ == "__main__":
+    unittest.main()
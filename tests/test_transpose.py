@@ -0,0 +1,86 @@
+# coding=utf-8
+
+from __future__ import nested_scopes, generators, division, absolute_import, with_statement, print_function, unicode_literals
+
+import unittest
+
+from abcv.transpose import Transposer, transposed_key
+
+_header = "X:1\nT:Test\nM:4/4\nL:1/8\n"
+
+
+def _transposed(key, body, semitones):
+    """Return the K: value and body of a tune transposed by semitones"""
+    abc = Transposer(semitones).transpose("%sK:%s\n%s\n" % (_header, key, body))
+    key_line, body = abc[len(_header):].split("\n", 1)
+    return key_line[2:], body.rstrip("\n")
+
+
+class KeyTest(unittest.TestCase):
+    def test_up_a_tone(self):
+        self.assertEqual(transposed_key("G", 2), ("A", 1))
+
+    def test_flat_keys(self):
+        # Ab rather than G#, with four flats rather than eight sharps
+        self.assertEqual(transposed_key("G", 1), ("Ab", 1))
+        self.assertEqual(transposed_key("C", 6), ("Gb", 4))
+
+    def test_modes(self):
+        self.assertEqual(transposed_key("Em", 1), ("Fm", 1))
+        self.assertEqual(transposed_key("Ador", -2), ("Gdor", -1))
+        self.assertEqual(transposed_key("F#m", -1), ("Fm", 0))
+
+    def test_octave(self):
+        self.assertEqual(transposed_key("Bb", 12), ("Bb", 7))
+
+    def test_no_key(self):
+        self.assertEqual(transposed_key("none", 2), ("none", 1))
+
+
+class TransposerTest(unittest.TestCase):
+    def test_notes_follow_key(self):
+        self.assertEqual(_transposed("G", "GABc dBAG|", 2), ("A", "ABcd ecBA|"))
+
+    def test_octaves(self):
+        self.assertEqual(_transposed("D", "B,A,|b'a'|", 3), ("F", "DC|d''c''|"))
+
+    def test_accidentals_kept(self):
+        # the sharp carries through the bar, and the natural F
+        # (not in the key of G) is a natural G in A
+        self.assertEqual(_transposed("G", "^c c|c =f f|", 2),
+                         ("A", "^d d|d =g g|"))
+
+    def test_accidentals_spelled_from_key(self):
+        self.assertEqual(_transposed("Bb", "B,2 _e ^f|", 1), ("B", "B,2 =e ^^f|"))
+
+    def test_accidentals_down(self):
+        self.assertEqual(_transposed("G", "c2 ^c2|", -2), ("F", "B2 =B2|"))
+
+    def test_chord_symbols(self):
+        self.assertEqual(_transposed("G", '"G"G2 "D7/F#"d2|"Am"A4|', 1),
+                         ("Ab", '"Ab"A2 "Eb7/G"e2|"Bbm"B4|'))
+
+    def test_inline_key(self):
+        self.assertEqual(_transposed("G", "G2 [K:Dmix] F2 c2|", 2),
+                         ("A", "A2 [K:Emix] G2 d2|"))
+
+    def test_grace_notes_and_chords(self):
+        self.assertEqual(_transposed("D", "{g}f2 [fa]|", -1), ("Db", "{g}f2 [fa]|"))
+
+    def test_text_left_alone(self):
+        self.assertEqual(_transposed("C", '"^Fine" C D|\nw: lyrics C D', 2),
+                         ("D", '"^Fine" D E|\nw: lyrics C D'))
+
+    def test_there_and_back(self):
+        body = '"G"GABc "D7/F#"d2^c2|"Am"=f2 f2 [K:Dmix] F2 c2|'
+        for semitones in range(-11, 12):
+            key, there = _transposed("G", body, semitones)
+            self.assertEqual(_transposed(key, there, -semitones), ("G", body))
+
+    def test_no_change(self):
+        abc = "%sK:G\nGABc|\n" % _header
+        self.assertEqual(Transposer(0).transpose(abc), abc)
+
+
+if __name__ == "__main__":
+    unittest.main()